@@ -0,0 +1,247 @@
+import asyncio
+import threading
+
+import numpy as np
+
+from LitoTTS import TTS_RATE, TTS_CHANNELS, TTS_SAMPLE_WIDTH
+
+
+class AudioOutputEngine:
+    """One long-lived output stream fed from a preallocated PCM ring buffer.
+
+    Producers append PCM with write()/enqueue() and get back the absolute byte
+    position where their audio ends, so a coroutine can await wait_played() for
+    exactly that point. Everything queued plays back to back on the same device
+    stream, and stop() drops whatever is still buffered, which the device
+    callback picks up on its next period.
+    """
+
+    def __init__(self, rate=TTS_RATE, channels=TTS_CHANNELS, sample_width=TTS_SAMPLE_WIDTH,
+                 frames_per_buffer=1024, buffer_seconds=30, audio=None, reference=None):
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frames_per_buffer = frames_per_buffer
+        self.frame_bytes = channels * sample_width
+
+        capacity = int(rate * buffer_seconds) * self.frame_bytes
+        self._ring = bytearray(capacity)
+        self._view = memoryview(self._ring)
+        self._capacity = capacity
+        self._silence = bytes(frames_per_buffer * self.frame_bytes)
+
+        # Absolute byte positions: everything before read_pos has been handed to the device
+        self._read_pos = 0
+        self._write_pos = 0
+        self._epoch = 0  # bumped by stop() so producers notice their audio was dropped
+        self._lock = threading.Lock()
+        self._waiters = []  # (position, loop, future)
+        self.gain = 1.0  # ducking, applied in the callback
+        self.reference = reference  # PlaybackReference for the echo canceller, gets what the device plays
+
+        # A PyAudio instance shared with the microphone is left for its owner to terminate
+        self._audio = audio
+        self._owns_audio = audio is None
+        self._stream = None
+
+    @property
+    def buffer_period(self):
+        return self.frames_per_buffer / self.rate
+
+    def start(self):
+        if self._stream is not None:
+            return
+        # Only here: the server's outputs are streamed and never need PortAudio
+        import pyaudio
+
+        if self._audio is None:
+            self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(
+            format=self._audio.get_format_from_width(self.sample_width),
+            channels=self.channels,
+            rate=self.rate,
+            output=True,
+            frames_per_buffer=self.frames_per_buffer,
+            stream_callback=self._callback
+        )
+        self._stream.start_stream()
+
+    def close(self):
+        self.stop()
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._audio is not None and self._owns_audio:
+            self._audio.terminate()
+            self._audio = None
+
+    def _read(self, wanted):
+        """Take up to wanted bytes off the ring, with the gain applied; b"" when idle."""
+        with self._lock:
+            available = min(self._write_pos - self._read_pos, wanted)
+            if available == 0:
+                return b""
+            start = self._read_pos % self._capacity
+            first = min(available, self._capacity - start)
+            out = bytes(self._view[start:start + first])
+            if first < available:
+                out += bytes(self._view[:available - first])
+            self._read_pos += available
+            self._notify_locked()
+        if self.gain != 1.0:
+            out = (np.frombuffer(out, dtype=np.int16) * self.gain).astype(np.int16).tobytes()
+        if self.reference is not None:
+            self.reference.played(out)
+        return out
+
+    def _callback(self, in_data, frame_count, time_info, status_flags):
+        import pyaudio
+
+        wanted = frame_count * self.frame_bytes
+        out = self._read(wanted)
+        if not out:
+            # Idle: hand the device silence without touching the ring
+            return self._silence[:wanted], pyaudio.paContinue
+        if len(out) < wanted:
+            out += self._silence[:wanted - len(out)]
+        return out, pyaudio.paContinue
+
+    def _notify_locked(self):
+        if not self._waiters:
+            return
+        pending = []
+        for position, loop, future in self._waiters:
+            if position <= self._read_pos:
+                loop.call_soon_threadsafe(_resolve, future, True)
+            else:
+                pending.append((position, loop, future))
+        self._waiters = pending
+
+    def enqueue(self, pcm):
+        """Copy as much of pcm as fits into the ring, return the number of bytes taken."""
+        with self._lock:
+            space = self._capacity - (self._write_pos - self._read_pos)
+            count = min(len(pcm), space)
+            count -= count % self.frame_bytes
+            if count <= 0:
+                return 0
+            start = self._write_pos % self._capacity
+            first = min(count, self._capacity - start)
+            self._view[start:start + first] = pcm[:first]
+            if first < count:
+                self._view[:count - first] = pcm[first:count]
+            self._write_pos += count
+            return count
+
+    async def write(self, pcm):
+        """Queue pcm behind whatever is already playing and return its end position.
+
+        Waits for room when the ring is full. Returns None if stop() dropped the
+        audio while we were waiting.
+        """
+        pcm = memoryview(pcm)
+        epoch = self._epoch
+        while True:
+            taken = self.enqueue(pcm)
+            pcm = pcm[taken:]
+            if self._epoch != epoch:
+                return None
+            if not len(pcm):
+                return self._write_pos
+            # Ring is full: wait until the device has consumed one more buffer period
+            await self.wait_played(self._read_pos + len(self._silence))
+            if self._epoch != epoch:
+                return None
+
+    async def wait_played(self, position):
+        """Wait until the device has consumed everything up to position.
+
+        Returns False if the audio was dropped by stop() before it got there.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if position <= self._read_pos:
+                return True
+            self._waiters.append((position, loop, future))
+        return await future
+
+    def stop(self):
+        """Drop everything still queued; the device goes silent within one buffer period."""
+        with self._lock:
+            self._epoch += 1
+            self._read_pos = self._write_pos
+            waiters, self._waiters = self._waiters, []
+        for position, loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, False)
+
+    def set_gain(self, gain):
+        """Duck (gain < 1) or restore (gain 1.0) playback from the next buffer period."""
+        self.gain = gain
+
+    def is_playing(self):
+        return self._write_pos > self._read_pos
+
+
+class StreamedAudioOutput(AudioOutputEngine):
+    """AudioOutputEngine that streams to a remote device instead of a local one.
+
+    A task on the event loop takes one buffer period off the ring per period
+    and hands it to send(pcm), so positions advance in real time the way
+    they do on a sound card and wait_played(), barge-in and the lookahead
+    behave the same. Nothing is sent while idle. The device is expected to
+    keep a short jitter buffer; stop() tells it to drop that buffer through
+    flush().
+    """
+
+    def __init__(self, send, flush, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._send = send
+        self._flush = flush
+        self._wake = asyncio.Event()
+        self._dropped = False  # stop() dropped audio, the device should drop its buffer too
+        self._pump = None
+
+    def start(self):
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        while True:
+            if self._dropped:
+                self._dropped = False
+                await self._flush()
+            if not self.is_playing():
+                self._wake.clear()
+                await self._wake.wait()
+                due = loop.time()
+                continue
+            out = self._read(self.frames_per_buffer * self.frame_bytes)
+            if out:
+                await self._send(out)
+            due += self.buffer_period
+            await asyncio.sleep(max(0.0, due - loop.time()))
+
+    async def write(self, pcm):
+        self._wake.set()
+        return await super().write(pcm)
+
+    def stop(self):
+        if self.is_playing():
+            self._dropped = True
+            self._wake.set()
+        super().stop()
+
+    def close(self):
+        self.stop()
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
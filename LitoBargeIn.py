@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+
+class BargeInController:
+    """Reacts to the user talking over the bot long before Google sends is_final.
+
+    Local voice activity while audio is playing ducks the output at once.
+    An interim transcript with at least min_chars characters confirms the
+    interruption: playback stops and on_confirm() is awaited so the caller
+    can cancel the current turn. If nothing is confirmed within
+    resume_after seconds the activity is treated as noise and the volume
+    comes back.
+    """
+
+    def __init__(self, output_getter, on_confirm, duck_gain=0.25, min_chars=2, min_voiced_chunks=1,
+                 resume_after=1.5):
+        self.output_getter = output_getter
+        self.on_confirm = on_confirm
+        self.duck_gain = duck_gain
+        self.min_chars = min_chars
+        self.min_voiced_chunks = min_voiced_chunks
+        self.resume_after = resume_after
+
+        self.ducked_at = None
+        self.confirmed = False
+        self._voiced = 0
+        self._resume_handle = None
+
+        self.ducks = 0
+        self.stops = 0
+        self.resumes = 0
+        self.duck_latency = 0.0
+
+    def _output(self):
+        output = self.output_getter()
+        return output if output is not None and output.is_playing() else None
+
+    def on_voice_activity(self, voiced, captured_at=None):
+        """Called on the event loop with the VAD decision for each captured chunk."""
+        self._voiced = self._voiced + 1 if voiced else 0
+        if self.ducked_at is not None or self._voiced < self.min_voiced_chunks:
+            return
+        output = self._output()
+        if output is None:
+            return
+        output.set_gain(self.duck_gain)
+        self.ducked_at = time.monotonic()
+        self.confirmed = False
+        self.ducks += 1
+        if captured_at is not None:
+            self.duck_latency += self.ducked_at - captured_at
+        self._resume_handle = asyncio.get_running_loop().call_later(self.resume_after, self._resume)
+
+    async def on_interim(self, transcript):
+        """Called with each interim transcript, returns True if it stopped the bot."""
+        if self.confirmed or len(transcript.strip()) < self.min_chars:
+            return False
+        output = self._output()
+        if output is None and self.ducked_at is None:
+            return False
+        self.confirmed = True
+        self.stops += 1
+        self._cancel_resume()
+        if output is not None:
+            output.stop()
+        self._restore_gain()
+        await self.on_confirm()
+        return True
+
+    def reset(self):
+        """A new turn begins: forget the last interruption."""
+        self._cancel_resume()
+        self._restore_gain()
+        self.confirmed = False
+
+    def _resume(self):
+        self._resume_handle = None
+        if not self.confirmed and self.ducked_at is not None:
+            self.resumes += 1
+            self._restore_gain()
+
+    def _restore_gain(self):
+        output = self.output_getter()
+        if output is not None:
+            output.set_gain(1.0)
+        self.ducked_at = None
+
+    def _cancel_resume(self):
+        if self._resume_handle is not None:
+            self._resume_handle.cancel()
+            self._resume_handle = None
+
+    def stats(self):
+        return {
+            'ducks': self.ducks,
+            'stops': self.stops,
+            'resumed_as_noise': self.resumes,
+            'mean_duck_ms': 1000 * self.duck_latency / self.ducks if self.ducks else 0.0,
+        }
@@ -0,0 +1,523 @@
+import logging
+import threading
+import time
+
+import av
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Names of RecognitionConfig.AudioEncoding values. google.cloud.speech takes a while to import
+# and the Whisper backend never needs it, so it is only loaded for recognition_config().
+ENCODINGS = ('LINEAR16', 'FLAC', 'OGG_OPUS')
+
+# Opus only runs at these rates, Google expects sample_rate_hertz to match
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+class Resampler:
+    """Streaming int16 mono resampler: windowed-sinc low-pass, then linear interpolation.
+
+    Filter history and the fractional read position carry over between
+    chunks, so consecutive chunks join without clicks.
+    """
+
+    def __init__(self, in_rate, out_rate, taps=63):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.step = in_rate / out_rate
+        # Cut off a little below the output Nyquist when downsampling
+        cutoff = 0.45 * min(in_rate, out_rate) / in_rate
+        n = np.arange(taps) - (taps - 1) / 2
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+        self.kernel = (kernel / kernel.sum()).astype(np.float32)
+        self._history = np.zeros(taps - 1, dtype=np.float32)
+        self._last = np.float32(0)
+        self._t = 0.0
+
+    def process(self, pcm):
+        if self.in_rate == self.out_rate:
+            return pcm
+        x = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        if not len(x):
+            return b""
+        filtered = np.convolve(np.concatenate((self._history, x)), self.kernel, mode='valid')
+        self._history = np.concatenate((self._history, x))[-(len(self.kernel) - 1):]
+
+        # Index 0 is the last filtered sample of the previous chunk
+        y = np.concatenate(([self._last], filtered))
+        count = int(np.ceil((len(y) - 1 - self._t) / self.step))
+        positions = self._t + np.arange(max(count, 0)) * self.step
+        index = positions.astype(np.int64)
+        frac = (positions - index).astype(np.float32)
+        out = y[index] * (1 - frac) + y[index + 1] * frac
+
+        self._t = (positions[-1] + self.step if count > 0 else self._t) - len(filtered)
+        self._last = filtered[-1]
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16).tobytes()
+
+
+class _ByteSink:
+    """Non-seekable file object that collects whatever the muxer writes."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class StreamEncoder:
+    """Incremental FLAC or OGG_OPUS encoder producing a continuous byte stream."""
+
+    def __init__(self, encoding, rate):
+        self.rate = rate
+        self._sink = _ByteSink()
+        if encoding == 'FLAC':
+            self._container = av.open(self._sink, 'w', format='flac')
+            self._stream = self._container.add_stream('flac', rate=rate)
+        elif encoding == 'OGG_OPUS':
+            # Short Ogg pages, otherwise the muxer holds a full second of audio back
+            self._container = av.open(self._sink, 'w', format='ogg', options={'page_duration': '100000'})
+            self._stream = self._container.add_stream('libopus', rate=rate)
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        self._stream.layout = 'mono'
+        self._pts = 0
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(1, -1)
+        frame = av.AudioFrame.from_ndarray(samples, format='s16', layout='mono')
+        frame.sample_rate = self.rate
+        frame.pts = self._pts
+        self._pts += samples.shape[1]
+        for packet in self._stream.encode(frame):
+            self._container.mux(packet)
+        return self._sink.drain()
+
+    def close(self):
+        for packet in self._stream.encode(None):
+            self._container.mux(packet)
+        self._container.close()
+        return self._sink.drain()
+
+
+class CaptureProcessor:
+    """Capture-side stage between the microphone generator and the STT requests.
+
+    Resamples the device rate down to what the recognizer needs, optionally
+    compresses it, and keeps count of uplink bytes and CPU time per chunk.
+    """
+
+    def __init__(self, in_rate, target_rate=16000, encoding='LINEAR16', report_interval=30):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        if encoding == 'OGG_OPUS' and target_rate not in OPUS_RATES:
+            raise ValueError(f"OGG_OPUS needs one of {OPUS_RATES} Hz, got {target_rate}")
+        self.in_rate = in_rate
+        self.target_rate = target_rate
+        self.encoding = encoding
+        self.report_interval = report_interval
+        self.resampler = Resampler(in_rate, target_rate)
+        self.encoder = None if encoding == 'LINEAR16' else StreamEncoder(encoding, target_rate)
+
+        self.chunks = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self._started = None
+        self._last_report = None
+
+    def recognition_config(self, language_code, **kwargs):
+        """RecognitionConfig matching what this processor sends."""
+        from google.cloud import speech
+        return speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding[self.encoding],
+            sample_rate_hertz=self.target_rate,
+            language_code=language_code,
+            **kwargs
+        )
+
+    def process(self, chunk):
+        start = time.thread_time()
+        data = self.resampler.process(chunk)
+        if self.encoder is not None:
+            data = self.encoder.encode(data)
+        self.cpu_seconds += time.thread_time() - start
+        self.chunks += 1
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(data)
+        return data
+
+    def process_stream(self, chunks):
+        """Wrap a microphone generator, yielding only non-empty uplink payloads."""
+        self._started = self._last_report = time.monotonic()
+        for chunk in chunks:
+            data = self.process(chunk)
+            if data:
+                yield data
+            if self.report_interval and time.monotonic() - self._last_report >= self.report_interval:
+                self._last_report = time.monotonic()
+                logger.info("%s", self.report())
+        data = self.finish()
+        if data:
+            yield data
+
+    def finish(self):
+        """Flush the encoder at the end of the stream, return whatever it still held."""
+        if self.encoder is None:
+            return b""
+        data = self.encoder.close()
+        self.bytes_out += len(data)
+        return data
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        return {
+            'encoding': self.encoding,
+            'rate': self.target_rate,
+            'chunks': self.chunks,
+            'bytes_in_per_second': self.bytes_in / elapsed if elapsed else 0.0,
+            'bytes_out_per_second': self.bytes_out / elapsed if elapsed else 0.0,
+            'cpu_ms_per_chunk': 1000 * self.cpu_seconds / self.chunks if self.chunks else 0.0,
+        }
+
+    def report(self):
+        s = self.stats()
+        return (f"Uplink {s['encoding']}@{s['rate']}Hz: {s['bytes_out_per_second'] / 1024:.1f} KiB/s "
+                f"(raw {s['bytes_in_per_second'] / 1024:.1f} KiB/s), {s['cpu_ms_per_chunk']:.2f} ms CPU/chunk")
+
+
+class CaptureRing:
+    """Bounded, preallocated ring of captured 16-bit PCM between the device callback and a reader.
+
+    write() copies into the ring and never blocks or allocates, so the audio
+    callback cannot stall; read() hands out memoryviews into the ring, no
+    copies, valid until the next read(). When the reader falls behind:
+      drop-oldest  reads are at most chunk_bytes, and a backlog beyond
+                   max_backlog_bytes is dropped oldest first, so latency
+                   stays bounded when STT stalls
+      coalesce     a read returns everything waiting in one piece, so the
+                   reader catches up with one request instead of many
+    Either way a full ring drops its oldest unread audio. Overruns (writes
+    that had to drop something) and dropped bytes are counted.
+    """
+
+    POLICIES = ('drop-oldest', 'coalesce')
+
+    def __init__(self, capacity_bytes, chunk_bytes, policy='drop-oldest', max_backlog_bytes=None, frame_bytes=2):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unsupported capture policy: {policy}")
+        self.frame_bytes = frame_bytes
+        self.capacity = capacity_bytes - capacity_bytes % frame_bytes
+        self.chunk_bytes = chunk_bytes
+        self.policy = policy
+        self.max_backlog_bytes = max_backlog_bytes if policy == 'drop-oldest' else None
+        self._ring = bytearray(self.capacity)
+        self._view = memoryview(self._ring)
+        self._cond = threading.Condition()
+        self.closed = False
+
+        # Absolute byte positions: the last read() view starts at _held and must not be overwritten
+        self._held = 0
+        self._read = 0
+        self._write = 0
+
+        self.written_bytes = 0
+        self.dropped_bytes = 0
+        self.overruns = 0
+        self.max_backlog = 0
+
+    def _align(self, count):
+        return count - count % self.frame_bytes
+
+    def _drop_unread_locked(self, count):
+        count = min(self._align(count + self.frame_bytes - 1), self._write - self._read)
+        self._read += count
+        self.dropped_bytes += count
+        return count
+
+    def _put_locked(self, data):
+        count = len(data)
+        start = self._write % self.capacity
+        first = min(count, self.capacity - start)
+        self._view[start:start + first] = data[:first]
+        if first < count:
+            self._view[:count - first] = data[first:count]
+        self._write += count
+
+    def _get_locked(self, position, count):
+        start = position % self.capacity
+        first = min(count, self.capacity - start)
+        return bytes(self._view[start:start + first]) + bytes(self._view[:count - first])
+
+    def write(self, data):
+        """Append captured PCM; called from the audio thread."""
+        data = memoryview(data).cast('B')
+        with self._cond:
+            if self.closed:
+                return
+            count = self._align(len(data))
+            self.written_bytes += count
+            space = self.capacity - (self._write - self._held)
+            if count > space:
+                # Full: drop the oldest unread audio and move the rest up behind the view the reader
+                # still holds (rare, so the copy is fine)
+                self.overruns += 1
+                drop = min(self._align(count - space + self.frame_bytes - 1), self._write - self._read)
+                if drop:
+                    kept = self._get_locked(self._read + drop, self._write - self._read - drop)
+                    self._write = self._read
+                    self._put_locked(kept)
+                    self.dropped_bytes += drop
+                    space += drop
+                if count > space:
+                    # The reader holds the rest, the newest audio goes
+                    self.dropped_bytes += count - space
+                    count = self._align(space)
+            self._put_locked(data[:count])
+            backlog = self._write - self._read
+            if self.max_backlog_bytes and backlog > self.max_backlog_bytes:
+                self.overruns += 1
+                backlog -= self._drop_unread_locked(backlog - self.max_backlog_bytes)
+            self.max_backlog = max(self.max_backlog, backlog)
+            self._cond.notify()
+
+    def read(self, timeout=None):
+        """The next piece of audio as a memoryview (valid until the next read), None once closed and drained.
+
+        Also None after timeout seconds without audio, with closed still False.
+        """
+        with self._cond:
+            if self._read == self._write and not self.closed:
+                self._cond.wait_for(lambda: self._read != self._write or self.closed, timeout)
+            # The previous view is released
+            self._held = self._read
+            available = self._write - self._read
+            if not available:
+                return None
+            if self.policy == 'drop-oldest':
+                available = min(available, self.chunk_bytes)
+            start = self._read % self.capacity
+            count = min(available, self.capacity - start)
+            self._read += count
+            return self._view[start:start + count]
+
+    def chunks(self):
+        """Yield the audio as bytes, for readers that keep chunks around (pre-roll, STT replay)."""
+        while True:
+            view = self.read()
+            if view is None:
+                if self.closed:
+                    return
+                continue
+            yield bytes(view)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'written_bytes': self.written_bytes,
+            'dropped_bytes': self.dropped_bytes,
+            'overruns': self.overruns,
+            'backlog_bytes': self._write - self._read,
+            'max_backlog_bytes': self.max_backlog,
+        }
+
+
+class MicrophoneStream:
+    """PyAudio input stream feeding a CaptureRing, shared by the bot and the test scripts.
+
+    generator() yields the captured audio as bytes, read() gives zero-copy
+    views. A PyAudio instance passed in (shared with the output) is left for
+    its owner to terminate.
+    """
+
+    def __init__(self, rate, chunk, audio=None, buffer_seconds=10.0, policy='drop-oldest', max_backlog_seconds=3.0,
+                 device_index=None):
+        self.rate = rate
+        self.chunk = chunk
+        self.device_index = device_index
+        self.ring = CaptureRing(
+            int(rate * buffer_seconds) * 2,
+            chunk * 2,
+            policy=policy,
+            max_backlog_bytes=int(rate * max_backlog_seconds) * 2 if max_backlog_seconds else None
+        )
+        self.p = audio
+        self._owns_audio = audio is None
+        self.stream = None
+        self.device_overflows = 0
+        self.closed = True
+
+    def __enter__(self):
+        import pyaudio
+
+        if self.p is None:
+            self.p = pyaudio.PyAudio()
+        self.stream = self.p.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=self.rate,
+            input=True,
+            input_device_index=self.device_index,
+            frames_per_buffer=self.chunk,
+            stream_callback=self._fill_buffer
+        )
+        self.closed = False
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.closed = True
+        self.ring.close()  # Signal the generator to terminate
+        if self._owns_audio:
+            self.p.terminate()
+
+    def _fill_buffer(self, in_data, frame_count, time_info, status_flags):
+        import pyaudio
+
+        if status_flags & pyaudio.paInputOverflow:
+            # PortAudio itself lost input before the callback ran
+            self.device_overflows += 1
+        self.ring.write(in_data)
+        return None, pyaudio.paContinue
+
+    def read(self, timeout=None):
+        return self.ring.read(timeout)
+
+    def generator(self):
+        return self.ring.chunks()
+
+    def stats(self):
+        return dict(self.ring.stats(), device_overflows=self.device_overflows)
+
+
+class VoiceActivityDetector:
+    """Energy VAD over 20 ms sub-frames with an adaptive noise floor."""
+
+    def __init__(self, rate, frame_ms=20, ratio=3.0, min_rms=300, voiced_fraction=0.3):
+        self.frame = int(rate * frame_ms / 1000)
+        self.ratio = ratio
+        self.min_rms = min_rms
+        self.voiced_fraction = voiced_fraction
+        self.noise_floor = float(min_rms)
+
+    def is_speech(self, pcm):
+        x = np.frombuffer(pcm, dtype=np.int16)
+        frames = len(x) // self.frame
+        if not frames:
+            return False
+        x = x[:frames * self.frame].reshape(frames, self.frame).astype(np.float32)
+        rms = np.sqrt(np.mean(x * x, axis=1))
+        threshold = max(self.noise_floor * self.ratio, self.min_rms)
+        speech = np.mean(rms > threshold) >= self.voiced_fraction
+        if not speech:
+            # Track the background level slowly, and only while nobody is talking
+            self.noise_floor = 0.95 * self.noise_floor + 0.05 * float(np.median(rms))
+        return speech
+
+
+class SpeechGate:
+    """Splits the endless microphone stream into utterances worth sending to STT.
+
+    wait_for_speech() blocks until the VAD has seen speech for start_seconds
+    and returns a generator for that utterance: the pre-roll chunks first, so
+    the first syllable is not lost, then live chunks until trailing_silence
+    seconds of silence. close() makes both return at the next chunk; a
+    source that has no next chunk is for its owner to close.
+    """
+
+    def __init__(self, chunks, rate, vad=None, pre_roll=0.5, start_seconds=0.2, trailing_silence=1.0,
+                 on_activity=None):
+        self._chunks = iter(chunks)
+        self.on_activity = on_activity  # called with the VAD decision for every chunk
+        self.rate = rate
+        self.vad = vad or VoiceActivityDetector(rate)
+        self.pre_roll = pre_roll
+        self.start_seconds = start_seconds
+        self.trailing_silence = trailing_silence
+        self._pre_roll = []
+        self._pre_roll_seconds = 0.0
+        self.closed = False
+
+        self.started = time.monotonic()
+        self.captured_seconds = 0.0
+        self.streamed_seconds = 0.0
+        self.utterances = 0
+        self.last_voice_at = None  # monotonic time of the last voiced chunk, i.e. end of speech
+
+    def _is_speech(self, chunk):
+        speech = self.vad.is_speech(chunk)
+        if speech:
+            self.last_voice_at = time.monotonic()
+        if self.on_activity is not None:
+            self.on_activity(speech)
+        return speech
+
+    def _duration(self, chunk):
+        return len(chunk) / 2 / self.rate
+
+    def wait_for_speech(self):
+        """Block until speech starts, return the utterance generator (None once the mic closes)."""
+        voiced = 0.0
+        for chunk in self._chunks:
+            if self.closed:
+                return None
+            seconds = self._duration(chunk)
+            self.captured_seconds += seconds
+            self._pre_roll.append(chunk)
+            self._pre_roll_seconds += seconds
+            while len(self._pre_roll) > 1 and self._pre_roll_seconds - self._duration(self._pre_roll[0]) >= self.pre_roll:
+                self._pre_roll_seconds -= self._duration(self._pre_roll.pop(0))
+            voiced = voiced + seconds if self._is_speech(chunk) else 0.0
+            if voiced >= self.start_seconds:
+                self.utterances += 1
+                return self._utterance()
+        return None
+
+    def _utterance(self):
+        pre_roll, self._pre_roll, self._pre_roll_seconds = self._pre_roll, [], 0.0
+        for chunk in pre_roll:
+            self.streamed_seconds += self._duration(chunk)
+            yield chunk
+        silence = 0.0
+        for chunk in self._chunks:
+            if self.closed:
+                return
+            seconds = self._duration(chunk)
+            self.captured_seconds += seconds
+            self.streamed_seconds += seconds
+            yield chunk
+            silence = 0.0 if self._is_speech(chunk) else silence + seconds
+            if silence >= self.trailing_silence:
+                return
+
+    def close(self):
+        """Stop at the next chunk, from any thread."""
+        self.closed = True
+
+    def stats(self):
+        wall = time.monotonic() - self.started
+        return {
+            'utterances': self.utterances,
+            'wall_seconds': wall,
+            'streamed_seconds': self.streamed_seconds,
+            'streamed_fraction': self.streamed_seconds / wall if wall else 0.0,
+        }
+
+    def report(self):
+        s = self.stats()
+        return (f"STT gate: streamed {s['streamed_seconds']:.1f}s of {s['wall_seconds']:.1f}s wall clock "
+                f"({100 * s['streamed_fraction']:.1f}%), {s['utterances']} utterances")
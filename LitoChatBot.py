@@ -1,350 +1,890 @@
 import os
 import asyncio
-import re
-import tempfile
+import concurrent.futures
+import contextlib
+import logging
 import queue
 import threading
+import time
 
+import aiohttp
 import openai
 
 import edge_tts
-import pyaudio
-import simpleaudio as sa
-from pydub import AudioSegment
 
-# Google Speech-to-text dependencies
-from google.cloud import speech
-from google.oauth2 import service_account
-
-# Google Cloud Speech setup
-credentials = service_account.Credentials.from_service_account_file('google_speech_config.json')
-client_speech = speech.SpeechClient(credentials=credentials)
-
-# OpenAI Assistants ID & thread ID
+from LitoTTS import synthesize_stream, VOICE_CHINESE, VOICE_ENGLISH
+from LitoTTSPool import TTSConnectionPool, StaleConnection
+from LitoAudioOutput import AudioOutputEngine
+from LitoTTSCache import TTSCache
+from LitoCapture import CaptureProcessor, MicrophoneStream, SpeechGate
+from LitoSTT import StreamingSessionManager, AsyncResponseReader
+from LitoWhisperSTT import WhisperSessionManager
+from LitoBargeIn import BargeInController
+from LitoSpeculation import SpeculationPolicy
+from LitoSegmenter import StreamingSegmenter
+from LitoMetrics import MetricsRecorder, TurnTimeline
+from LitoStartup import Startup
+from LitoContext import ChatHistory, ThreadContext, ThreadPool
+from LitoLLM import AssistantsBackend, ChatCompletionsBackend
+from LitoCreateAssistant import INSTRUCTIONS, MODEL
+from LitoRegistry import Registry
+from LitoResponseStore import ResponseStore, context_free
+from LitoEchoCancel import EchoCanceller, PlaybackReference
+from LitoDiagnostics import LoopWatchdog, SamplingProfiler
+
+logger = logging.getLogger("LitoChatBot")
+
+# Speech recognition: Google streaming ("google") or OpenAI Whisper on pause-split segments ("whisper")
+STT_BACKEND = os.getenv('LITO_STT_BACKEND', 'google')
+
+# Google Cloud Speech endpoint; LITO_STT_ENDPOINT points at a plain-text stand-in (benchmarks) instead
+STT_ENDPOINT = os.getenv('LITO_STT_ENDPOINT')
+
+# OpenAI Assistants ID & thread ID, from the environment or else from what LitoCreateAssistant.py
+# provisioned (LITO_REGISTRY='' ignores the registry). Without a thread, one comes from the pool.
+# The registry is only read by load_state(), importing this module touches no files.
+REGISTRY_PATH = os.getenv('LITO_REGISTRY', 'lito_registry.json')
+registry = None
 assistant_id = os.getenv('OPENAI_ASSISTANT_ID')
 thread_id = os.getenv('OPENAI_THREAD_ID')
 
+# Empty threads kept ready for new conversations (0: create them when needed)
+THREAD_POOL = int(os.getenv('LITO_THREAD_POOL', '2'))
+
+# LLM backend: Assistants runs ("assistants") or streamed Chat Completions with the history kept
+# here ("chat", one request per turn). The chat backend's model and system prompt default to the
+# assistant's persona from LitoCreateAssistant.py; both backends add RUN_INSTRUCTIONS.
+LLM_BACKEND = os.getenv('LITO_LLM_BACKEND', 'assistants')
+CHAT_MODEL = os.getenv('LITO_CHAT_MODEL', MODEL)
+CHAT_INSTRUCTIONS = os.getenv('LITO_CHAT_INSTRUCTIONS', INSTRUCTIONS)
+RUN_INSTRUCTIONS = "用户名字叫小旭"
+
 # Audio parameters
 RATE = 44100
 CHUNK = int(RATE / 10)  # 100ms
 
+# Uplink to Google STT: resampled rate and LINEAR16, FLAC or OGG_OPUS
+STT_RATE = int(os.getenv('LITO_STT_RATE', '16000'))
+STT_ENCODING = os.getenv('LITO_STT_ENCODING', 'LINEAR16')
+
+# Capture ring between the device callback and STT: seconds it holds, drop-oldest (a backlog
+# beyond LITO_CAPTURE_MAX_BACKLOG seconds is dropped) or coalesce (the backlog is read in one piece)
+CAPTURE_BUFFER = float(os.getenv('LITO_CAPTURE_BUFFER', '10'))
+CAPTURE_POLICY = os.getenv('LITO_CAPTURE_POLICY', 'drop-oldest')
+CAPTURE_MAX_BACKLOG = float(os.getenv('LITO_CAPTURE_MAX_BACKLOG', '3'))
+
+# Local VAD gating: audio replayed ahead of detected speech, silence that ends an utterance
+STT_PRE_ROLL = float(os.getenv('LITO_STT_PRE_ROLL', '0.5'))
+STT_TRAILING_SILENCE = float(os.getenv('LITO_STT_TRAILING_SILENCE', '1.0'))
+
+# Echo cancellation: what the speaker plays is subtracted from the microphone before VAD and STT.
+# Echo path length modelled in seconds (0 disables), adaptation step, and the microphone peak,
+# relative to the speaker's, above which the user is taken to be talking over the bot
+AEC_TAIL = float(os.getenv('LITO_AEC_TAIL', '0.25'))
+AEC_STEP = float(os.getenv('LITO_AEC_STEP', '0.5'))
+AEC_DOUBLE_TALK = float(os.getenv('LITO_AEC_DOUBLE_TALK', '0.5'))
+
+# Barge-in: playback volume while the user may be talking over the bot, interim transcript
+# length that confirms the interruption, and how long to wait before treating it as noise
+BARGE_IN_DUCK_GAIN = float(os.getenv('LITO_BARGE_IN_DUCK_GAIN', '0.25'))
+BARGE_IN_MIN_CHARS = int(os.getenv('LITO_BARGE_IN_MIN_CHARS', '2'))
+BARGE_IN_RESUME = float(os.getenv('LITO_BARGE_IN_RESUME', '1.5'))
+
+# Speculative runs: interim stability that starts the LLM before is_final (1.1 disables it)
+SPECULATIVE_STABILITY = float(os.getenv('LITO_SPECULATIVE_STABILITY', '0.8'))
+
+# Roll over to a fresh streaming_recognize call before Google's ~305 s limit
+STT_MAX_SESSION = float(os.getenv('LITO_STT_MAX_SESSION', '240'))
+
+# Whisper uploads: OGG_OPUS or FLAC, and where long utterances may be split
+WHISPER_ENCODING = os.getenv('LITO_WHISPER_ENCODING', 'OGG_OPUS')
+WHISPER_SEGMENT = float(os.getenv('LITO_WHISPER_SEGMENT', '4'))
+
+# Context management: a run's prompt tokens that make the thread rotate to a fresh one carrying
+# a summary (0 disables), messages each run reads (0: the API's own truncation), optional hard
+# prompt cap, messages copied verbatim into the new thread and the model that summarizes
+CONTEXT_BUDGET = int(os.getenv('LITO_CONTEXT_BUDGET', '6000'))
+CONTEXT_LAST_MESSAGES = int(os.getenv('LITO_CONTEXT_LAST_MESSAGES', '20'))
+CONTEXT_MAX_PROMPT_TOKENS = int(os.getenv('LITO_CONTEXT_MAX_PROMPT_TOKENS', '0')) or None
+CONTEXT_KEEP_MESSAGES = int(os.getenv('LITO_CONTEXT_KEEP_MESSAGES', '6'))
+SUMMARY_MODEL = os.getenv('LITO_SUMMARY_MODEL', 'gpt-4o-mini')
+
 # OpenAI client setup
 openai_api_key = os.getenv('OPENAI_API_KEY')
-client_openai = openai.OpenAI(api_key=openai_api_key)
-
-# Global TTS task and interaction task references
-tts_task = None
-interaction_task = None
-playback_thread = None
-stop_playback_event = threading.Event()
-playback_lock = threading.Lock()  # Lock for managing playback concurrency
-
-class MicrophoneStream:
-    def __init__(self, rate, chunk):
-        self.rate = rate
-        self.chunk = chunk
-        self.p = pyaudio.PyAudio()
-        self.stream = None
-        self.closed = True
-
-    def __enter__(self):
-        self.stream = self.p.open(
-            format=pyaudio.paInt16,
-            channels=1,
-            rate=self.rate,
-            input=True,
-            frames_per_buffer=self.chunk,
-            stream_callback=self._fill_buffer
-        )
-        self._buff = queue.Queue()
-        self.closed = False
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.stream.stop_stream()
-        self.stream.close()
-        self.p.terminate()
-        self.closed = True
-        self._buff.put(None)
-
-    def _fill_buffer(self, in_data, frame_count, time_info, status_flags):
-        self._buff.put(in_data)
-        return None, pyaudio.paContinue
-
-    def generator(self):
-        while not self.closed:
-            chunk = self._buff.get()
-            if chunk is None:
-                return
-            yield chunk
-
-
-def contains_chinese(text):
-    return any('\u4e00' <= char <= '\u9fff' for char in text)
-
-
-def remove_emojis(text):
-    emoji_pattern = re.compile(
-        "["
-        u"\U0001F600-\U0001F64F"  # emoticons
-        u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-        u"\U0001F680-\U0001F6FF"  # transport & map symbols
-        u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-        u"\U00002702-\U000027B0"  # other symbols
-        u"\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-        u"\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-        "]+", flags=re.UNICODE)
-    return emoji_pattern.sub(r'', text)
-
-
-def play_audio(audio_data):
-    global stop_playback_event, playback_lock
-
-    with playback_lock:
-        stop_playback_event.clear()
-        play_obj = sa.play_buffer(
-            audio_data.raw_data,
-            num_channels=audio_data.channels,
-            bytes_per_sample=audio_data.sample_width,
-            sample_rate=audio_data.frame_rate
-        )
 
-        while play_obj.is_playing() and not stop_playback_event.is_set():
-            pass
-
-        play_obj.stop()
-
-
-async def text_to_speech(text):
-    """Convert text to speech and play the audio."""
-    global tts_task, playback_thread, stop_playback_event
-
-    if not isinstance(text, str):
-        text = str(text)  # Ensure text is converted to a string
-
-    # Cancel the previous TTS task if it exists
-    if tts_task:
-        tts_task.cancel()
+# Clients and devices are created on first use, or all at once by warm_up() at startup
+client_speech = None
+client_openai = None
+_pyaudio = None
+_clients_lock = threading.RLock()
+# Their own: building the OpenAI client and connecting the speech channel take long, nothing else waits for them
+_openai_lock = threading.Lock()
+_speech_lock = threading.Lock()
+startup = Startup()
+
+audio_output = None  # long-lived output stream of the local speaker, shared by every utterance
+echo_reference = PlaybackReference() if AEC_TAIL else None  # what the local speaker played
+
+# TTS chunking: a short first chunk so audio starts early, then longer ones (in characters,
+# a Chinese character counting as three)
+TTS_FIRST_CHUNK = int(os.getenv('LITO_TTS_FIRST_CHUNK', '5'))
+TTS_MIN_CHUNK = int(os.getenv('LITO_TTS_MIN_CHUNK', '12'))
+TTS_MAX_CHUNK = int(os.getenv('LITO_TTS_MAX_CHUNK', '80'))
+
+# How many upcoming sentences may be synthesized while the current one plays (0: none, each
+# sentence is only synthesized once the one before has played)
+TTS_LOOKAHEAD = int(os.getenv('LITO_TTS_LOOKAHEAD', '2'))
+
+# Per-turn latency timelines: JSON-lines log file and local HTTP endpoint (both off when unset)
+METRICS_LOG = os.getenv('LITO_METRICS_LOG')
+METRICS_PORT = int(os.getenv('LITO_METRICS_PORT', '0'))
+metrics = None  # MetricsRecorder, created by load_state(): it opens the log and starts its writer
+
+# Diagnostics, both off by default: event-loop stall (seconds) past which the watchdog logs the
+# stack that blocks the loop, and a file the sampling profiler writes collapsed stacks of all
+# threads to (flamegraph.pl, speedscope), sampling every LITO_PROFILE_INTERVAL seconds
+LOOP_STALL = float(os.getenv('LITO_LOOP_STALL', '0'))
+PROFILE_PATH = os.getenv('LITO_PROFILE')
+PROFILE_INTERVAL = float(os.getenv('LITO_PROFILE_INTERVAL', '0.01'))
+watchdog = None
+profiler = None
+
+# Cache of synthesized phrases (greetings, praise...) that survives restarts, opened by load_state()
+TTS_CACHE_PATH = os.getenv('LITO_TTS_CACHE', 'tts_cache.sqlite3')
+tts_cache = None
+
+# Fast path: replies to questions asked before (same or similar transcript), spoken without a
+# run from the audio already in the TTS cache. Entries (0 disables), lifetime in seconds and the
+# n-gram similarity that counts as the same question. Only a conversation's opening question,
+# or a later one that needs no context (no "it", "那个"...), takes it: a follow-up depends on
+# what was said before.
+FAST_PATH_ENTRIES = int(os.getenv('LITO_FAST_PATH_ENTRIES', '500'))
+FAST_PATH_TTL = float(os.getenv('LITO_FAST_PATH_TTL', '21600'))
+FAST_PATH_SIMILARITY = float(os.getenv('LITO_FAST_PATH_SIMILARITY', '0.8'))
+response_stores = {}  # persona -> ResponseStore, shared by the conversations speaking with it
+
+# Warm edge-tts websockets per voice (0 disables), LITO_TTS_URL points at another endpoint
+tts_pool = TTSConnectionPool(
+    (VOICE_CHINESE, VOICE_ENGLISH),
+    size=int(os.getenv('LITO_TTS_POOL_SIZE', '2')),
+    url=os.getenv('LITO_TTS_URL')
+)
+
+
+def get_pyaudio():
+    """PortAudio instance shared by the microphone and the output stream."""
+    global _pyaudio
+    with _clients_lock:
+        if _pyaudio is None:
+            import pyaudio  # only the local bot opens PortAudio, server workers never import it
+            _pyaudio = pyaudio.PyAudio()
+        return _pyaudio
+
+
+def get_audio_output():
+    global audio_output
+    with _clients_lock:
+        if audio_output is None:
+            audio_output = AudioOutputEngine(audio=get_pyaudio(), reference=echo_reference)
+            audio_output.start()
+        return audio_output
+
+
+def get_speech_client():
+    """Google client on a channel that is already connected (DNS, TLS and HTTP/2 done)."""
+    global client_speech
+    with _speech_lock:
+        if client_speech is not None:
+            return client_speech
+        import grpc
+        from google.cloud import speech
+        from google.cloud.speech_v1.services.speech.transports import SpeechGrpcTransport
+        if STT_ENDPOINT:
+            transport = SpeechGrpcTransport(channel=grpc.insecure_channel(STT_ENDPOINT))
+        else:
+            from google.oauth2 import service_account
+            credentials = service_account.Credentials.from_service_account_file('google_speech_config.json')
+            transport = SpeechGrpcTransport(credentials=credentials)
         try:
-            await tts_task
-        except asyncio.CancelledError:
-            print("Previous TTS task cancelled")
-
-    # Stop the current playback if it exists
-    if playback_thread and playback_thread.is_alive():
-        stop_playback_event.set()
-        playback_thread.join()
-
-    async def tts_task_fn(text_segment):
-        global playback_thread, stop_playback_event
-
-        # Choose the voice based on the text content
-        if contains_chinese(text_segment):
-            voice = "zh-CN-XiaoyiNeural"
+            grpc.channel_ready_future(transport.grpc_channel).result(timeout=10)
+        except grpc.FutureTimeoutError:
+            logger.warning("Speech channel not connected yet, the first utterance will wait for it")
+        client_speech = speech.SpeechClient(transport=transport)
+        return client_speech
+
+
+def get_openai_client():
+    global client_openai
+    with _openai_lock:
+        if client_openai is None:
+            client = openai.AsyncOpenAI(api_key=openai_api_key)
+            # Resources are imported on first use; get the ones a turn needs imported here as well
+            _ = client.beta.assistants, client.beta.threads.runs, client.beta.threads.messages, client.chat.completions
+            client_openai = client
+        return client_openai
+
+
+thread_pool = None
+local_conversation = None  # the local microphone and speaker, see get_local_conversation()
+
+
+def load_state():
+    """Read the registry, open the TTS cache and the metrics log, set up the thread pool.
+
+    Once; warm_up() starts with it, importing this module opens nothing.
+    """
+    global registry, assistant_id, thread_id, tts_cache, thread_pool, metrics
+    if metrics is None:
+        metrics = MetricsRecorder(METRICS_LOG)
+    if registry is not None:
+        return
+    registry = Registry(REGISTRY_PATH)
+    assistant_id = assistant_id or registry.assistant_id
+    thread_id = thread_id or registry.thread_id
+    tts_cache = TTSCache(TTS_CACHE_PATH)
+    thread_pool = ThreadPool(get_openai_client, size=THREAD_POOL, registry=registry)
+
+
+async def warm_openai():
+    # Building the client imports the HTTP stack and the resources (close to a second), not on the event loop
+    client = await asyncio.to_thread(get_openai_client)
+    # One cheap request opens the HTTP connection pool and checks the assistant (or model) exists
+    try:
+        if LLM_BACKEND == 'chat':
+            await client.models.retrieve(CHAT_MODEL)
         else:
-            voice = "en-GB-SoniaNeural"
-
-        communicate = edge_tts.Communicate(text_segment, voice)
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio_file:
-            output_file = temp_audio_file.name
-            try:
-                async for chunk in communicate.stream():
-                    if chunk["type"] == "audio":
-                        with open(output_file, "ab") as file:
-                            file.write(chunk["data"])
-
-                # Use pydub to load the complete audio file
-                audio = AudioSegment.from_file(output_file)
-                
-                # Reset the stop playback event
-                stop_playback_event.clear()
-
-                # Run the play_audio function in a separate thread
-                playback_thread = threading.Thread(target=play_audio, args=(audio,))
-                playback_thread.start()
-                playback_thread.join()
-
-            except edge_tts.exceptions.NoAudioReceived as e:
-                print(f"No audio received: {e}")
-            finally:
-                # Cleanup: remove the temporary file
-                os.remove(output_file)
-
-    # Create a new TTS task
-    tts_task = asyncio.create_task(tts_task_fn(text))
-    await tts_task
-
-
-class CustomEventHandler(openai.AssistantEventHandler):
-    def __init__(self, loop):
+            await client.beta.assistants.retrieve(assistant_id)
+    except openai.OpenAIError as e:
+        logger.warning("%s not reachable: %s", CHAT_MODEL if LLM_BACKEND == 'chat' else assistant_id, e)
+
+
+def warm_up(audio=True, threads=False):
+    """Start every component at once; handle_speech only waits for what it needs next.
+
+    The thread pool is filled when the local conversation has no thread yet, or with threads
+    (the server, where every session starts one); the chat backend needs none.
+    """
+    load_state()
+    if audio:
+        startup.run_thread('pyaudio', get_pyaudio)
+        startup.run_thread('audio_output', get_audio_output)
+    if STT_BACKEND == 'google':
+        startup.run_thread('speech', get_speech_client)
+    startup.run_task('openai', warm_openai())
+    startup.run_task('tts', tts_pool.start())
+    if LLM_BACKEND != 'chat' and (thread_id is None or threads):
+        startup.run_task('threads', thread_pool.fill())
+
+
+def start_diagnostics(profile_path=PROFILE_PATH):
+    """Start the loop watchdog and the profiler if they are configured; call on the event loop."""
+    global watchdog, profiler
+    if LOOP_STALL and watchdog is None:
+        watchdog = LoopWatchdog(threshold=LOOP_STALL)
+        watchdog.start()
+    if profile_path and profiler is None:
+        profiler = SamplingProfiler(profile_path, interval=PROFILE_INTERVAL)
+        profiler.start()
+
+
+def stop_diagnostics():
+    if watchdog is not None:
+        watchdog.stop()
+        logger.info("Event loop lag: %s", watchdog.stats())
+    if profiler is not None:
+        profiler.stop()
+        logger.info("Profile written to %s: %s", profiler.path, profiler.stats())
+
+
+async def report_ready():
+    logger.info("Time to ready (ms): %s", await startup.wait_all())
+
+
+class CustomEventHandler(openai.AsyncAssistantEventHandler):
+    def __init__(self, timeline=None, lookahead=TTS_LOOKAHEAD, conversation=None):
         super().__init__()
-        self.loop = loop
+        self.timeline = timeline or TurnTimeline()
+        self.conversation = conversation or get_local_conversation()
         self.response_text = ""
-        self.accumulated_text = ""
-        self.initial_text_processed = False
+        self.segmenter = StreamingSegmenter(
+            first_min_chars=TTS_FIRST_CHUNK,
+            min_chars=TTS_MIN_CHUNK,
+            max_chars=TTS_MAX_CHUNK
+        )
         self.responses = queue.Queue()
         self.tts_queue = asyncio.Queue()
-        self.tts_task = None
-        self.sentence_end_pattern = re.compile(r'[。！？.!?]')
+        self.lookahead = max(0, lookahead)
+        self.tts_consumer = None
+        self.spoken = []  # (text, voice) in the order they were queued
+        self.synthesis_tasks = set()
+        self.last_end = None  # output position where the last queued audio ends
+
+    def start_tts(self):
+        if self.tts_consumer is None:
+            self.tts_consumer = asyncio.create_task(self.process_tts_queue())
+
+    def queue_chunks(self, chunks):
+        for chunk in chunks:
+            self.timeline.mark('first_sentence_queued')
+            self.spoken.append(chunk)
+            self.tts_queue.put_nowait(chunk)
+
+    def finish_tts(self):
+        """The run is over: speak whatever is left, then let the consumer exit."""
+        self.queue_chunks(self.segmenter.flush())
+        self.tts_queue.put_nowait(None)
+
+    def cancel_tts(self):
+        """Barge-in: drop queued sentences, in-flight synthesis and buffered audio."""
+        if self.tts_consumer:
+            self.tts_consumer.cancel()
+        for task in list(self.synthesis_tasks):
+            task.cancel()
+        output = self.conversation.output
+        if output:
+            output.stop()
+
+    async def synthesize_sentence(self, text, voice, pcm_queue):
+        try:
+            async for pcm in synthesize_stream(text, voice, tts_cache, tts_pool):
+                self.timeline.mark('first_tts_byte')
+                pcm_queue.put_nowait(pcm)
+        except edge_tts.exceptions.NoAudioReceived as e:
+            logger.warning("No audio received: %s", e)
+        except StaleConnection as e:
+            logger.warning("TTS connection lost mid-sentence: %s", e)
+        except (aiohttp.ClientError, ConnectionError) as e:
+            # Without the pool (or after it fell back), edge-tts' own connection failed
+            logger.warning("TTS request failed: %r", e)
+        finally:
+            pcm_queue.put_nowait(None)
+
+    async def play_in_order(self, pending):
+        output = await self.conversation.open_output()
+        while True:
+            pcm_queue = await pending.get()
+            while True:
+                pcm = await pcm_queue.get()
+                if pcm is None:
+                    break
+                # Queued behind the previous sentence, so sentences play back to back
+                end = await output.write(pcm)
+                if end is not None:
+                    if self.last_end is None:
+                        asyncio.create_task(self.mark_playback_start(output, end - len(pcm)))
+                    self.last_end = end
+            pending.task_done()
+
+    async def mark_playback_start(self, output, start):
+        # The device has started on our first frame
+        if await output.wait_played(start + output.frame_bytes):
+            self.timeline.mark('playback_start')
 
     async def process_tts_queue(self):
-        while True:
-            text = await self.tts_queue.get()
-            if self.tts_task:
-                self.tts_task.cancel()
-                try:
-                    await self.tts_task
-                except asyncio.CancelledError:
-                    print("Previous TTS task cancelled")
-            self.tts_task = asyncio.create_task(text_to_speech(text))
-            await self.tts_task
-            self.tts_queue.task_done()
-
-    def on_text_created(self, text) -> None:
-        print(f"\nassistant(t_c) > ", end="", flush=True)
+        # Sentences are synthesized up to `lookahead` ahead of the one playing,
+        # each into its own buffer, and the player drains the buffers in order.
+        # maxsize=0 would be unbounded, no lookahead waits for each sentence instead.
+        pending = asyncio.Queue(maxsize=max(1, self.lookahead))
+        player = asyncio.create_task(self.play_in_order(pending))
+        try:
+            while True:
+                chunk = await self.tts_queue.get()
+                if chunk is None:
+                    break
+                text, voice = chunk
+                pcm_queue = asyncio.Queue()
+                await pending.put(pcm_queue)
+                task = asyncio.create_task(self.synthesize_sentence(text, voice, pcm_queue))
+                self.synthesis_tasks.add(task)
+                task.add_done_callback(self.synthesis_tasks.discard)
+                self.tts_queue.task_done()
+                if not self.lookahead:
+                    await pending.join()
+
+            # Reply complete: let the player drain every buffer, then wait for the speaker
+            await pending.join()
+            if self.last_end is not None:
+                output = await self.conversation.open_output()
+                if await output.wait_played(self.last_end):
+                    self.timeline.mark('playback_end')
+        finally:
+            player.cancel()
+            for task in list(self.synthesis_tasks):
+                task.cancel()
+
+    async def on_text_created(self, text) -> None:
+        logger.debug("assistant(t_c) > %s", text)
         if isinstance(text, str):
             self.responses.put(text)
             self.response_text += text
-            self.accumulated_text += text
-            asyncio.run_coroutine_threadsafe(self.tts_queue.put(self.accumulated_text), self.loop)
-            self.accumulated_text = ""
+            self.queue_chunks(self.segmenter.feed(text))
 
-    def on_text_delta(self, delta, snapshot):
-        print(f"DEBUG: Received delta: {delta}")
+    async def on_text_delta(self, delta, snapshot):
         text = getattr(delta, 'value', None)
-        if text:
-            print(f"DEBUG: Delta text type: {type(text)}")
-            if not self.initial_text_processed and isinstance(text, str):
-                self.response_text += text
-                self.accumulated_text += text
-                self.initial_text_processed = True
-            else:
-                if isinstance(text, str):
-                    self.response_text += text
-                    self.accumulated_text += text
-                    print(text, end="", flush=True)
-                    # when text chunks ends with specified punctuation, mark it as a "complete" sentence to audio playback
-                    if self.sentence_end_pattern.search(text):
-                        asyncio.run_coroutine_threadsafe(self.tts_queue.put(self.accumulated_text), self.loop)
-                        self.accumulated_text = ""
-
-    def on_tool_call_created(self, tool_call):
-        print(f"\nassistant(t_c_c) > {tool_call.type}\n", flush=True)
-
-    def on_tool_call_delta(self, delta, snapshot):
+        if text and isinstance(text, str):
+            self.timeline.mark('first_token')
+            self.response_text += text
+            logger.debug("assistant(t_d) > %s", text)
+            # the segmenter decides when there is enough text for the next TTS chunk
+            self.queue_chunks(self.segmenter.feed(text))
+
+    async def on_tool_call_created(self, tool_call):
+        logger.debug("assistant(t_c_c) > %s", tool_call.type)
+
+    async def on_tool_call_delta(self, delta, snapshot):
         if delta.type == 'code_interpreter':
             if delta.code_interpreter.input:
-                print(f"\nassistant(c_i_i) > ", end="", flush=True)
-                print(delta.code_interpreter.input, end="", flush=True)
+                logger.debug("assistant(c_i_i) > %s", delta.code_interpreter.input)
             if delta.code_interpreter.outputs:
-                print(f"\nassistant(c_i_o) > ", end="", flush=True)
-                print(f"\n\noutput >", flush=True)
                 for output in delta.code_interpreter.outputs:
                     if output.type == "logs":
-                        print(f"\n{output.logs}", flush=True)
-
-
-async def handle_speech():
-    global interaction_task, tts_task, stop_playback_event, playback_thread
-
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz=RATE,
-        language_code='cmn-Hans-CN'
-    )
-    streaming_config = speech.StreamingRecognitionConfig(config=config, interim_results=True)
-
-    with MicrophoneStream(RATE, CHUNK) as stream:
-        audio_generator = stream.generator()
-        requests = (speech.StreamingRecognizeRequest(audio_content=content) for content in audio_generator)
-        responses = client_speech.streaming_recognize(streaming_config, requests)
-
-        async for response in async_responses(responses):
-            for result in response.results:
-                if result.is_final:
-                    # Stop any ongoing audio playback immediately
-                    stop_playback_event.set()
-                    if playback_thread and playback_thread.is_alive():
-                        playback_thread.join()
-
-                    if interaction_task:
-                        interaction_task.cancel()
-                        try:
-                            await interaction_task
-                        except asyncio.CancelledError:
-                            print("Previous interaction task cancelled")
-                    if tts_task:
-                        tts_task.cancel()
-                        try:
-                            await tts_task
-                        except asyncio.CancelledError:
-                            print("Previous TTS task cancelled")
-
-                    input_text = result.alternatives[0].transcript
-                    print(f"Recognized: {input_text}")
-                    interaction_task = asyncio.create_task(handle_interaction(input_text))
-
-
-async def handle_interaction(input_text):
-    response_text = await ask_chatbot(input_text)
-    print(f"Bot response: {response_text}")
-
-
-async def async_responses(responses):
-    loop = asyncio.get_event_loop()
-    while True:
+                        logger.debug("assistant(c_i_o) > %s", output.logs)
+
+
+class ConversationTurn:
+    """One user utterance: its request to the LLM backend, the streamed reply and its TTS consumer.
+
+    cancel() stops all three, so nothing of an interrupted turn outlives it:
+    the local stream is closed, the backend stops the reply on the server
+    (an Assistants run is cancelled so it stops generating tokens), and the
+    TTS consumer and its synthesis tasks are torn down.
+
+    A speculative turn is started on a draft transcript. It streams the reply
+    but does not speak until commit(); discard() also deletes its message.
+
+    A turn with a stored response speaks it right away and adds the question
+    and the reply to the thread in the background instead of running.
+    """
+
+    def __init__(self, input_text, previous=None, speculative=False, timeline=None, conversation=None,
+                 stored=None):
+        self.input_text = input_text
+        self.previous = previous
+        self.stored = stored
+        self.conversation = conversation or get_local_conversation()
+        self.timeline = timeline or TurnTimeline(input_text)
+        self.handler = CustomEventHandler(self.timeline, conversation=self.conversation)
+        self.task = None
+        self.remote_cancel = None
+        self.thread_id = None  # fixed when the turn starts, the conversation may rotate threads later
+        self.message_id = None
+        self.posted = False  # the backend has the user's text
+        self.reusable = False  # an opening or context-free question: its reply may be stored
+        self.discarded = False
+        self.committed = asyncio.Event()
+        if not speculative:
+            self.committed.set()
+
+    def start(self):
+        self.task = asyncio.create_task(handle_interaction(self))
+        return self.task
+
+    async def run(self):
+        if self.stored is not None:
+            return await self.speak_stored()
+
+        # A cancelled run stays active on the thread until the server confirms it
+        if self.previous is not None:
+            if self.previous.remote_cancel:
+                await asyncio.shield(self.previous.remote_cancel)
+            self.previous = None
+
+        self.timeline.mark('llm_request')
+        await self.conversation.llm.post(self)
+        self.posted = True
+        self.timeline.mark('message_created')
+
+        if self.committed.is_set():
+            self.handler.start_tts()
         try:
-            response = await loop.run_in_executor(None, next, responses)
-            yield response
-        except StopIteration:
-            break
-
-
-def ask_chatbot_sync(input_text, loop):
-    global assistant_id, thread_id
-
-    message = client_openai.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=input_text
+            usage = await self.conversation.llm.stream(self)
+            if usage is not None:
+                self.timeline.tokens = {'prompt': usage.prompt_tokens, 'completion': usage.completion_tokens}
+            # A speculative reply is only spoken once the final transcript matched the draft
+            await self.committed.wait()
+            # Only then does it count towards the context: a discarded draft may trigger no rotation
+            if not self.discarded:
+                self.conversation.context.record(usage)
+            self.handler.finish_tts()
+            await self.handler.tts_consumer
+        finally:
+            if self.handler.tts_consumer and not self.handler.tts_consumer.done():
+                self.handler.cancel_tts()
+
+        return self.handler.response_text
+
+    async def speak_stored(self):
+        # Posted once the previous run has left the thread, while the reply is already playing
+        after = self.previous.remote_cancel if self.previous is not None else None
+        self.previous = None
+        self.conversation.context.append((('user', self.input_text), ('assistant', self.stored.reply)), after)
+
+        self.handler.response_text = self.stored.reply
+        self.handler.start_tts()
+        self.handler.queue_chunks(self.stored.chunks)
+        self.handler.tts_queue.put_nowait(None)
+        try:
+            await self.handler.tts_consumer
+        finally:
+            if not self.handler.tts_consumer.done():
+                self.handler.cancel_tts()
+        return self.handler.response_text
+
+    def commit(self, speech_end=None):
+        """The final transcript matched the draft: start speaking the reply."""
+        if speech_end is not None:
+            self.timeline.mark('speech_end', speech_end)
+        self.timeline.mark('final_transcript')
+        if self.posted:
+            self.handler.start_tts()
+        self.committed.set()
+
+    async def discard(self):
+        """The final transcript differed from the draft: cancel it and remove what the backend kept of it."""
+        self.discarded = True
+        await self.cancel()
+
+    async def cancel(self):
+        self.handler.cancel_tts()
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                logger.debug("Previous interaction task cancelled")
+        self.remote_cancel = self.conversation.llm.cancel(self)
+        if self.remote_cancel is None and self.previous is not None:
+            # Never got as far as its own run, the next turn still has to wait for the older one
+            self.remote_cancel = self.previous.remote_cancel
+
+
+def get_response_store(persona):
+    store = response_stores.get(persona)
+    if store is None:
+        store = response_stores[persona] = ResponseStore(
+            max_entries=FAST_PATH_ENTRIES,
+            ttl=FAST_PATH_TTL,
+            similarity=FAST_PATH_SIMILARITY
+        )
+    return store
+
+
+def make_llm(thread_id):
+    """The LLM backend of a new conversation, with its context."""
+    if LLM_BACKEND == 'chat':
+        history = ChatHistory(
+            get_openai_client,
+            budget=CONTEXT_BUDGET,
+            last_messages=CONTEXT_LAST_MESSAGES,
+            keep_messages=CONTEXT_KEEP_MESSAGES,
+            summary_model=SUMMARY_MODEL
+        )
+        return ChatCompletionsBackend(get_openai_client, history, CHAT_MODEL, CHAT_INSTRUCTIONS + RUN_INSTRUCTIONS)
+    context = ThreadContext(
+        get_openai_client,
+        thread_id,
+        budget=CONTEXT_BUDGET,
+        last_messages=CONTEXT_LAST_MESSAGES,
+        max_prompt_tokens=CONTEXT_MAX_PROMPT_TOKENS,
+        keep_messages=CONTEXT_KEEP_MESSAGES,
+        summary_model=SUMMARY_MODEL,
+        thread_pool=thread_pool
     )
+    return AssistantsBackend(get_openai_client, assistant_id, context, instructions=RUN_INSTRUCTIONS)
+
+
+class Conversation:
+    """Everything one conversation owns: its LLM backend and context, its turns and its output.
+
+    The local bot has one, for this machine's microphone and speaker (no
+    output of its own: the shared AudioOutputEngine). LitoServer keeps one
+    per connected device, speaking into that device's stream. Clients, the
+    TTS pool and the cache are shared by every conversation in the process.
+    """
+
+    def __init__(self, thread_id, output=None, rate=RATE):
+        self.llm = make_llm(thread_id)
+        self.context = self.llm.context
+        # Replies are only shared between conversations with the same assistant (or chat persona)
+        persona = assistant_id if LLM_BACKEND != 'chat' else (CHAT_MODEL, CHAT_INSTRUCTIONS)
+        self.response_store = get_response_store(persona)
+        # A thread that was resumed has earlier turns this process never saw, a pooled one is empty
+        self.turns = 0 if self.context.fresh else None
+        self.rate = rate  # of the captured audio
+        self._output = output
+        self.current_turn = None
+        self.speculative_turn = None  # run started on a stable interim transcript, not spoken yet
+        self.echo_canceller = None
+
+    @property
+    def thread_id(self):
+        """The thread new turns go to; it changes when the context is rotated (None for the chat backend)."""
+        return self.context.thread_id
+
+    @property
+    def opening(self):
+        """No turn so far: the next question is understood without context, the fast path may answer it."""
+        return self.turns == 0
+
+    def reusable(self, question):
+        """Whether a stored reply may answer question: the opening one, or any that needs no context."""
+        return self.opening or context_free(question)
+
+    def count_turn(self, turn):
+        """A turn is answered in this conversation; only a reusable one may be stored."""
+        turn.reusable = self.reusable(turn.input_text)
+        if self.turns is not None:
+            self.turns += 1
+
+    @property
+    def output(self):
+        """The output stream, None while the local speaker is not open yet."""
+        return self._output if self._output is not None else audio_output
+
+    @property
+    def echo_reference(self):
+        """What this conversation's output played, None without echo cancellation."""
+        return self._output.reference if self._output is not None else echo_reference
+
+    async def open_output(self):
+        if self._output is not None:
+            return self._output
+        # Opened by warm_up() on a startup thread, do not open it on the event loop
+        await startup.wait('audio_output')
+        return get_audio_output()
+
+    async def ask_chatbot(self, input_text):
+        turn = ConversationTurn(input_text, conversation=self)
+        self.count_turn(turn)
+        return await turn.run()
+
+    async def interrupt_bot(self):
+        """Stop any ongoing audio playback, lookahead synthesis and the current run."""
+        if self.output:
+            self.output.stop()
+        if self.current_turn:
+            await self.current_turn.cancel()
+
+    async def start_speculation(self, draft):
+        """Start the LLM on a stable interim transcript; nothing is spoken until it is committed."""
+        # The user is talking over the previous reply anyway, and the thread must be free
+        await self.interrupt_bot()
+        previous = self.current_turn
+        if self.speculative_turn:
+            await self.speculative_turn.discard()
+            previous = self.speculative_turn
+        self.current_turn = None
+        self.speculative_turn = ConversationTurn(draft, previous=previous, speculative=True, conversation=self)
+        self.speculative_turn.start()
+
+    async def close(self):
+        """The device went away: stop talking and drop an unconfirmed draft."""
+        await self.interrupt_bot()
+        if self.speculative_turn:
+            await self.speculative_turn.discard()
+            self.speculative_turn = None
+
+    async def handle_speech(self, chunks, capture=None):
+        """Recognize the utterances in chunks (a blocking iterator over PCM) and answer each one.
+
+        capture, if given, is where chunks come from; its stats() are logged with the others.
+        """
+        loop = asyncio.get_event_loop()
+        # Waiting for speech can take hours, keep it off the default executor the OpenAI calls use
+        capture_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='capture')
+
+        # Duck on local voice activity, stop on interim results, well before is_final
+        barge_in = BargeInController(
+            lambda: self.output,
+            self.interrupt_bot,
+            duck_gain=BARGE_IN_DUCK_GAIN,
+            min_chars=BARGE_IN_MIN_CHARS,
+            resume_after=BARGE_IN_RESUME
+        )
 
-    event_handler = CustomEventHandler(loop)
-    # start TTS queue task
-    asyncio.run_coroutine_threadsafe(event_handler.process_tts_queue(), loop)
+        def on_activity(voiced):
+            # Called from the capture thread for every chunk
+            loop.call_soon_threadsafe(barge_in.on_voice_activity, voiced, time.monotonic())
+
+        speculation = SpeculationPolicy(stability=SPECULATIVE_STABILITY)
+
+        # The bot's own voice must not open utterances, or barge in on itself
+        if self.echo_reference is not None:
+            self.echo_canceller = EchoCanceller(
+                self.echo_reference,
+                self.rate,
+                tail=AEC_TAIL,
+                step=AEC_STEP,
+                double_talk_ratio=AEC_DOUBLE_TALK,
+                trailing_silence=STT_TRAILING_SILENCE
+            )
+            chunks = self.echo_canceller.process_stream(chunks)
+
+        # Only open a recognize stream while someone is talking
+        gate = SpeechGate(chunks, self.rate, pre_roll=STT_PRE_ROLL, trailing_silence=STT_TRAILING_SILENCE,
+                          on_activity=on_activity)
+        try:
+            # The audio is already being captured while the STT client may still be warming up
+            with contextlib.closing(await make_stt_sessions(self.rate)) as sessions:
+                while True:
+                    utterance = await loop.run_in_executor(capture_executor, gate.wait_for_speech)
+                    if utterance is None:
+                        break
+
+                    # A dedicated reader thread per utterance, not an executor hop per response
+                    responses = AsyncResponseReader(sessions.responses(utterance))
+
+                    async for response in responses:
+                        for result in response.results:
+                            if not result.alternatives:
+                                continue
+                            if not result.is_final:
+                                transcript = result.alternatives[0].transcript
+                                await barge_in.on_interim(transcript)
+                                # No run to start early for a question the store answers
+                                if (not (self.reusable(transcript) and self.response_store.knows(transcript))
+                                        and speculation.should_draft(transcript, result.stability)):
+                                    await self.start_speculation(transcript)
+                                continue
+
+                            await self.interrupt_bot()
+                            barge_in.reset()
+
+                            input_text = result.alternatives[0].transcript
+                            logger.info("Recognized: %s", input_text)
+                            if self.speculative_turn and speculation.resolve(input_text):
+                                self.speculative_turn.commit(gate.last_voice_at)
+                                self.count_turn(self.speculative_turn)
+                                self.current_turn = self.speculative_turn
+                            else:
+                                previous = self.current_turn
+                                if self.speculative_turn:
+                                    await self.speculative_turn.discard()
+                                    previous = self.speculative_turn
+                                timeline = TurnTimeline(input_text)
+                                if gate.last_voice_at is not None:
+                                    timeline.mark('speech_end', gate.last_voice_at)
+                                timeline.mark('final_transcript')
+                                stored = self.response_store.lookup(input_text) if self.reusable(input_text) else None
+                                self.current_turn = ConversationTurn(input_text, previous=previous, timeline=timeline,
+                                                                     conversation=self, stored=stored)
+                                self.count_turn(self.current_turn)
+                                self.current_turn.start()
+                            self.speculative_turn = None
+
+                    # The utterance ended without a final result: the draft has nothing to match
+                    if self.speculative_turn:
+                        speculation.resolve("")
+                        await self.speculative_turn.discard()
+                        self.speculative_turn = None
+
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("%s", gate.report())
+                        logger.info("STT sessions and uplink: %s, responses: %s", sessions.stats(), responses.stats())
+                        logger.info("Barge-in: %s", barge_in.stats())
+                        logger.info("Speculation: %s", speculation.stats())
+                        if capture is not None:
+                            logger.info("Capture: %s", capture.stats())
+                        if self.echo_canceller is not None:
+                            logger.info("Echo canceller: %s", self.echo_canceller.stats())
+        finally:
+            # Not a `with`: its exit would wait, on the event loop, for the capture thread, and
+            # that one is blocked in wait_for_speech() until somebody talks
+            gate.close()
+            capture_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_local_conversation():
+    """The conversation of the local microphone and speaker, created on first use."""
+    global local_conversation
+    if local_conversation is None:
+        load_state()
+        local_conversation = Conversation(thread_id)
+    return local_conversation
+
+
+async def make_stt_sessions(rate=RATE):
+    if STT_BACKEND == 'whisper':
+        # Whisper uploads run on their own threads, next to the blocking STT response generator
+        return WhisperSessionManager(
+            openai.OpenAI(api_key=openai_api_key),
+            rate,
+            language='zh',
+            encoding=WHISPER_ENCODING,
+            target_rate=STT_RATE,
+            min_segment_seconds=WHISPER_SEGMENT
+        )
+    await startup.wait('speech')
+    # Resample (and optionally compress) the mic audio, the RecognitionConfig follows what
+    # is sent. FLAC/OGG streams start with a header, so every call gets its own processor.
+    return StreamingSessionManager(
+        get_speech_client(),
+        lambda: CaptureProcessor(rate, STT_RATE, STT_ENCODING),
+        language_code='cmn-Hans-CN',
+        rate=rate,
+        max_session_seconds=STT_MAX_SESSION
+    )
 
-    with client_openai.beta.threads.runs.stream(
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-        instructions="用户名字叫小旭",
-        event_handler=event_handler
-    ) as stream:
-        stream.until_done()
 
-    return event_handler.response_text
+async def handle_speech():
+    """The local microphone and speaker as one conversation."""
+    await startup.wait('pyaudio')
+    microphone = MicrophoneStream(RATE, CHUNK, audio=get_pyaudio(), buffer_seconds=CAPTURE_BUFFER,
+                                  policy=CAPTURE_POLICY, max_backlog_seconds=CAPTURE_MAX_BACKLOG)
+    with microphone as stream:
+        startup.mark('microphone')
+        await get_local_conversation().handle_speech(stream.generator(), capture=stream)
+
+
+async def handle_interaction(turn):
+    try:
+        response_text = await turn.run()
+    except asyncio.CancelledError:
+        metrics.record(turn.timeline, 'discarded' if turn.discarded else 'cancelled')
+        raise
+    metrics.record(turn.timeline)
+    logger.info("Bot response: %s", response_text)
+    if turn.stored is None and turn.reusable:
+        turn.conversation.response_store.put(turn.input_text, response_text, turn.handler.spoken)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Context: %s", turn.conversation.context.stats())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("TTS cache: %s", tts_cache.stats())
+        logger.debug("TTS pool: %s", tts_pool.stats())
+        logger.debug("Response store: %s", turn.conversation.response_store.stats())
 
 
 async def ask_chatbot(input_text):
-    loop = asyncio.get_event_loop()
-    response_text = await loop.run_in_executor(None, ask_chatbot_sync, input_text, loop)
-    return response_text
+    return await get_local_conversation().ask_chatbot(input_text)
 
 
 async def main():
-    global interaction_task
-    loop = asyncio.get_event_loop()
-
-    while True:
-        if interaction_task:
-            interaction_task.cancel()
+    load_state()
+    if METRICS_PORT:
+        await metrics.serve(port=METRICS_PORT)
+    start_diagnostics()
+    # Devices, channels and connections come up concurrently; speech is accepted as soon
+    # as the microphone is open, the rest only has to be ready by the time it is needed
+    warm_up()
+    asyncio.create_task(report_ready())
+
+    # The capture stream and STT sessions live inside handle_speech; it is only
+    # rebuilt when something unrecoverable happened (e.g. the audio device went away)
+    try:
+        while True:
             try:
-                await interaction_task
-            except asyncio.CancelledError:
-                print("Previous interaction task cancelled")
-
-        interaction_task = asyncio.create_task(handle_speech())
-        await interaction_task
+                await handle_speech()
+            except Exception as e:
+                logger.exception("Speech handling failed, restarting: %r", e)
+                await asyncio.sleep(1)
+    finally:
+        await thread_pool.close()
+        stop_diagnostics()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.getenv('LITO_LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
     asyncio.run(main())
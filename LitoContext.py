@@ -0,0 +1,379 @@
+import asyncio
+import logging
+import time
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep the memory of a voice assistant's conversation with a child. Merge the previous "
+    "summary (if any) and the new turns into one short summary: who the user is, what they like, "
+    "what was talked about and anything promised or left open. Write it in the conversation's "
+    "language, at most a few sentences, no preamble."
+)
+
+# First message of a rotated thread, followed by the summary
+SUMMARY_PREFIX = "（之前的对话摘要）"
+
+
+def _message_text(message):
+    return "".join(part.text.value for part in message.content if part.type == 'text')
+
+
+async def summarize(client, model, max_tokens, summary, messages):
+    """The previous summary and (role, text) messages folded into a new summary."""
+    turns = "\n".join(f"{role}: {text}" for role, text in messages)
+    prompt = f"Previous summary: {summary}\n\nNew turns:\n{turns}" if summary else turns
+    completion = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {'role': 'system', 'content': SUMMARY_INSTRUCTIONS},
+            {'role': 'user', 'content': prompt},
+        ],
+        max_tokens=max_tokens
+    )
+    return completion.choices[0].message.content.strip()
+
+
+class ThreadContext:
+    """Keeps one conversation's Assistants thread within a prompt-token budget.
+
+    Every run is sent with a truncation strategy, so the model reads at most
+    the last `last_messages` messages (and max_prompt_tokens, if set) however
+    long the thread gets. record() is handed each finished run's usage; once
+    the thread holds more messages than a run reads, or a prompt goes over
+    `budget` tokens, the thread is rotated in the background while the reply
+    is still playing: the turns since the last rotation are folded into a
+    rolling summary (the previous summary plus what happened since), and a
+    fresh thread starts with that summary and the last `keep_messages`
+    messages verbatim. Messages of a resumed thread from before this process
+    are not counted, and not summarized. ready() makes the next turn wait for a rotation that
+    has not finished yet, and for messages append() is still adding.
+    Without a thread_id, the conversation's first thread comes from
+    thread_pool. `fresh` tells whether the conversation starts from an empty
+    thread: one still to be taken, or one thread_pool just handed out.
+    """
+
+    def __init__(self, client_getter, thread_id, budget=6000, last_messages=20, max_prompt_tokens=None,
+                 keep_messages=6, summary_model='gpt-4o-mini', summary_max_tokens=300, thread_pool=None):
+        self.client_getter = client_getter
+        self.thread_id = thread_id
+        self.thread_pool = thread_pool
+        self.fresh = thread_id is None or (thread_pool is not None and thread_pool.handed_out(thread_id))
+        self._starting = None
+        self.budget = budget
+        self.last_messages = last_messages
+        self.max_prompt_tokens = max_prompt_tokens
+        self.keep_messages = keep_messages
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self.summary = ""
+        self.messages = 0  # on the current thread since it was started, rotated to or resumed
+        self._rotation = None
+        self._appending = None
+
+        self.runs = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.last_prompt_tokens = None
+        self.rotations = 0
+        self.failed_rotations = 0
+        self.rotation_seconds = 0.0
+
+    def run_options(self):
+        """Extra arguments for runs.stream()."""
+        options = {}
+        if self.last_messages:
+            options['truncation_strategy'] = {'type': 'last_messages', 'last_messages': self.last_messages}
+        if self.max_prompt_tokens:
+            options['max_prompt_tokens'] = self.max_prompt_tokens
+        return options
+
+    def record(self, usage):
+        """Account for a finished run; start a rotation once runs no longer read the whole thread."""
+        self.messages += 2  # the question and the reply
+        over_budget = False
+        if usage is not None:
+            self.runs += 1
+            self.prompt_tokens += usage.prompt_tokens
+            self.completion_tokens += usage.completion_tokens
+            self.last_prompt_tokens = usage.prompt_tokens
+            over_budget = bool(self.budget) and usage.prompt_tokens > self.budget
+        # The truncated prompt stays small: turns beyond last_messages would be dropped unsummarized
+        outgrown = bool(self.last_messages) and self.messages > self.last_messages
+        if (over_budget or outgrown) and self._rotation is None:
+            self._rotation = asyncio.create_task(self._rotate(self.thread_id))
+
+    async def _start(self):
+        # Shielded like the rest: the first thread is the conversation's, not the turn's
+        if self.thread_id is None:
+            if self._starting is None:
+                pool = self.thread_pool or ThreadPool(self.client_getter, size=0)
+                self._starting = asyncio.create_task(pool.take())
+            try:
+                self.thread_id = await asyncio.shield(self._starting)
+            except openai.OpenAIError:
+                self._starting = None  # the next turn tries again
+                raise
+        return self.thread_id
+
+    async def ready(self):
+        """The thread the next turn should post to, once a rotation or append in progress is done."""
+        await self._start()
+        # Shielded: a cancelled turn must not take them down with it
+        if self._appending is not None:
+            await asyncio.shield(self._appending)
+        if self._rotation is not None:
+            await asyncio.shield(self._rotation)
+        return self.thread_id
+
+    def append(self, messages, after=None):
+        """Add (role, text) messages to the thread in the background, once `after` is done.
+
+        Used for turns answered without a run, so the thread still knows what
+        was said. Appends keep their order; ready() waits for them.
+        """
+        self.messages += len(messages)
+        self._appending = asyncio.create_task(self._append(messages, [self._appending, after]))
+
+    async def _append(self, messages, waiting):
+        for task in waiting:
+            if task is not None:
+                await asyncio.gather(task, return_exceptions=True)
+        if self._rotation is not None:
+            await asyncio.gather(self._rotation, return_exceptions=True)
+        try:
+            thread_id = await self._start()
+            for role, text in messages:
+                await self.client_getter().beta.threads.messages.create(thread_id=thread_id, role=role, content=text)
+        except openai.OpenAIError as e:
+            logger.warning("Messages not added to thread %s: %s", self.thread_id, e)
+        finally:
+            if self._appending is asyncio.current_task():
+                self._appending = None
+
+    async def _rotate(self, thread_id):
+        started = time.monotonic()
+        client = self.client_getter()
+        try:
+            # Only what was added since the last rotation: the summary already holds the rest
+            limit = min(100, max(self.messages, self.keep_messages, 1))
+            messages = [(message.role, _message_text(message)) async for message in
+                        client.beta.threads.messages.list(thread_id=thread_id, order='desc', limit=limit)]
+            messages = [(role, text) for role, text in reversed(messages) if text]
+            if messages and messages[0][1].startswith(SUMMARY_PREFIX):
+                # The summary this thread started with (a resumed thread's, if this process has none)
+                self.summary = self.summary or messages[0][1][len(SUMMARY_PREFIX):]
+                messages = messages[1:]
+            older = messages[:-self.keep_messages] if self.keep_messages else messages
+            recent = messages[len(older):]
+            if older:
+                self.summary = await summarize(client, self.summary_model, self.summary_max_tokens,
+                                               self.summary, older)
+            initial = [{'role': 'assistant', 'content': SUMMARY_PREFIX + self.summary}] if self.summary else []
+            initial += [{'role': role, 'content': text} for role, text in recent]
+            thread = await client.beta.threads.create(messages=initial)
+            logger.info("Thread %s rotated to %s after %d messages (%d summarized)",
+                        thread_id, thread.id, self.messages, len(older))
+            self.thread_id = thread.id
+            self.messages = len(initial)
+            self.rotations += 1
+        except openai.OpenAIError as e:
+            # Stay on the long thread, the truncation strategy still bounds each run
+            self.failed_rotations += 1
+            logger.warning("Thread %s not rotated: %s", thread_id, e)
+        finally:
+            self.rotation_seconds += time.monotonic() - started
+            self._rotation = None
+
+    def stats(self):
+        return {
+            'thread_id': self.thread_id,
+            'messages': self.messages,
+            'runs': self.runs,
+            'last_prompt_tokens': self.last_prompt_tokens,
+            'mean_prompt_tokens': self.prompt_tokens / self.runs if self.runs else 0.0,
+            'completion_tokens': self.completion_tokens,
+            'rotations': self.rotations,
+            'failed_rotations': self.failed_rotations,
+            'mean_rotation_ms': 1000 * self.rotation_seconds / self.rotations if self.rotations else 0.0,
+        }
+
+
+class ChatHistory:
+    """One conversation's history for Chat Completions, kept here instead of in a thread.
+
+    The same limits as ThreadContext: each request carries at most the
+    last `last_messages` messages, and once there are more than that, or a
+    prompt goes over `budget` tokens, the older messages are folded into
+    the rolling summary in the background, keeping the last
+    `keep_messages` verbatim. The summary
+    goes first, as the assistant message a rotated thread starts with.
+    There is no thread, thread_id is always None.
+    """
+
+    thread_id = None
+
+    def __init__(self, client_getter, budget=6000, last_messages=20, keep_messages=6,
+                 summary_model='gpt-4o-mini', summary_max_tokens=300):
+        self.client_getter = client_getter
+        self.budget = budget
+        self.last_messages = last_messages
+        self.keep_messages = keep_messages
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self.summary = ""
+        self.messages = []  # (role, text), oldest first
+        self.fresh = True  # nothing said before this process, unlike a resumed thread
+        self._compaction = None
+
+        self.runs = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.last_prompt_tokens = None
+        self.compactions = 0
+        self.failed_compactions = 0
+        self.compaction_seconds = 0.0
+
+    def prompt(self, instructions, text):
+        """The messages of a request answering text."""
+        messages = [{'role': 'system', 'content': instructions}]
+        if self.summary:
+            messages.append({'role': 'assistant', 'content': SUMMARY_PREFIX + self.summary})
+        recent = self.messages[-self.last_messages:] if self.last_messages else self.messages
+        messages += [{'role': role, 'content': content} for role, content in recent]
+        messages.append({'role': 'user', 'content': text})
+        return messages
+
+    def append(self, messages, after=None):
+        """Add (role, text) messages; local, so at once (after is only there to match ThreadContext)."""
+        self.messages.extend(messages)
+        # Requests only carry the last ones: summarize before any is dropped unsummarized
+        if self.last_messages and len(self.messages) > self.last_messages:
+            self._compact_soon()
+
+    def record(self, usage):
+        """Account for a finished request; start a compaction if its prompt went over the budget."""
+        if usage is None:
+            return
+        self.runs += 1
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        self.last_prompt_tokens = usage.prompt_tokens
+        if self.budget and usage.prompt_tokens > self.budget:
+            self._compact_soon()
+
+    def _compact_soon(self):
+        if self._compaction is None:
+            self._compaction = asyncio.create_task(self._compact())
+
+    async def ready(self):
+        """Wait for a compaction in progress, like ThreadContext.ready()."""
+        if self._compaction is not None:
+            await asyncio.shield(self._compaction)
+
+    async def _compact(self):
+        started = time.monotonic()
+        # Turns keep being appended meanwhile; only the first `count` messages are replaced
+        count = len(self.messages) - self.keep_messages
+        try:
+            if count > 0:
+                self.summary = await summarize(self.client_getter(), self.summary_model, self.summary_max_tokens,
+                                               self.summary, self.messages[:count])
+                del self.messages[:count]
+                self.compactions += 1
+                logger.info("History compacted (%d messages summarized)", count)
+        except openai.OpenAIError as e:
+            # Keep the long history, last_messages still bounds each request
+            self.failed_compactions += 1
+            logger.warning("History not compacted: %s", e)
+        finally:
+            self.compaction_seconds += time.monotonic() - started
+            self._compaction = None
+
+    def stats(self):
+        return {
+            'messages': len(self.messages),
+            'runs': self.runs,
+            'last_prompt_tokens': self.last_prompt_tokens,
+            'mean_prompt_tokens': self.prompt_tokens / self.runs if self.runs else 0.0,
+            'completion_tokens': self.completion_tokens,
+            'compactions': self.compactions,
+            'failed_compactions': self.failed_compactions,
+            'mean_compaction_ms': 1000 * self.compaction_seconds / self.compactions if self.compactions else 0.0,
+        }
+
+
+class ThreadPool:
+    """Empty threads created ahead of time, so a new conversation does not wait for threads.create.
+
+    fill() first claims threads LitoCreateAssistant.py left in the registry,
+    then creates the rest; take() hands one out at once and tops the pool up
+    in the background. It only creates one on the spot when the pool ran dry.
+    close() puts the threads never handed out back into the registry, or
+    every start would claim (or create) size more and lose them on exit.
+    """
+
+    def __init__(self, client_getter, size=2, registry=None):
+        self.client_getter = client_getter
+        self.size = size
+        self.registry = registry
+        self._threads = []
+        self._filling = None
+
+        self._handed_out = set()  # taken, not yet opened by a ThreadContext
+
+        self.hits = 0
+        self.misses = 0
+
+    async def fill(self):
+        """Top the pool up, or wait for the top-up already in progress."""
+        if self._filling is None:
+            self._filling = asyncio.create_task(self._fill())
+        await asyncio.shield(self._filling)
+
+    async def _fill(self):
+        try:
+            if self.registry is not None and len(self._threads) < self.size:
+                self._threads += await asyncio.to_thread(self.registry.claim_threads, self.size - len(self._threads))
+            while len(self._threads) < self.size:
+                thread = await self.client_getter().beta.threads.create()
+                self._threads.append(thread.id)
+        except openai.OpenAIError as e:
+            logger.warning("Thread pool not filled: %s", e)
+        finally:
+            self._filling = None
+
+    async def take(self):
+        """The ID of a new, empty thread."""
+        if self._threads:
+            self.hits += 1
+            thread_id = self._threads.pop(0)
+        else:
+            self.misses += 1
+            thread_id = (await self.client_getter().beta.threads.create()).id
+        if self.size and self._filling is None:
+            self._filling = asyncio.create_task(self._fill())
+        self._handed_out.add(thread_id)
+        return thread_id
+
+    def handed_out(self, thread_id):
+        """True, once, for a thread take() returned: it is still empty."""
+        if thread_id in self._handed_out:
+            self._handed_out.discard(thread_id)
+            return True
+        return False
+
+    async def close(self):
+        """Return the unused threads to the registry, after the top-up in progress if any."""
+        if self._filling is not None:
+            # Cancelling it could lose threads it already claimed
+            await asyncio.gather(self._filling, return_exceptions=True)
+        threads, self._threads = self._threads, []
+        if self.registry is not None and threads:
+            await asyncio.to_thread(self.registry.add_threads, threads)
+            logger.info("%d unused threads returned to the registry", len(threads))
+
+    def stats(self):
+        return {'ready': len(self._threads), 'hits': self.hits, 'misses': self.misses}
@@ -1,23 +1,79 @@
+"""Provision the assistant and threads LitoChatBot uses, idempotently.
+
+    python LitoCreateAssistant.py                # reuse what the registry has, top up the thread pool
+    python LitoCreateAssistant.py --new-thread   # start the default conversation over
+    eval "$(python LitoCreateAssistant.py)"      # also export the IDs to the shell
+
+The assistant is only created when no assistant with the same name,
+instructions and model is in the registry (or it was deleted on the
+server); the default thread likewise. The registry also keeps --threads
+empty threads, so a new session or a fresh conversation starts without a
+threads.create round trip. LitoChatBot reads the registry, the
+OPENAI_ASSISTANT_ID and OPENAI_THREAD_ID variables still take precedence.
+"""
+import argparse
 import os
+
+import openai
 from openai import OpenAI
 
-from typing_extensions import override
-from openai import AssistantEventHandler
+from LitoRegistry import Registry, persona_fingerprint
+
+NAME = "小小新"
+INSTRUCTIONS = "你扮演一个孩子的小伙伴，名字叫小小新，性格温和，说话可爱，对孩子充满爱心，经常赞赏和鼓励孩子，用5岁孩子容易理解语言提供有趣和创新的回答，回答不要超过50字。"
+MODEL = "gpt-3.5-turbo-0125"
+
+REGISTRY_PATH = os.getenv('LITO_REGISTRY', 'lito_registry.json')
+
+
+def exists(retrieve, object_id):
+    if object_id is None:
+        return False
+    try:
+        retrieve(object_id)
+    except openai.NotFoundError:
+        return False
+    return True
+
+
+def provision(client, registry, threads=4, new_thread=False):
+    fingerprint = persona_fingerprint(NAME, INSTRUCTIONS, MODEL)
+    assistant_id = registry.assistant_for(fingerprint)
+    if exists(client.beta.assistants.retrieve, assistant_id):
+        print(f"# Reusing assistant {assistant_id}")
+    else:
+        assistant = client.beta.assistants.create(name=NAME, instructions=INSTRUCTIONS, model=MODEL)
+        assistant_id = assistant.id
+        print(f"# Created assistant {assistant_id}")
+    # Also when reused: the fingerprint becomes the current one again
+    registry.set_assistant(fingerprint, assistant_id, NAME, MODEL)
+
+    thread_id = registry.thread_id
+    if new_thread or not exists(client.beta.threads.retrieve, thread_id):
+        pooled = registry.claim_threads(1)
+        thread_id = pooled[0] if pooled else client.beta.threads.create().id
+        registry.set_thread(thread_id)
+        print(f"# {'Took pooled' if pooled else 'Created'} thread {thread_id}")
 
+    missing = threads - len(registry.data['threads'])
+    if missing > 0:
+        registry.add_threads([client.beta.threads.create().id for _ in range(missing)])
+        print(f"# Pooled {missing} new threads")
+    return assistant_id, thread_id
 
-openai_api_key = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=openai_api_key)
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--registry', default=REGISTRY_PATH, help="registry file (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=4, help="empty threads to keep ready (default: %(default)s)")
+    parser.add_argument('--new-thread', action='store_true', help="replace the default thread with a new one")
+    args = parser.parse_args()
 
-# Create assistant
-assistant = client.beta.assistants.create(
-    name="小小新",
-    instructions="你扮演一个孩子的小伙伴，名字叫小小新，性格温和，说话可爱，对孩子充满爱心，经常赞赏和鼓励孩子，用5岁孩子容易理解语言提供有趣和创新的回答，回答不要超过50字。",
-    model="gpt-3.5-turbo-0125",
-)
+    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    assistant_id, thread_id = provision(client, Registry(args.registry), args.threads, args.new_thread)
+    print(f"export OPENAI_ASSISTANT_ID={assistant_id}")
+    print(f"export OPENAI_THREAD_ID={thread_id}")
 
-# Create thread
-thread = client.beta.threads.create()
 
-print(assistant)
-print(thread)
+if __name__ == "__main__":
+    main()
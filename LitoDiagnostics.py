@@ -0,0 +1,187 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from LitoMetrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# Innermost frames of a thread that is waiting, not working: (file name, function)
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('LitoCapture.py', 'read'),
+}
+
+
+class LoopWatchdog:
+    """Measures how late the event loop runs and shows what blocks it.
+
+    A heartbeat task sleeps `interval` at a time; by how much it oversleeps
+    is the loop lag, kept in a LatencyHistogram. A watchdog thread looks at
+    the last heartbeat: once the loop has not come round for `threshold`
+    seconds, it logs the stack of the loop's thread, i.e. the code that is
+    blocking it, while it still blocks. The stall's full length is logged
+    when the loop is back.
+    """
+
+    def __init__(self, threshold=0.1, interval=0.02, report_interval=60):
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+        self.lag = LatencyHistogram()
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = None
+        self._loop_thread = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching the running loop."""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        last_report = time.monotonic()
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            lag = max(0.0, now - before - self.interval)
+            self.lag.add(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                logger.warning("Event loop was blocked for %.0f ms", 1000 * lag)
+            if self.report_interval and now - last_report >= self.report_interval:
+                last_report = now
+                logger.info("Event loop lag: %s", self.stats())
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            # The next heartbeat is due interval seconds after the last one
+            late = time.monotonic() - beat - self.interval
+            if beat == reported or late < self.threshold:
+                continue
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            if frame is not None and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                # Nothing runs on the loop, it is waiting for the GIL other threads hold
+                stack += "(the loop is idle: other threads keep the GIL)"
+            logger.warning("Event loop blocked for %.0f ms so far, in:\n%s", 1000 * late, stack.rstrip())
+
+    def stats(self):
+        return {
+            'lag_ms': self.lag.percentiles(),
+            'max_lag_ms': round(1000 * self.max_lag, 1),
+            'stalls': self.stalls,
+        }
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of every thread and writes them as collapsed stacks.
+
+    Every `interval` seconds a daemon thread takes sys._current_frames(),
+    so nothing is instrumented and the event loop, the capture callback,
+    the executors and the playback callback are all seen as they are. Each
+    distinct stack is counted under its thread's name, and path gets one
+    line per stack, "thread;outer;...;inner count", which flamegraph.pl and
+    speedscope read. The file is rewritten every flush_interval seconds
+    and at stop(). Threads sitting in a wait (IDLE_FRAMES) are left out
+    unless idle is set, so the profile shows where CPU time goes.
+    """
+
+    def __init__(self, path, interval=0.01, flush_interval=10, idle=False):
+        self.path = path
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.idle = idle
+        self.samples = 0
+        self.sample_seconds = 0.0
+        self._stacks = collections.Counter()
+        self._labels = {}  # code object -> frame label
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if not self.idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self._stacks[";".join(reversed(stack))] += 1
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            start = time.perf_counter()
+            self._sample()
+            self.samples += 1
+            self.sample_seconds += time.perf_counter() - start
+            if time.monotonic() - last_flush >= self.flush_interval:
+                last_flush = time.monotonic()
+                self.write()
+
+    def write(self):
+        """Write the collapsed stacks so far (atomically: a flame graph can be drawn at any time)."""
+        lines = [f"{stack} {count}\n" for stack, count in self._stacks.copy().items()]
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(temporary, self.path)
+
+    def stats(self):
+        return {
+            'samples': self.samples,
+            'stacks': len(self._stacks),
+            'overhead_ms_per_sample': 1000 * self.sample_seconds / self.samples if self.samples else 0.0,
+        }
@@ -0,0 +1,248 @@
+import collections
+import time
+
+import numpy as np
+
+from LitoCapture import Resampler, VoiceActivityDetector
+from LitoTTS import TTS_RATE
+
+
+class PlaybackReference:
+    """What an output stream handed to its device, and when: the echo canceller's reference.
+
+    The output calls played() with every buffer it hands over (from the audio
+    callback or the event loop, so it only appends); one EchoCanceller drains
+    it from the capture thread. Without a reader only the last max_buffers
+    are kept.
+    """
+
+    def __init__(self, rate=TTS_RATE, max_buffers=256):
+        self.rate = rate
+        self._buffers = collections.deque(maxlen=max_buffers)
+
+    def played(self, pcm):
+        self._buffers.append((time.monotonic(), pcm))
+
+    def drain(self):
+        buffers = []
+        while self._buffers:
+            buffers.append(self._buffers.popleft())
+        return buffers
+
+
+class EchoCanceller:
+    """Removes the bot's own voice from the microphone audio before the VAD and STT hear it.
+
+    A partitioned-block frequency-domain NLMS filter (multi-delay filter):
+    the echo path, up to `tail` seconds of it, is modelled as partitions of
+    `block` samples adapted in the FFT domain, so each block costs a few
+    FFTs and no per-sample Python. The reference is placed on the capture
+    timeline by the monotonic time it was handed to the device. Captured
+    audio can only reach us after it was recorded, so the reference always
+    leads the echo and the tail also absorbs the output and input latency.
+    The filter adapts only while the far end plays and the near end is
+    quiet (Geigel double-talk detector). Blocks that are still mostly echo
+    after the filter are attenuated by `suppression`.
+
+    An utterance the VAD finds in the raw audio during playback, but not in
+    the cleaned audio, would have opened a turn on the bot's own voice; those
+    are counted as suppressed turns.
+    """
+
+    def __init__(self, reference, rate, tail=0.25, block=1024, step=0.5, double_talk_ratio=0.5,
+                 suppression=0.1, far_threshold=200, max_lag=1.0, start_seconds=0.2, trailing_silence=1.0):
+        self.reference = reference
+        self.rate = rate
+        self.block = block
+        self.partitions = max(1, int(np.ceil(tail * rate / block)))
+        self.step = step
+        self.double_talk_ratio = double_talk_ratio
+        self.suppression = suppression
+        self.far_threshold = far_threshold
+        self.max_lag = int(max_lag * rate)
+        self.start_seconds = start_seconds
+        self.trailing_silence = trailing_silence
+        self.resampler = Resampler(reference.rate, rate)
+        self._origin = time.monotonic()
+
+        # Reference on the capture timeline, absolute sample positions, zeros where nothing played
+        self._ref = np.zeros(int((max_lag + tail + 1) * rate))
+        self._ref_end = None
+        self._capture_end = None
+        self._pending_d = np.zeros(0)
+        self._pending_x = np.zeros(0)
+
+        bins = block + 1
+        self._weights = np.zeros((self.partitions, bins), dtype=complex)
+        self._spectra = np.zeros((self.partitions, bins), dtype=complex)  # newest block first
+        self._power = np.zeros(bins)
+        self._last_x = np.zeros(block)
+        self._peaks = collections.deque([0.0] * self.partitions, maxlen=self.partitions)
+        self._blocks = 0
+
+        self._raw_vad = VoiceActivityDetector(rate)
+        self._clean_vad = VoiceActivityDetector(rate)
+        self._raw_voiced = 0.0
+        self._raw_silence = 0.0
+        self._counted = False
+
+        self.chunks = 0
+        self.cpu_seconds = 0.0
+        self.far_blocks = 0
+        self.double_talk_blocks = 0
+        self.resyncs = 0
+        self.suppressed_turns = 0
+        self._mic_energy = 0.0
+        self._residual_energy = 0.0
+
+    def _position(self, at):
+        return int(round((at - self._origin) * self.rate))
+
+    def _put_reference(self, position, samples):
+        capacity = len(self._ref)
+        if len(samples) > capacity:
+            position += len(samples) - capacity
+            samples = samples[-capacity:]
+        start = position % capacity
+        first = min(len(samples), capacity - start)
+        self._ref[start:start + first] = samples[:first]
+        self._ref[:len(samples) - first] = samples[first:]
+
+    def _take_reference(self):
+        for played_at, pcm in self.reference.drain():
+            samples = np.frombuffer(self.resampler.process(pcm), dtype=np.int16).astype(np.float64)
+            position = self._position(played_at)
+            if self._ref_end is None or position > self._ref_end + self.block:
+                # The output was idle in between: that stretch of the timeline is silence
+                if self._ref_end is not None:
+                    gap = min(position - self._ref_end, len(self._ref))
+                    self._put_reference(position - gap, np.zeros(gap))
+                self._ref_end = position
+            self._put_reference(self._ref_end, samples)
+            self._ref_end += len(samples)
+
+    def _reference_window(self, start, count):
+        window = np.zeros(count)
+        if self._ref_end is None:
+            return window
+        first = max(start, self._ref_end - len(self._ref))
+        last = min(start + count, self._ref_end)
+        if first < last:
+            window[first - start:last - start] = self._ref[np.arange(first, last) % len(self._ref)]
+        return window
+
+    def _process_block(self, d, x):
+        n = self.block
+        spectrum = np.fft.rfft(np.concatenate((self._last_x, x)))
+        self._last_x = x
+        self._spectra = np.roll(self._spectra, 1, axis=0)
+        self._spectra[0] = spectrum
+        self._power = 0.9 * self._power + 0.1 * np.abs(spectrum) ** 2
+        self._peaks.append(float(np.max(np.abs(x))))
+
+        echo = np.fft.irfft(np.sum(self._weights * self._spectra, axis=0))[n:]
+        e = d - echo
+
+        far_peak = max(self._peaks)
+        if far_peak < self.far_threshold:
+            return e
+        self.far_blocks += 1
+        if np.max(np.abs(d)) > self.double_talk_ratio * far_peak:
+            # Someone talks over the bot: keep the filter, pass the audio through
+            self.double_talk_blocks += 1
+            return e
+
+        error = np.fft.rfft(np.concatenate((np.zeros(n), e)))
+        gradient = error / (self.partitions * self._power + 2 * n * self.far_threshold)
+        self._weights += self.step * np.conj(self._spectra) * gradient
+        # Keep one partition per block a linear (not circular) convolution, round robin
+        k = self._blocks % self.partitions
+        taps = np.fft.irfft(self._weights[k])
+        taps[n:] = 0
+        self._weights[k] = np.fft.rfft(taps)
+        self._blocks += 1
+
+        mic_energy = float(np.dot(d, d))
+        residual_energy = float(np.dot(e, e))
+        self._mic_energy += mic_energy
+        self._residual_energy += residual_energy
+        if residual_energy < float(np.dot(echo, echo)):
+            e = e * self.suppression
+        return e
+
+    def process(self, chunk):
+        """Cleaned audio for one captured chunk; up to a block of it may be held back for the next one."""
+        start_time = time.thread_time()
+        now = time.monotonic()
+        self._take_reference()
+        d = np.frombuffer(chunk, dtype=np.int16).astype(np.float64)
+        count = len(d)
+
+        # The chunk's last sample was captured at the latest now. Counting samples from there keeps
+        # the clock steady; it is only re-anchored when it runs clearly ahead of now (impossible) or
+        # far behind (audio was dropped). Running a little late just shifts the echo into later taps.
+        arrival = self._position(now)
+        lag = arrival - (self._capture_end + count) if self._capture_end is not None else None
+        if lag is None or not -self.block <= lag <= self.max_lag:
+            if self._capture_end is not None:
+                self.resyncs += 1
+            self._capture_end = arrival - count
+        x = self._reference_window(self._capture_end, count)
+        self._capture_end += count
+
+        self._pending_d = np.concatenate((self._pending_d, d))
+        self._pending_x = np.concatenate((self._pending_x, x))
+        blocks = len(self._pending_d) // self.block
+        out = np.empty(blocks * self.block)
+        for i in range(blocks):
+            part = slice(i * self.block, (i + 1) * self.block)
+            out[part] = self._process_block(self._pending_d[part], self._pending_x[part])
+        self._pending_d = self._pending_d[blocks * self.block:]
+        self._pending_x = self._pending_x[blocks * self.block:]
+        cleaned = np.clip(np.rint(out), -32768, 32767).astype(np.int16).tobytes()
+
+        self._count_suppressed(chunk, cleaned)
+        self.chunks += 1
+        self.cpu_seconds += time.thread_time() - start_time
+        return cleaned
+
+    def _count_suppressed(self, chunk, cleaned):
+        # SpeechGate's rule on the raw audio: start_seconds of voice opens an utterance,
+        # trailing_silence ends it. One that opens during playback but not on the cleaned
+        # audio would have been a turn on the bot's own voice.
+        seconds = len(chunk) / 2 / self.rate
+        clean = bool(cleaned) and self._clean_vad.is_speech(cleaned)
+        if self._raw_vad.is_speech(chunk):
+            self._raw_silence = 0.0
+            if clean or max(self._peaks) < self.far_threshold:
+                self._raw_voiced = 0.0
+                return
+            self._raw_voiced += seconds
+            if self._raw_voiced >= self.start_seconds and not self._counted:
+                self.suppressed_turns += 1
+                self._counted = True
+        else:
+            self._raw_voiced = 0.0
+            self._raw_silence += seconds
+            if self._raw_silence >= self.trailing_silence:
+                self._counted = False
+
+    def process_stream(self, chunks):
+        """Wrap a microphone generator, yielding the cleaned audio."""
+        for chunk in chunks:
+            cleaned = self.process(chunk)
+            if cleaned:
+                yield cleaned
+
+    def stats(self):
+        erle = (10 * np.log10(self._mic_energy / self._residual_energy)
+                if self._mic_energy and self._residual_energy else 0.0)
+        return {
+            'tail_ms': round(1000 * self.partitions * self.block / self.rate, 1),
+            'far_blocks': self.far_blocks,
+            'double_talk_blocks': self.double_talk_blocks,
+            'erle_db': round(float(erle), 1),
+            'resyncs': self.resyncs,
+            'suppressed_turns': self.suppressed_turns,
+            'cpu_ms_per_chunk': 1000 * self.cpu_seconds / self.chunks if self.chunks else 0.0,
+        }
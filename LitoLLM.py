@@ -0,0 +1,156 @@
+"""LLM backends behind ConversationTurn: Assistants runs or streamed Chat Completions.
+
+A backend answers the turns of one conversation and owns its context. Both
+have the same interface:
+
+    context       ThreadContext or ChatHistory: ready(), append(), record(), stats(), thread_id, fresh
+    post(turn)    hand turn.input_text over before the reply is requested
+    stream(turn)  stream the reply into turn.handler (a CustomEventHandler); returns the usage or None
+    cancel(turn)  after the turn's task was cancelled: a task that finishes the cancellation
+                  on the server, or None when nothing is left to do there
+"""
+import asyncio
+import logging
+
+import openai
+from openai.types.beta.threads import Text, TextDelta
+
+logger = logging.getLogger(__name__)
+
+
+class AssistantsBackend:
+    """Assistants runs: the thread keeps the history, a turn is a message and then a streamed run.
+
+    Two round trips per turn, and the run is queued on the server before it
+    produces its first token. A cancelled run is cancelled on the server as
+    well. A discarded draft is removed from the thread: its message and
+    whatever its run answered, finished or cut off, or every later run would
+    read a reply to a question that was never asked.
+    """
+
+    def __init__(self, client_getter, assistant_id, context, instructions=None):
+        self.client_getter = client_getter
+        self.assistant_id = assistant_id
+        self.context = context
+        self.instructions = instructions
+
+    async def post(self, turn):
+        turn.thread_id = await self.context.ready()
+        message = await self.client_getter().beta.threads.messages.create(
+            thread_id=turn.thread_id,
+            role="user",
+            content=turn.input_text
+        )
+        turn.message_id = message.id
+
+    async def stream(self, turn):
+        async with self.client_getter().beta.threads.runs.stream(
+            thread_id=turn.thread_id,
+            assistant_id=self.assistant_id,
+            instructions=self.instructions,
+            event_handler=turn.handler,
+            **self.context.run_options()
+        ) as stream:
+            await stream.until_done()
+        run = turn.handler.current_run
+        return run.usage if run is not None else None
+
+    def cancel(self, turn):
+        run = turn.handler.current_run
+        active = run is not None and run.status in ("queued", "in_progress", "requires_action")
+        if active or (turn.discarded and turn.message_id is not None):
+            # The next turn waits for this task, so it never posts before the thread is clean
+            return asyncio.create_task(self._cancel_run(turn, run.id if run is not None else None, active))
+        return None
+
+    async def _cancel_run(self, turn, run_id, active):
+        client = self.client_getter()
+        if active:
+            try:
+                run = await client.beta.threads.runs.cancel(run_id, thread_id=turn.thread_id)
+                # Messages can only be added again once the run has left "cancelling"
+                for _ in range(50):
+                    if run.status not in ("queued", "in_progress", "cancelling", "requires_action"):
+                        break
+                    await asyncio.sleep(0.1)
+                    run = await client.beta.threads.runs.retrieve(run_id, thread_id=turn.thread_id)
+            except openai.OpenAIError as e:
+                # Typically the run already finished on its own
+                logger.info("Run %s not cancelled: %s", run_id, e)
+        if not turn.discarded or turn.message_id is None:
+            return
+        message_ids = []
+        try:
+            if run_id is not None:
+                message_ids = [message.id async for message in
+                               client.beta.threads.messages.list(thread_id=turn.thread_id, run_id=run_id)]
+        except openai.OpenAIError as e:
+            logger.warning("Replies of run %s not listed: %s", run_id, e)
+        for message_id in message_ids + [turn.message_id]:
+            try:
+                await client.beta.threads.messages.delete(message_id, thread_id=turn.thread_id)
+            except openai.OpenAIError as e:
+                logger.warning("Draft message %s not deleted: %s", message_id, e)
+
+
+class ChatCompletionsBackend:
+    """Chat Completions: the history is kept here, so a turn is one streamed request.
+
+    No message to create first and no run to be scheduled. The reply comes
+    out as the text events of an Assistants run (on_text_created, then
+    on_text_delta with a TextDelta and the text so far, on_text_done), so
+    CustomEventHandler speaks it unchanged. The exchange joins the history
+    once the turn is committed: a discarded draft leaves nothing behind, an
+    interrupted reply is kept as far as it got. Closing the stream stops
+    the generation, there is nothing to cancel on the server.
+    """
+
+    def __init__(self, client_getter, context, model, instructions, max_tokens=None):
+        self.client_getter = client_getter
+        self.context = context
+        self.model = model
+        self.instructions = instructions
+        self.max_tokens = max_tokens
+
+    async def post(self, turn):
+        # Nothing is sent ahead, only a compaction in progress is waited for
+        await self.context.ready()
+
+    async def stream(self, turn):
+        handler = turn.handler
+        options = {'max_tokens': self.max_tokens} if self.max_tokens else {}
+        snapshot = None
+        usage = None
+        try:
+            stream = await self.client_getter().chat.completions.create(
+                model=self.model,
+                messages=self.context.prompt(self.instructions, turn.input_text),
+                stream=True,
+                stream_options={'include_usage': True},
+                **options
+            )
+            async with stream:
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    for choice in chunk.choices:
+                        text = choice.delta.content
+                        if not text:
+                            continue
+                        if snapshot is None:
+                            snapshot = Text(value="", annotations=[])
+                            await handler.on_text_created(snapshot)
+                        snapshot = Text(value=snapshot.value + text, annotations=[])
+                        await handler.on_text_delta(TextDelta(value=text), snapshot)
+            if snapshot is not None:
+                await handler.on_text_done(snapshot)
+            # A speculative reply only becomes history once the final transcript matched the draft
+            await turn.committed.wait()
+        finally:
+            if turn.committed.is_set() and not turn.discarded:
+                reply = snapshot.value if snapshot is not None else ""
+                self.context.append((('user', turn.input_text),) + ((('assistant', reply),) if reply else ()))
+        return usage
+
+    def cancel(self, turn):
+        return None
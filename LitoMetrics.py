@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Points in a turn, in the order they normally happen
+MARKS = (
+    'speech_end',
+    'final_transcript',
+    'llm_request',
+    'message_created',
+    'first_token',
+    'first_sentence_queued',
+    'first_tts_byte',
+    'playback_start',
+    'playback_end',
+)
+
+# Intervals rolled up into histograms: name -> (from mark, to mark)
+INTERVALS = {
+    'endpointing': ('speech_end', 'final_transcript'),
+    'message_create': ('final_transcript', 'message_created'),
+    'llm_first_token': ('message_created', 'first_token'),
+    # Whole request, message included: compares the LLM backends
+    'time_to_first_token': ('llm_request', 'first_token'),
+    'first_sentence': ('first_token', 'first_sentence_queued'),
+    'tts_first_byte': ('first_sentence_queued', 'first_tts_byte'),
+    'audio_out': ('first_tts_byte', 'playback_start'),
+    'final_to_first_audio': ('final_transcript', 'playback_start'),
+    'speech_end_to_first_audio': ('speech_end', 'playback_start'),
+    'speaking': ('playback_start', 'playback_end'),
+}
+
+_turn_ids = itertools.count(1)
+
+
+class TurnTimeline:
+    """Monotonic timestamps of one turn; the first mark() of each point wins."""
+
+    def __init__(self, text=""):
+        self.turn_id = next(_turn_ids)
+        self.text = text
+        self.started = time.time()
+        self.marks = {}
+        self.tokens = {}  # prompt/completion tokens of the run, when it reports them
+
+    def mark(self, name, at=None):
+        if name not in self.marks:
+            self.marks[name] = time.monotonic() if at is None else at
+
+    def interval(self, start, end):
+        """Seconds from start to end, as far as they were waited for after the final transcript.
+
+        A committed speculative turn got some points before its final
+        transcript: an interval is counted from the final transcript at the
+        earliest, and one that was over by then is left out (None).
+        """
+        if start not in self.marks or end not in self.marks:
+            return None
+        begin = self.marks[start]
+        final = self.marks.get('final_transcript')
+        if final is not None and MARKS.index(start) >= MARKS.index('final_transcript'):
+            begin = max(begin, final)
+            if self.marks[end] < begin:
+                return None
+        return self.marks[end] - begin
+
+    def to_dict(self, status='completed'):
+        origin = self.marks.get('speech_end', self.marks.get('final_transcript'))
+        return {
+            'turn': self.turn_id,
+            'time': self.started,
+            'status': status,
+            'text': self.text,
+            # ms relative to the end of speech (or the final transcript without VAD)
+            'marks_ms': {name: round(1000 * (self.marks[name] - origin), 1)
+                         for name in MARKS if name in self.marks and origin is not None},
+            'intervals_ms': {name: round(1000 * value, 1)
+                             for name, (start, end) in INTERVALS.items()
+                             if (value := self.interval(start, end)) is not None},
+            'tokens': self.tokens,
+        }
+
+
+class LatencyHistogram:
+    """Percentiles over the most recent samples."""
+
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentiles(self, points=(50, 90, 99)):
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+        result = {f'p{p}': round(1000 * ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 1)
+                  for p in points}
+        result['count'] = self.count
+        return result
+
+
+class MetricsRecorder:
+    """Collects turn timelines into histograms, a JSON-lines log and an HTTP endpoint.
+
+    The log file is written from a background thread so recording a turn
+    never touches the disk on the event loop.
+    """
+
+    def __init__(self, jsonl_path=None):
+        self.histograms = {name: LatencyHistogram() for name in INTERVALS}
+        self.turns = collections.Counter()
+        self.tokens = collections.Counter()
+        self.prompt_tokens = collections.deque(maxlen=1000)
+        self._queue = None
+        if jsonl_path:
+            self._queue = queue.SimpleQueue()
+            threading.Thread(target=self._write, args=(jsonl_path,), name='metrics-writer', daemon=True).start()
+
+    def _write(self, path):
+        with open(path, 'a', encoding='utf-8', buffering=1) as f:
+            while True:
+                line = self._queue.get()
+                f.write(line + '\n')
+
+    def record(self, timeline, status='completed'):
+        self.turns[status] += 1
+        if status == 'completed':
+            for name, (start, end) in INTERVALS.items():
+                value = timeline.interval(start, end)
+                if value is not None:
+                    self.histograms[name].add(value)
+            if 'prompt' in timeline.tokens:
+                self.tokens.update(timeline.tokens)
+                self.prompt_tokens.append(timeline.tokens['prompt'])
+        entry = timeline.to_dict(status)
+        if self._queue is not None:
+            self._queue.put(json.dumps(entry, ensure_ascii=False))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Turn %d %s: %s, tokens %s", entry['turn'], status, entry['intervals_ms'], entry['tokens'])
+
+    def snapshot(self):
+        return {
+            'turns': dict(self.turns),
+            'latency_ms': {name: h.percentiles() for name, h in self.histograms.items() if h.count},
+            'tokens': {
+                **self.tokens,
+                # over the most recent turns, to see how the context size develops
+                'mean_prompt': sum(self.prompt_tokens) / len(self.prompt_tokens) if self.prompt_tokens else 0.0,
+                'max_prompt': max(self.prompt_tokens, default=0),
+            },
+        }
+
+    async def serve(self, host='127.0.0.1', port=9108):
+        """Serve snapshot() as JSON on GET /metrics."""
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                if request.split(b' ')[1:2] == [b'/metrics']:
+                    body = json.dumps(self.snapshot(), ensure_ascii=False).encode('utf-8')
+                    status = b'200 OK'
+                else:
+                    body = b'{"error": "not found"}'
+                    status = b'404 Not Found'
+                writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info("Metrics on http://%s:%d/metrics", host, port)
+        return server
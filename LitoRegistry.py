@@ -0,0 +1,96 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: claims are not locked against other processes
+    fcntl = None
+
+
+def persona_fingerprint(name, instructions, model):
+    """Identifies an assistant configuration; a changed persona or model gets a new assistant."""
+    text = json.dumps([name, instructions, model], ensure_ascii=False)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class Registry:
+    """Local record of the assistants and threads LitoCreateAssistant.py provisioned.
+
+    A JSON file with the assistant of each persona fingerprint, the current
+    one, the default thread and a list of empty threads created ahead of
+    time. Changes are written atomically under a lock file, so server
+    workers claiming pooled threads never get the same one. An empty path
+    disables it: nothing is read or written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = self._load()
+
+    def _empty(self):
+        return {'assistants': {}, 'current': None, 'thread': None, 'threads': []}
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return self._empty()
+        with open(self.path, encoding='utf-8') as f:
+            return {**self._empty(), **json.load(f)}
+
+    def _save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(temporary, self.path)
+
+    @contextlib.contextmanager
+    def update(self):
+        """Re-read, change and write back the registry, holding the lock file meanwhile."""
+        if not self.path:
+            yield self.data
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self.data = self._load()
+            yield self.data
+            self._save()
+
+    @property
+    def assistant_id(self):
+        current = self.data['assistants'].get(self.data['current'])
+        return current['id'] if current else None
+
+    @property
+    def thread_id(self):
+        return self.data['thread']
+
+    def assistant_for(self, fingerprint):
+        entry = self.data['assistants'].get(fingerprint)
+        return entry['id'] if entry else None
+
+    def set_assistant(self, fingerprint, assistant_id, name, model):
+        with self.update() as data:
+            entry = data['assistants'].get(fingerprint)
+            if entry is None or entry['id'] != assistant_id:
+                data['assistants'][fingerprint] = {'id': assistant_id, 'name': name, 'model': model,
+                                                   'created': int(time.time())}
+            data['current'] = fingerprint
+
+    def set_thread(self, thread_id):
+        with self.update() as data:
+            data['thread'] = thread_id
+
+    def add_threads(self, thread_ids):
+        with self.update() as data:
+            data['threads'].extend(thread_ids)
+
+    def claim_threads(self, count):
+        """Take up to count pooled threads out of the registry, for this process alone."""
+        if not self.path:
+            return []
+        with self.update() as data:
+            claimed, data['threads'] = data['threads'][:count], data['threads'][count:]
+        return claimed
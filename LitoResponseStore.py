@@ -0,0 +1,170 @@
+import collections
+import re
+import time
+
+from LitoTTSCache import normalize_text
+
+
+def normalize_utterance(text):
+    """Transcript as a lookup key: NFKC, lower case, letters and digits only (CJK included)."""
+    return "".join(char for char in normalize_text(text).lower() if char.isalnum())
+
+
+# What points back at earlier turns ("it", "那个", "你呢"): a question containing one is a follow-up
+FOLLOW_UP_MARKERS = ("它", "他", "她", "这个", "那个", "这些", "那些", "刚才", "刚刚", "上面", "前面",
+                     "然后", "还有", "继续", "接着", "你呢", "那你")
+FOLLOW_UP_WORDS = {"it", "its", "that", "this", "these", "those", "they", "them", "their", "he", "she", "him",
+                   "her", "his", "then", "again", "more", "else", "also", "too", "another"}
+
+
+def context_free(question):
+    """True if question is understood without the turns before it, so a stored reply may answer it."""
+    text = normalize_text(question).lower()
+    if any(marker in text for marker in FOLLOW_UP_MARKERS):
+        return False
+    return FOLLOW_UP_WORDS.isdisjoint(re.findall(r"[a-z]+", text))
+
+
+def ngrams(key, n=2):
+    if len(key) <= n:
+        return {key}
+    return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+
+class StoredResponse:
+    __slots__ = ('key', 'question', 'reply', 'chunks', 'grams', 'created', 'hits')
+
+    def __init__(self, key, question, reply, chunks, grams):
+        self.key = key
+        self.question = question
+        self.reply = reply
+        self.chunks = chunks  # (text, voice) as they were spoken, so their audio is in the TTS cache
+        self.grams = grams
+        self.created = time.monotonic()
+        self.hits = 0
+
+
+class ResponseStore:
+    """Replies to questions that were asked before, answered without a run.
+
+    Keyed on the normalized transcript, with an inverted index of character
+    n-grams for near matches ("你叫什么名字" / "你叫什么名字呀"): a candidate
+    matches when the Dice coefficient of the two n-gram sets reaches
+    `similarity`. Entries are learned from completed turns, expire after
+    `ttl` seconds and the least recently used go first beyond `max_entries`.
+    Questions shorter than min_chars ("好", "yes") depend on the context and
+    are never stored.
+    """
+
+    def __init__(self, max_entries=500, ttl=6 * 3600, similarity=0.8, n=2, min_chars=4, max_question_chars=40,
+                 max_reply_chars=400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.n = n
+        self.min_chars = min_chars
+        self.max_question_chars = max_question_chars
+        self.max_reply_chars = max_reply_chars
+
+        self._entries = collections.OrderedDict()  # key -> StoredResponse, least recently used first
+        self._index = collections.defaultdict(set)  # n-gram -> keys
+
+        self.lookups = 0
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _storable(self, key, reply):
+        return (self.max_entries and self.min_chars <= len(key) <= self.max_question_chars
+                and 0 < len(reply) <= self.max_reply_chars)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for gram in entry.grams:
+            keys = self._index[gram]
+            keys.discard(key)
+            if not keys:
+                del self._index[gram]
+
+    def _live(self, entry, now):
+        if now - entry.created < self.ttl:
+            return True
+        self._remove(entry.key)
+        self.expired += 1
+        return False
+
+    def _find(self, key):
+        """(entry, exact) for the normalized question key, or (None, False)."""
+        if not self.max_entries or len(key) < self.min_chars:
+            return None, False
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and self._live(entry, now):
+            return entry, True
+        return self._closest(key, now), False
+
+    def knows(self, question):
+        """True if lookup() would answer question; not counted in the stats."""
+        return self._find(normalize_utterance(question))[0] is not None
+
+    def lookup(self, question):
+        """The stored reply for question, or None."""
+        key = normalize_utterance(question)
+        if not self.max_entries or len(key) < self.min_chars:
+            return None
+        self.lookups += 1
+        entry, exact = self._find(key)
+        if entry is None:
+            return None
+        if exact:
+            self.exact_hits += 1
+        else:
+            self.fuzzy_hits += 1
+        entry.hits += 1
+        self._entries.move_to_end(entry.key)
+        return entry
+
+    def _closest(self, key, now):
+        grams = ngrams(key, self.n)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self._index.get(gram, ()))
+        best, best_score = None, self.similarity
+        for candidate, count in shared.most_common():
+            entry = self._entries[candidate]
+            score = 2 * count / (len(grams) + len(entry.grams))
+            if score >= best_score and self._live(entry, now):
+                best, best_score = entry, score
+        return best
+
+    def put(self, question, reply, chunks):
+        """Remember the reply a completed turn gave to question."""
+        key = normalize_utterance(question)
+        if not self._storable(key, reply):
+            return
+        if key in self._entries:
+            self._remove(key)
+        entry = StoredResponse(key, question, reply, tuple(chunks), ngrams(key, self.n))
+        self._entries[key] = entry
+        for gram in entry.grams:
+            self._index[gram].add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self):
+        hits = self.exact_hits + self.fuzzy_hits
+        return {
+            'entries': len(self._entries),
+            'lookups': self.lookups,
+            'hits': hits,
+            'exact_hits': self.exact_hits,
+            'fuzzy_hits': self.fuzzy_hits,
+            'hit_rate': hits / self.lookups if self.lookups else 0.0,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
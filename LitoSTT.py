@@ -0,0 +1,323 @@
+import asyncio
+import collections
+import logging
+import queue
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+# Google ends a streaming recognize call after ~305 s of audio, roll over well before that
+MAX_SESSION_SECONDS = 240
+
+# Errors after which the same audio can simply be sent again on a new call
+RECOVERABLE_ERRORS = (
+    google_exceptions.OutOfRange,  # "Exceeded maximum allowed stream duration"
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+)
+
+
+class _Session:
+    """One streaming_recognize call and the queue feeding its request generator."""
+
+    def __init__(self, number, start_offset, processor, streaming_config, replaces=None):
+        self.number = number
+        self.start_offset = start_offset  # seconds into the utterance of its first chunk
+        self.processor = processor
+        self.streaming_config = streaming_config
+        self.replaces = replaces  # the session this one rolls over from, None for the first
+        self.chunks = queue.Queue()
+        self.opened = time.monotonic()
+        self.ready = threading.Event()
+        self.error = None
+        self.responses = None
+        self.received = 0
+
+    def _chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def requests(self):
+        from google.cloud import speech  # loaded with the client, see LitoCapture.ENCODINGS
+        for content in self.processor.process_stream(self._chunks()):
+            yield speech.StreamingRecognizeRequest(audio_content=content)
+
+    def start(self, client, on_ready):
+        """Open the call on its own thread; on_ready(session) follows once it is up or has failed."""
+        threading.Thread(target=self._open, args=(client, on_ready), name=f'stt-open-{self.number}',
+                         daemon=True).start()
+
+    def _open(self, client, on_ready):
+        # The client waits for the first response before returning, so this must not run
+        # under the manager's lock or on the thread that feeds the audio
+        try:
+            self.responses = client.streaming_recognize(self.streaming_config, self.requests())
+        except Exception as e:
+            self.error = e
+        self.ready.set()
+        on_ready(self)
+
+    def wait(self):
+        """The response iterator once the call is open, or its error."""
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self.responses
+
+    def close_requests(self):
+        self.chunks.put(None)
+
+    def cancel(self):
+        if self.responses is not None and hasattr(self.responses, 'cancel'):
+            self.responses.cancel()
+
+
+class StreamingSessionManager:
+    """Recognizes one continuous chunk stream across as many Google sessions as it needs.
+
+    A pump thread owns the capture side and keeps every chunk that has not
+    been covered by a final result yet. Before the current call reaches
+    max_session_seconds, or when it fails with a recoverable error, the next
+    call is opened on the same client (and so the same gRPC channel) and
+    primed with that unfinalized audio, then live chunks follow. Responses
+    from the superseded call are dropped, the new one re-recognizes the same
+    audio, so nothing said across the switch is lost.
+
+    Each call is opened on its own thread as soon as it is created. At the
+    duration limit the old call keeps receiving live audio until its
+    successor is up, and only then are its requests closed, so there is
+    always an open call. stats() includes the uplink of the last
+    utterance, summed over the CaptureProcessor of each of its calls.
+    """
+
+    def __init__(self, client, capture_factory, language_code, rate,
+                 max_session_seconds=MAX_SESSION_SECONDS, max_failures=3):
+        self.client = client
+        self.capture_factory = capture_factory
+        self.language_code = language_code
+        self.rate = rate
+        self.max_session_seconds = max_session_seconds
+        self.max_failures = max_failures
+
+        self._lock = threading.Lock()
+        self._current = None
+        self._retiring = None  # the call being replaced, fed until its successor is up
+        self._processors = []  # of the current utterance
+        self._unfinalized = collections.deque()  # (offset, duration, chunk)
+        self._offset = 0.0
+        self._done = False
+        self._sessions = 0
+
+        self.rollovers = 0
+        self.replayed_seconds = 0.0
+        self.switch_seconds = 0.0
+
+    def _open_locked(self, start_offset):
+        from google.cloud import speech
+        processor = self.capture_factory()
+        streaming_config = speech.StreamingRecognitionConfig(
+            config=processor.recognition_config(language_code=self.language_code),
+            interim_results=True
+        )
+        session = _Session(self._sessions, start_offset, processor, streaming_config, replaces=self._current)
+        self._sessions += 1
+        self._processors.append(processor)
+        for _, _, chunk in self._unfinalized:
+            session.chunks.put(chunk)
+        # Chunks queue up until the call is open
+        session.start(self.client, self._opened)
+        return session
+
+    def _opened(self, session):
+        with self._lock:
+            if session.replaces is not None:
+                self.switch_seconds += time.monotonic() - session.opened
+            retiring = None
+            if self._retiring is not None and self._retiring is session.replaces:
+                retiring, self._retiring = self._retiring, None
+        if retiring is not None:
+            retiring.close_requests()
+
+    def _rollover_locked(self, reason, overlap=False):
+        old = self._current
+        start = self._unfinalized[0][0] if self._unfinalized else self._offset
+        self._current = self._open_locked(start)
+        if self._done:
+            self._current.close_requests()
+        if self._retiring is not None:
+            # Only one call is kept alive for its successor
+            self._retiring.close_requests()
+            self._retiring = None
+        if overlap and not self._done:
+            self._retiring = old
+        else:
+            old.close_requests()
+
+        replayed = self._offset - start
+        self.rollovers += 1
+        self.replayed_seconds += replayed
+        logger.info("STT session %d -> %d (%s), replayed %.2fs of unfinalized audio",
+                    old.number, self._current.number, reason, replayed)
+
+    def _pump(self, chunks):
+        for chunk in chunks:
+            duration = len(chunk) / 2 / self.rate
+            with self._lock:
+                self._unfinalized.append((self._offset, duration, chunk))
+                self._offset += duration
+                session = self._current
+                if time.monotonic() - session.opened >= self.max_session_seconds:
+                    # The new session is primed with the unfinalized audio, this chunk included
+                    self._rollover_locked("duration limit", overlap=True)
+                else:
+                    session.chunks.put(chunk)
+                if self._retiring is not None:
+                    self._retiring.chunks.put(chunk)
+        with self._lock:
+            self._done = True
+            self._current.close_requests()
+            if self._retiring is not None:
+                self._retiring.close_requests()
+                self._retiring = None
+
+    def _trim_locked(self, session, response):
+        for result in response.results:
+            if not result.is_final:
+                continue
+            end = session.start_offset + result.result_end_time.total_seconds()
+            while self._unfinalized and self._unfinalized[0][0] + self._unfinalized[0][1] <= end:
+                self._unfinalized.popleft()
+
+    def responses(self, chunks):
+        """Blocking generator over responses for the whole chunk stream."""
+        with self._lock:
+            self._unfinalized.clear()
+            self._offset = 0.0
+            self._done = False
+            self._processors = []
+            self._current = None
+            self._current = self._open_locked(0.0)
+            session = self._current
+        threading.Thread(target=self._pump, args=(chunks,), daemon=True).start()
+
+        failures = 0
+        while True:
+            try:
+                for response in session.wait():
+                    with self._lock:
+                        if session is not self._current:
+                            break  # superseded, the next session re-recognizes this audio
+                        session.received += 1
+                        self._trim_locked(session, response)
+                    failures = 0
+                    yield response
+            except RECOVERABLE_ERRORS as e:
+                failures += 0 if session.received else 1
+                if failures >= self.max_failures:
+                    raise
+                with self._lock:
+                    if session is self._current:
+                        self._rollover_locked(type(e).__name__)
+
+            with self._lock:
+                if session is self._current:
+                    if self._done:
+                        return
+                    # The server closed the call on its own, carry on with a new one
+                    failures += 0 if session.received else 1
+                    if failures >= self.max_failures:
+                        return
+                    self._rollover_locked("server closed stream")
+                superseded, session = session, self._current
+            # The old call stays up until its successor is
+            session.ready.wait()
+            superseded.cancel()
+
+    def close(self):
+        """Cancel the calls still open, if any."""
+        with self._lock:
+            sessions = [s for s in (self._current, self._retiring) if s is not None]
+            self._retiring = None
+            self._done = True
+        for session in sessions:
+            session.close_requests()
+            session.cancel()
+
+    def stats(self):
+        """Counters over all utterances, and the uplink per second of audio for the last one."""
+        with self._lock:
+            processors = list(self._processors)
+            seconds = self._offset
+        chunks = sum(p.chunks for p in processors)
+        return {
+            'sessions': self._sessions,
+            'rollovers': self.rollovers,
+            'replayed_seconds': self.replayed_seconds,
+            'mean_switch_ms': 1000 * self.switch_seconds / self.rollovers if self.rollovers else 0.0,
+            'uplink_bytes_per_second': sum(p.bytes_out for p in processors) / seconds if seconds else 0.0,
+            'raw_bytes_per_second': sum(p.bytes_in for p in processors) / seconds if seconds else 0.0,
+            'cpu_ms_per_chunk': 1000 * sum(p.cpu_seconds for p in processors) / chunks if chunks else 0.0,
+        }
+
+
+_END = object()
+
+
+class AsyncResponseReader:
+    """Async iterator over a blocking response iterator.
+
+    One dedicated thread pulls responses and hands them to the event loop
+    through an asyncio.Queue, so interim results never wait for (or tie up)
+    the default executor that the OpenAI calls use. The hand-off delay from
+    the reader thread to the consuming coroutine is measured per response.
+    """
+
+    def __init__(self, responses, loop=None, name='stt-reader'):
+        self.responses = responses
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.count = 0
+        self.handoff_seconds = 0.0
+        self.max_handoff_seconds = 0.0
+        self._thread = threading.Thread(target=self._read, name=name, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            for response in self.responses:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, (response, time.perf_counter()))
+            item = (_END, None)
+        except Exception as e:
+            item = (e, None)
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item, read_at = await self.queue.get()
+        if item is _END:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        handoff = time.perf_counter() - read_at
+        self.count += 1
+        self.handoff_seconds += handoff
+        self.max_handoff_seconds = max(self.max_handoff_seconds, handoff)
+        return item
+
+    def stats(self):
+        return {
+            'responses': self.count,
+            'mean_handoff_ms': 1000 * self.handoff_seconds / self.count if self.count else 0.0,
+            'max_handoff_ms': 1000 * self.max_handoff_seconds,
+        }
@@ -0,0 +1,173 @@
+import re
+
+from LitoTTS import VOICE_CHINESE, VOICE_ENGLISH
+
+EMOJI_PATTERN = re.compile(
+    "["
+    u"\U0001F600-\U0001F64F"  # emoticons
+    u"\U0001F300-\U0001F5FF"  # symbols & pictographs
+    u"\U0001F680-\U0001F6FF"  # transport & map symbols
+    u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    u"\U00002702-\U000027B0"  # other symbols
+    u"\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+    u"\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+    "]+", flags=re.UNICODE)
+CHINESE_PATTERN = re.compile(u"[一-鿿]")
+
+# Always end a chunk (once it is long enough) / may end one when a short chunk is wanted
+SENTENCE_ENDS = set("。！？!?；;…\n")
+CLAUSE_ENDS = set("，,、：:")
+# What may close a sentence right after its "."
+CLOSING = set("\"'”’)）]」")
+# Words whose "." is not the end of a sentence even when a capital follows ("Dr. Smith")
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "st", "jr", "sr", "vs", "no", "fig", "approx", "e.g", "i.e"}
+
+
+def remove_emojis(text):
+    return EMOJI_PATTERN.sub('', text)
+
+
+def contains_chinese(text):
+    return CHINESE_PATTERN.search(text) is not None
+
+
+def select_voice(text):
+    return VOICE_CHINESE if contains_chinese(text) else VOICE_ENGLISH
+
+
+# A Chinese character takes about as long to say as three English letters
+CHINESE_WEIGHT = 3
+
+
+def _is_chinese(char):
+    return '一' <= char <= '鿿'
+
+
+class StreamingSegmenter:
+    """Cuts streamed LLM text into TTS chunks, mixed Chinese and English.
+
+    Lengths are counted in English-character equivalents, a Chinese
+    character counting as CHINESE_WEIGHT since it is a whole syllable.
+    Each delta is scanned once: emojis are stripped, the voice is decided and
+    boundaries are found in the same pass. The first chunk is cut early, at
+    the first clause boundary past first_min_chars, so audio can start
+    quickly. Later chunks wait for a sentence end past min_chars, fall back to
+    a clause boundary past clause_chars, and are cut hard at max_chars.
+    A "." only ends a sentence when followed by a closing quote, Chinese
+    text, or whitespace and then a capital, a digit or Chinese text, and
+    not after one of ABBREVIATIONS: "3.14", "e.g. apples" and "Dr. Smith"
+    stay in one piece.
+    """
+
+    def __init__(self, first_min_chars=5, min_chars=12, clause_chars=40, max_chars=80):
+        self.first_min_chars = first_min_chars
+        self.min_chars = min_chars
+        self.clause_chars = clause_chars
+        self.max_chars = max_chars
+        self.emitted = 0
+        self._buf = ""
+        self._scan = 0
+        self._chinese = False
+        self._weight = 0
+        self._last_space = -1
+
+    def _boundary(self, i, final):
+        """'sentence', 'clause' or None for the character at i; 'wait' if it depends on what follows."""
+        buf = self._buf
+        char = buf[i]
+        if char in SENTENCE_ENDS:
+            return 'sentence'
+        if char in CLAUSE_ENDS:
+            # "1,000" is a number, not a clause
+            if char == ',' and 0 < i < len(buf) - 1 and buf[i - 1].isdigit() and buf[i + 1].isdigit():
+                return None
+            return 'clause'
+        if char == '.':
+            if i == len(buf) - 1:
+                return 'sentence' if final else 'wait'
+            following = buf[i + 1]
+            if following in CLOSING or _is_chinese(following):
+                return 'sentence'
+            if not following.isspace():
+                return None
+            rest = buf[i + 1:].lstrip()
+            if not rest:
+                # The next word has not arrived yet
+                return 'sentence' if final else 'wait'
+            start = i
+            while start > 0 and (buf[start - 1].isalpha() or buf[start - 1] == '.'):
+                start -= 1
+            if buf[start:i].lower() in ABBREVIATIONS:
+                return None
+            following = rest[0]
+            if following.isupper() or following.isdigit() or following in CLOSING or _is_chinese(following):
+                return 'sentence'
+        return None
+
+    def _take(self, end):
+        chunk, self._buf = self._buf[:end], self._buf[end:]
+        chinese = self._chinese
+        self._scan = 0
+        self._chinese = False
+        self._weight = 0
+        self._last_space = -1
+        chunk = chunk.strip()
+        if not chunk:
+            return None
+        self.emitted += 1
+        return chunk, VOICE_CHINESE if chinese else VOICE_ENGLISH
+
+    def _segment(self, final=False):
+        chunks = []
+        i = self._scan
+        while i < len(self._buf):
+            char = self._buf[i]
+            kind = self._boundary(i, final)
+            if kind == 'wait':
+                break
+            if _is_chinese(char):
+                self._chinese = True
+                self._weight += CHINESE_WEIGHT
+            else:
+                self._weight += 1
+                if char.isspace():
+                    self._last_space = i
+
+            weight = self._weight
+            if self.emitted == 0:
+                cut = kind is not None and weight >= self.first_min_chars
+            else:
+                cut = ((kind == 'sentence' and weight >= self.min_chars) or
+                       (kind == 'clause' and weight >= self.clause_chars))
+            end = i + 1
+            if cut and kind == 'sentence':
+                # A closing quote or bracket belongs to the sentence it closes
+                while end < len(self._buf) and self._buf[end] in CLOSING:
+                    end += 1
+            if not cut and weight >= self.max_chars:
+                # No boundary in sight: break at the last space for English, anywhere for Chinese
+                if self._last_space > 0 and not self._chinese:
+                    end = self._last_space + 1
+                cut = True
+            if cut:
+                chunk = self._take(end)
+                if chunk:
+                    chunks.append(chunk)
+                i = 0
+                continue
+            i += 1
+        self._scan = i
+        return chunks
+
+    def feed(self, delta):
+        """Add a text delta, return the (text, voice) chunks that are ready."""
+        self._buf += remove_emojis(delta)
+        return self._segment()
+
+    def flush(self):
+        """End of the reply: return whatever is left."""
+        chunks = self._segment(final=True)
+        rest = self._take(len(self._buf))
+        if rest:
+            chunks.append(rest)
+        return chunks
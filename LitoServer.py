@@ -0,0 +1,188 @@
+"""Voice server: many devices, one conversation each, spread over worker processes.
+
+A device opens a websocket on /session, optionally with ?thread_id=...&rate=...
+  device -> server  binary: 16-bit mono microphone PCM at `rate` Hz (8000-48000, default 44100)
+  server -> device  binary: 16-bit mono PCM to play at 24000 Hz, paced in real time
+                    text:   {"type": "ready", "thread_id": ...} once the session is set up
+                            {"type": "stop"} drop whatever is still buffered (barge-in)
+Without a thread_id the session starts on a fresh assistant thread, taken
+from the worker's pool of empty ones (LITO_THREAD_POOL); with the chat
+backend (LITO_LLM_BACKEND=chat) the history is kept by the session and
+thread_id is null. Every
+worker binds the same port with SO_REUSEPORT and the kernel spreads the
+connections over them; within a worker, sessions share the STT, OpenAI and
+TTS clients, the TTS pool and the TTS cache.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+
+import aiohttp
+from aiohttp import web
+
+from LitoAudioOutput import StreamedAudioOutput
+from LitoCapture import CaptureRing
+from LitoEchoCancel import PlaybackReference
+
+logger = logging.getLogger("LitoServer")
+
+SERVER_HOST = os.getenv('LITO_SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('LITO_SERVER_PORT', '8765'))
+SERVER_WORKERS = int(os.getenv('LITO_SERVER_WORKERS', '0')) or os.cpu_count() or 1
+
+# Each session holds capture, pump and (while someone talks) STT threads, and its echo canceller
+# takes about 2 ms of CPU per 100 ms chunk under the GIL, so a worker is saturated at about 45;
+# refuse beyond this
+SERVER_MAX_SESSIONS = int(os.getenv('LITO_SERVER_MAX_SESSIONS', '32'))
+
+# Microphone rates a device may ask for (Hz)
+MIN_RATE = 8000
+MAX_RATE = 48000
+
+
+class VoiceSession:
+    """One connected device: its websocket, its microphone, its output and its Conversation."""
+
+    def __init__(self, bot, websocket, thread_id, rate):
+        self.websocket = websocket
+        # Same bounded ring as the local microphone, a stalled STT upload cannot grow it
+        self.microphone = CaptureRing(
+            int(rate * bot.CAPTURE_BUFFER) * 2,
+            int(rate / 10) * 2,
+            policy=bot.CAPTURE_POLICY,
+            max_backlog_bytes=int(rate * bot.CAPTURE_MAX_BACKLOG) * 2
+        )
+        # Devices without echo cancellation of their own hear the bot in their microphone too; the
+        # reference is timed when the audio is sent, the tail has to cover the round trip
+        reference = PlaybackReference() if bot.AEC_TAIL else None
+        self.output = StreamedAudioOutput(self._send_audio, self._send_stop, reference=reference)
+        self.conversation = bot.Conversation(thread_id, output=self.output, rate=rate)
+
+    async def _send_audio(self, pcm):
+        if not self.websocket.closed:
+            await self.websocket.send_bytes(pcm)
+
+    async def _send_stop(self):
+        if not self.websocket.closed:
+            await self.websocket.send_json({'type': 'stop'})
+
+    async def _receive(self):
+        async for message in self.websocket:
+            if message.type == aiohttp.WSMsgType.BINARY:
+                self.microphone.write(message.data)
+            elif message.type == aiohttp.WSMsgType.ERROR:
+                logger.warning("Session %s: %r", self.conversation.thread_id, self.websocket.exception())
+                return
+
+    async def run(self):
+        self.output.start()
+        await self.websocket.send_json({'type': 'ready', 'thread_id': self.conversation.thread_id})
+        speech = asyncio.create_task(self.conversation.handle_speech(self.microphone.chunks(), capture=self.microphone))
+        receive = asyncio.create_task(self._receive())
+        try:
+            # Either the device hung up or the conversation failed
+            await asyncio.wait((speech, receive), return_when=asyncio.FIRST_COMPLETED)
+            if speech.done() and speech.exception() is not None:
+                logger.error("Session %s failed: %r", self.conversation.thread_id, speech.exception())
+        finally:
+            receive.cancel()
+            self.microphone.close()
+            await self.conversation.close()
+            self.output.close()
+            await asyncio.gather(speech, return_exceptions=True)
+            await self.websocket.close()
+
+
+class VoiceServer:
+    """The websocket front end of one worker process."""
+
+    def __init__(self, bot, max_sessions=SERVER_MAX_SESSIONS):
+        self.bot = bot
+        self.max_sessions = max_sessions
+        self.sessions = set()
+        self.app = web.Application()
+        self.app.add_routes([web.get('/session', self.handle_session)])
+
+    async def handle_session(self, request):
+        if len(self.sessions) >= self.max_sessions:
+            # The client retries and the kernel will likely pick another worker
+            return web.Response(status=503, text="Too many sessions")
+        try:
+            rate = int(request.query.get('rate', self.bot.RATE))
+        except ValueError:
+            return web.Response(status=400, text="Bad rate")
+        # A tiny rate makes empty capture chunks (a busy loop), 0 a division by zero
+        if not MIN_RATE <= rate <= MAX_RATE:
+            return web.Response(status=400, text=f"Rate must be {MIN_RATE}-{MAX_RATE} Hz")
+        thread_id = request.query.get('thread_id')
+        if not thread_id and self.bot.LLM_BACKEND != 'chat':
+            thread_id = await self.bot.thread_pool.take()
+
+        websocket = web.WebSocketResponse(heartbeat=30)
+        await websocket.prepare(request)
+        session = VoiceSession(self.bot, websocket, thread_id, rate)
+        self.sessions.add(session)
+        logger.info("Session %s opened (%d active)", thread_id, len(self.sessions))
+        try:
+            await session.run()
+        finally:
+            self.sessions.discard(session)
+            logger.info("Session %s closed (%d active)", thread_id, len(self.sessions))
+        return websocket
+
+
+async def serve(index, host=SERVER_HOST, port=SERVER_PORT):
+    # Imported here: the clients must be created in the worker, not inherited by it
+    import LitoChatBot as bot
+
+    bot.load_state()
+    if bot.METRICS_PORT:
+        await bot.metrics.serve(port=bot.METRICS_PORT + index)
+    # One profile per worker
+    bot.start_diagnostics(f'{bot.PROFILE_PATH}.{index}' if bot.PROFILE_PATH else None)
+    bot.warm_up(audio=False, threads=True)
+    asyncio.create_task(bot.report_ready())
+
+    server = VoiceServer(bot)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=True).start()
+    logger.info("Worker %d listening on %s:%d", index, host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot.tts_pool.close()
+        await bot.thread_pool.close()
+        bot.stop_diagnostics()
+
+
+def run_worker(index):
+    logging.basicConfig(
+        level=os.getenv('LITO_LOG_LEVEL', 'INFO').upper(),
+        format=f'%(asctime)s %(levelname)s [{index}] %(name)s: %(message)s'
+    )
+    try:
+        asyncio.run(serve(index))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    # spawn, not fork: gRPC and the event loop do not survive a fork
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(index,), name=f'lito-worker-{index}')
+               for index in range(SERVER_WORKERS)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import logging
+import re
+import time
+
+from LitoTTSCache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+_punctuation = re.compile(r'[\s\.,!?;:，。！？；：、"“”\'‘’…-]+')
+
+
+def comparable(transcript):
+    """Transcript reduced to what matters for "did the user say the same thing"."""
+    return _punctuation.sub('', normalize_text(transcript)).casefold()
+
+
+class SpeculationPolicy:
+    """Decides when an interim transcript is stable enough to start the LLM on.
+
+    Keeps the hit rate and the time won by each committed draft (how long
+    before the final transcript the run had already been started), so the
+    stability threshold can be tuned from the logs.
+    """
+
+    def __init__(self, stability=0.8, min_chars=4, max_drafts=2):
+        self.stability = stability
+        self.min_chars = min_chars
+        self.max_drafts = max_drafts
+
+        self._draft = None
+        self._drafted_at = None
+        self._drafts_this_utterance = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def should_draft(self, transcript, stability):
+        """Return True if a new draft should be started for this interim result."""
+        if stability < self.stability or self._drafts_this_utterance >= self.max_drafts:
+            return False
+        text = comparable(transcript)
+        if len(text) < self.min_chars or text == self._draft:
+            return False
+        if self._draft is not None:
+            self.misses += 1  # the previous draft is thrown away
+        self._draft = text
+        self._drafted_at = time.monotonic()
+        self._drafts_this_utterance += 1
+        return True
+
+    def resolve(self, final_transcript):
+        """Called on is_final: True to commit the draft, False to throw it away."""
+        hit = self._draft is not None and comparable(final_transcript) == self._draft
+        if self._draft is not None:
+            if hit:
+                self.hits += 1
+                saved = time.monotonic() - self._drafted_at
+                self.saved_seconds += saved
+                logger.info("Speculation hit, LLM started %.0f ms before the final transcript", saved * 1000)
+            else:
+                self.misses += 1
+                logger.info("Speculation miss: draft %r != final %r", self._draft, comparable(final_transcript))
+        self._draft = None
+        self._drafted_at = None
+        self._drafts_this_utterance = 0
+        return hit
+
+    def stats(self):
+        drafts = self.hits + self.misses
+        return {
+            'threshold': self.stability,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / drafts if drafts else 0.0,
+            'mean_saved_ms': 1000 * self.saved_seconds / self.hits if self.hits else 0.0,
+        }
@@ -0,0 +1,83 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """Brings the bot's components up concurrently and keeps time-to-ready per component.
+
+    Blocking setup (imports, client construction, device and channel opening)
+    runs on its own threads and coroutines run as tasks, all started at once.
+    Whatever needs a component awaits wait(name) right before using it, so
+    the microphone can already be capturing while the rest is warming up.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._components = {}  # name -> concurrent.futures.Future
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='startup')
+        self.ready_seconds = {}
+
+    def _track(self, name, future):
+        self._components[name] = future
+
+        def done(f):
+            self.ready_seconds[name] = time.monotonic() - self.started
+            if f.cancelled():
+                return
+            if f.exception() is not None:
+                logger.warning("Startup of %s failed: %r", name, f.exception())
+            else:
+                logger.info("%s ready after %.0f ms", name, 1000 * self.ready_seconds[name])
+        future.add_done_callback(done)
+
+    def mark(self, name):
+        """Record a point that is not a component of its own, e.g. the microphone being open."""
+        self.ready_seconds.setdefault(name, time.monotonic() - self.started)
+
+    def run_thread(self, name, fn, *args):
+        """Run blocking setup on a startup thread."""
+        if name not in self._components:
+            self._track(name, self._executor.submit(fn, *args))
+
+    def run_task(self, name, coroutine):
+        """Run async setup as a task on the current event loop."""
+        if name in self._components:
+            coroutine.close()
+            return
+        future = concurrent.futures.Future()
+
+        def copy(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        asyncio.create_task(coroutine).add_done_callback(copy)
+        self._track(name, future)
+
+    async def wait(self, name):
+        """Wait until name is up (or failed; the caller then works with it cold). No-op if it never started."""
+        future = self._components.get(name)
+        if future is None:
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception:
+            return None
+
+    async def wait_all(self):
+        for name in list(self._components):
+            await self.wait(name)
+        return self.report()
+
+    def report(self):
+        """ms from start until each component was ready, and until all of them were."""
+        report = {name: round(1000 * seconds, 1) for name, seconds in self.ready_seconds.items()}
+        if self._components and all(name in report for name in self._components):
+            report['all'] = max(report[name] for name in self._components)
+        return report
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+import av
+import edge_tts
+
+from LitoTTSPool import PoolUnavailable
+
+logger = logging.getLogger(__name__)
+
+# edge-tts returns "audio-24khz-48kbitrate-mono-mp3", decode straight to 16-bit mono PCM
+TTS_RATE = 24000
+TTS_CHANNELS = 1
+TTS_SAMPLE_WIDTH = 2
+
+# Voices picked by whether the text contains Chinese
+VOICE_CHINESE = "zh-CN-XiaoyiNeural"
+VOICE_ENGLISH = "en-GB-SoniaNeural"
+
+
+class Mp3StreamDecoder:
+    """Incremental in-process MP3 decoder, fed with the raw chunks edge-tts yields."""
+
+    def __init__(self, rate=TTS_RATE):
+        self.codec = av.CodecContext.create("mp3", "r")
+        self.resampler = av.AudioResampler(format="s16", layout="mono", rate=rate)
+
+    def _frames_to_pcm(self, frames):
+        pcm = []
+        for frame in frames:
+            for out in self.resampler.resample(frame):
+                # packed s16 mono, the plane may be padded past the last sample
+                pcm.append(bytes(out.planes[0])[:out.samples * TTS_SAMPLE_WIDTH])
+        return b"".join(pcm)
+
+    def _decode_packets(self, packets):
+        frames = []
+        for packet in packets:
+            try:
+                frames.extend(self.codec.decode(packet))
+            except av.InvalidDataError:
+                # ID3 tags and the odd corrupt frame: skip them, keep the stream going
+                continue
+        return frames
+
+    def decode(self, data):
+        """Return the PCM for every complete MP3 frame contained in data so far."""
+        return self._frames_to_pcm(self._decode_packets(self.codec.parse(data)))
+
+    def flush(self):
+        """Drain the parser, the decoder and the resampler at the end of a stream."""
+        frames = self._decode_packets(self.codec.parse(None))
+        frames.extend(self.codec.decode(None))
+        pcm = self._frames_to_pcm(frames)
+        tail = [bytes(out.planes[0])[:out.samples * TTS_SAMPLE_WIDTH] for out in self.resampler.resample(None)]
+        return pcm + b"".join(tail)
+
+
+async def mp3_stream(text, voice, pool=None):
+    """Yield the MP3 chunks for text, over a warm pooled connection when there is one."""
+    if pool is not None:
+        try:
+            async for data in pool.synthesize(text, voice):
+                yield data
+            return
+        except PoolUnavailable as e:
+            logger.debug("TTS pool not used for %r: %s", text, e)
+
+    communicate = edge_tts.Communicate(text, voice)
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
+
+
+async def synthesize_stream(text, voice, cache=None, pool=None):
+    """Yield decoded PCM as soon as each edge-tts audio chunk arrives.
+
+    With a TTSCache, short phrases are served from it and new ones are stored
+    once their synthesis has completed. With a TTSConnectionPool the request
+    goes over an already open websocket.
+    """
+    cacheable = cache is not None and cache.cacheable(text)
+    if cacheable:
+        # The disk tier is SQLite, keep it off the event loop
+        pcm = await asyncio.to_thread(cache.get, text, voice)
+        if pcm is not None:
+            yield pcm
+            return
+
+    decoder = Mp3StreamDecoder()
+    decoded = [] if cacheable else None
+    async for data in mp3_stream(text, voice, pool):
+        pcm = decoder.decode(data)
+        if pcm:
+            if cacheable:
+                decoded.append(pcm)
+            yield pcm
+    pcm = decoder.flush()
+    if pcm:
+        if cacheable:
+            decoded.append(pcm)
+        yield pcm
+
+    if cacheable:
+        await asyncio.to_thread(cache.put, text, voice, b"".join(decoded))
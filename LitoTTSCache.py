@@ -0,0 +1,149 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Canonical form of a phrase for cache lookups: NFKC, trimmed, single spaces."""
+    return _whitespace.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+class TTSCache:
+    """Two-tier cache of decoded TTS PCM keyed on normalized text plus voice.
+
+    Tier one is an in-memory LRU bounded by total PCM bytes. Tier two is a
+    SQLite file holding zlib-compressed PCM, bounded by compressed bytes and
+    evicted least-recently-used first, so common phrases survive restarts.
+    """
+
+    def __init__(self, path='tts_cache.sqlite3', max_memory_bytes=32 * 1024 * 1024,
+                 max_disk_bytes=256 * 1024 * 1024, max_text_length=120):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_text_length = max_text_length
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tts_cache ("
+                " key TEXT PRIMARY KEY, voice TEXT, text TEXT,"
+                " pcm BLOB, size INTEGER, last_used REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS tts_cache_last_used ON tts_cache(last_used)")
+            self._db.commit()
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM tts_cache").fetchone()[0]
+        else:
+            self._disk_bytes = 0
+
+    @staticmethod
+    def make_key(text, voice):
+        return hashlib.sha1(f"{voice}\n{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+    def cacheable(self, text):
+        return 0 < len(normalize_text(text)) <= self.max_text_length
+
+    def get(self, text, voice):
+        """Return cached PCM for (text, voice) or None. May touch the disk tier."""
+        key = self.make_key(text, voice)
+        with self._lock:
+            pcm = self._memory.get(key)
+            if pcm is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return pcm
+            if self._db is not None:
+                row = self._db.execute("SELECT pcm FROM tts_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE tts_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    pcm = zlib.decompress(row[0])
+                    self._remember_locked(key, pcm)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return pcm
+            self.misses += 1
+            return None
+
+    def put(self, text, voice, pcm):
+        if not pcm or not self.cacheable(text):
+            return
+        key = self.make_key(text, voice)
+        with self._lock:
+            self._remember_locked(key, pcm)
+            if self._db is not None:
+                blob = zlib.compress(pcm)
+                old = self._db.execute("SELECT size FROM tts_cache WHERE key = ?", (key,)).fetchone()
+                if old is not None:
+                    self._disk_bytes -= old[0]
+                self._db.execute(
+                    "INSERT OR REPLACE INTO tts_cache (key, voice, text, pcm, size, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, voice, normalize_text(text), blob, len(blob), time.time())
+                )
+                self._disk_bytes += len(blob)
+                self._evict_disk_locked()
+                self._db.commit()
+
+    def _remember_locked(self, key, pcm):
+        if len(pcm) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = pcm
+        self._memory_bytes += len(pcm)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.memory_evictions += 1
+
+    def _evict_disk_locked(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            row = self._db.execute("SELECT key, size FROM tts_cache ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                self._disk_bytes = 0
+                return
+            self._db.execute("DELETE FROM tts_cache WHERE key = ?", (row[0],))
+            self._disk_bytes -= row[1]
+            self.disk_evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'memory_evictions': self.memory_evictions,
+                'disk_evictions': self.disk_evictions,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_bytes': self._disk_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
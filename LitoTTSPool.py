@@ -0,0 +1,284 @@
+import asyncio
+import collections
+import logging
+import ssl
+import time
+
+import aiohttp
+import certifi
+from edge_tts.communicate import (connect_id, date_to_string, escape, get_headers_and_data, mkssml,
+                                  remove_incompatible_characters, ssml_headers_plus_data)
+from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS, WSS_URL
+from edge_tts.data_classes import TTSConfig
+from edge_tts.drm import DRM
+
+logger = logging.getLogger(__name__)
+
+_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+# One SSML message per synthesis, longer text goes through edge_tts.Communicate, which splits it
+MAX_SSML_BYTES = 4096
+
+SPEECH_CONFIG = (
+    "Content-Type:application/json; charset=utf-8\r\n"
+    "Path:speech.config\r\n\r\n"
+    '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+    '"sentenceBoundaryEnabled":"true","wordBoundaryEnabled":"false"},'
+    '"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}\r\n'
+)
+
+
+class StaleConnection(Exception):
+    """The websocket went away before the synthesis was complete."""
+
+
+class PoolUnavailable(Exception):
+    """Nothing was synthesized through the pool, the caller should synthesize without it."""
+
+
+class TTSConnection:
+    """One edge-tts websocket, configured once and reused for one synthesis after another."""
+
+    def __init__(self, websocket, voice):
+        self.websocket = websocket
+        self.voice = voice
+        self.opened_at = time.monotonic()
+        self.last_used = self.opened_at
+        self.turns = 0
+
+    @classmethod
+    async def open(cls, session, url, voice):
+        websocket = await session.ws_connect(
+            f"{url}&ConnectionId={connect_id()}"
+            f"&Sec-MS-GEC={DRM.generate_sec_ms_gec()}"
+            f"&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}",
+            compress=15,
+            headers=DRM.headers_with_muid(WSS_HEADERS),
+            ssl=_SSL_CONTEXT if url.startswith('wss:') else None,
+        )
+        await websocket.send_str(f"X-Timestamp:{date_to_string()}\r\n" + SPEECH_CONFIG)
+        return cls(websocket, voice)
+
+    @property
+    def closed(self):
+        return self.websocket.closed
+
+    def age(self):
+        return time.monotonic() - self.opened_at
+
+    def idle(self):
+        return time.monotonic() - self.last_used
+
+    async def synthesize(self, ssml):
+        """Yield the MP3 chunks of one synthesis request."""
+        self.turns += 1
+        await self.websocket.send_str(ssml_headers_plus_data(connect_id(), date_to_string(), ssml))
+        while True:
+            received = await self.websocket.receive()
+            if received.type == aiohttp.WSMsgType.TEXT:
+                data = received.data.encode('utf-8')
+                headers, _ = get_headers_and_data(data, data.find(b"\r\n\r\n"))
+                if headers.get(b"Path") == b"turn.end":
+                    self.last_used = time.monotonic()
+                    return
+            elif received.type == aiohttp.WSMsgType.BINARY:
+                if len(received.data) < 2:
+                    continue
+                headers, data = get_headers_and_data(received.data, int.from_bytes(received.data[:2], 'big'))
+                # The last audio message of a turn has no Content-Type and no data
+                if headers.get(b"Path") == b"audio" and headers.get(b"Content-Type") == b"audio/mpeg" and data:
+                    yield data
+            else:
+                raise StaleConnection(f"websocket {received.type.name.lower()}")
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class TTSConnectionPool:
+    """Pre-opened edge-tts websockets for the voices the bot speaks with.
+
+    start() opens `size` connections per voice and a background task keeps
+    them that way: connections that were idle for max_idle seconds or are
+    older than max_age are replaced before the service drops them, and
+    whatever acquire() hands out is replenished. A connection that still
+    turns out to be stale fails before yielding any audio with
+    PoolUnavailable, and synthesize_stream() falls back to a one-off
+    edge_tts.Communicate. One that fails after some audio raises
+    StaleConnection, whatever the error was.
+    """
+
+    def __init__(self, voices, size=2, url=None, max_idle=30.0, max_age=240.0, refresh_interval=5.0):
+        self.voices = voices
+        self.size = size
+        self.url = url or WSS_URL
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+
+        self._idle = {voice: collections.deque() for voice in voices}
+        self._opening = collections.Counter()
+        self._session = None
+        self._refresher = None
+        self._tasks = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.refreshed = 0
+        self.opened = 0
+        self.failures = 0
+        self.connect_seconds = 0.0
+
+    @property
+    def started(self):
+        return self._session is not None
+
+    async def start(self):
+        """Open the first connections and wait for them, then keep the pool topped up."""
+        if self.started or not self.size:
+            return
+        self._session = aiohttp.ClientSession(trust_env=True)
+        await asyncio.gather(*(self._fill(voice) for voice in self.voices))
+        self._refresher = asyncio.create_task(self._refresh())
+
+    async def _open(self, voice):
+        self._opening[voice] += 1
+        started = time.monotonic()
+        try:
+            try:
+                connection = await TTSConnection.open(self._session, self.url, voice)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 403:
+                    raise
+                # Sec-MS-GEC is time based, correct the clock skew like edge_tts does
+                DRM.handle_client_response_error(e)
+                connection = await TTSConnection.open(self._session, self.url, voice)
+        except Exception as e:
+            self.failures += 1
+            logger.warning("TTS connection for %s not opened: %r", voice, e)
+            return
+        finally:
+            self._opening[voice] -= 1
+        self.opened += 1
+        self.connect_seconds += time.monotonic() - started
+        self._idle[voice].append(connection)
+
+    async def _fill(self, voice):
+        missing = self.size - len(self._idle[voice]) - self._opening[voice]
+        if missing > 0:
+            await asyncio.gather(*(self._open(voice) for _ in range(missing)))
+
+    def _fill_later(self, voice):
+        if self.started:
+            task = asyncio.create_task(self._fill(voice))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _close_later(self, connection):
+        task = asyncio.create_task(connection.close())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _is_stale(self, connection):
+        return connection.closed or connection.idle() >= self.max_idle or connection.age() >= self.max_age
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for voice, idle in self._idle.items():
+                for connection in [c for c in idle if self._is_stale(c)]:
+                    idle.remove(connection)
+                    self.refreshed += 1
+                    self._close_later(connection)
+                await self._fill(voice)
+
+    def acquire(self, voice):
+        """A warm connection for voice, or None (the caller then synthesizes without the pool)."""
+        idle = self._idle.get(voice)
+        while idle:
+            connection = idle.popleft()
+            if not self._is_stale(connection):
+                self.hits += 1
+                self._fill_later(voice)
+                return connection
+            self.stale += 1
+            self._close_later(connection)
+        self.misses += 1
+        self._fill_later(voice)
+        return None
+
+    async def synthesize(self, text, voice):
+        """Yield the MP3 chunks for text over a warm connection.
+
+        Raises PoolUnavailable if that did not produce any audio, so the
+        caller can still synthesize the text another way.
+        """
+        ssml = make_ssml(text, voice)
+        connection = self.acquire(voice) if ssml is not None else None
+        if connection is None:
+            raise PoolUnavailable("no warm connection")
+        received = False
+        completed = False
+        try:
+            async for data in connection.synthesize(ssml):
+                received = True
+                yield data
+            completed = True
+        except (StaleConnection, aiohttp.ClientError, ConnectionError) as e:
+            self.stale += 1
+            if not received:
+                raise PoolUnavailable(repr(e)) from e
+            if isinstance(e, StaleConnection):
+                raise
+            raise StaleConnection(repr(e)) from e
+        finally:
+            # Abandoned mid-turn (barge-in) the rest of the turn is still on its way, drop it
+            if completed:
+                self.release(connection)
+            else:
+                self.discard(connection)
+
+    def release(self, connection):
+        """Hand back a connection whose last synthesis ran to turn.end."""
+        idle = self._idle[connection.voice]
+        if self.started and not connection.closed and len(idle) < self.size:
+            idle.append(connection)
+        else:
+            self._close_later(connection)
+
+    def discard(self, connection):
+        """Drop a connection that failed or was abandoned mid-synthesis."""
+        self._close_later(connection)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'stale': self.stale,
+            'refreshed': self.refreshed,
+            'opened': self.opened,
+            'failures': self.failures,
+            'mean_connect_ms': 1000 * self.connect_seconds / self.opened if self.opened else 0.0,
+            'idle': {voice: len(idle) for voice, idle in self._idle.items()},
+        }
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        for idle in self._idle.values():
+            while idle:
+                await idle.popleft().close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def make_ssml(text, voice):
+    """The SSML edge_tts.Communicate would send for text, or None if it needs splitting."""
+    ssml = mkssml(TTSConfig(voice, "+0%", "+0%", "+0Hz", "SentenceBoundary"),
+                  escape(remove_incompatible_characters(text)))
+    return ssml if len(ssml.encode('utf-8')) <= MAX_SSML_BYTES else None
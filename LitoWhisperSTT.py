@@ -0,0 +1,202 @@
+import collections
+import concurrent.futures
+import datetime
+import logging
+import time
+
+import openai
+
+from LitoCapture import CaptureProcessor, VoiceActivityDetector
+
+logger = logging.getLogger(__name__)
+
+# File names the transcription endpoint uses to tell the container apart
+FILE_NAMES = {
+    'OGG_OPUS': 'segment.ogg',
+    'FLAC': 'segment.flac',
+}
+
+# Worth one more attempt; anything else drops the segment
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+# Shaped like the Google responses handle_speech reads
+Alternative = collections.namedtuple('Alternative', 'transcript confidence')
+Result = collections.namedtuple('Result', 'alternatives is_final stability result_end_time')
+Response = collections.namedtuple('Response', 'results')
+
+
+def _response(transcript, is_final, seconds):
+    return Response([Result(
+        alternatives=[Alternative(transcript, 0.0)],
+        is_final=is_final,
+        # Whisper never revises a segment, but a partial transcript is not the utterance
+        stability=1.0 if is_final else 0.0,
+        result_end_time=datetime.timedelta(seconds=seconds),
+    )])
+
+
+class _Segment:
+    """Audio between two pauses, compressed while it is being captured."""
+
+    def __init__(self, number, processor):
+        self.number = number
+        self.processor = processor
+        self.payload = []
+        self.seconds = 0.0
+        self.voiced = False
+        self.future = None
+
+    def add(self, chunk, seconds, voiced):
+        data = self.processor.process(chunk)
+        if data:
+            self.payload.append(data)
+        self.seconds += seconds
+        self.voiced = self.voiced or voiced
+
+    def close(self):
+        self.payload.append(self.processor.finish())
+        return b"".join(self.payload)
+
+
+class WhisperSessionManager:
+    """OpenAI Whisper behind the same responses(chunks) interface as StreamingSessionManager.
+
+    The utterance is already endpoint-terminated by the SpeechGate. While it
+    is being captured it is resampled and compressed in memory and cut into
+    segments at pauses (once a segment is min_segment_seconds long, or hard
+    at max_segment_seconds). Each segment is uploaded as soon as it is cut,
+    on a small thread pool, so long answers are transcribed while the user
+    is still talking. Finished segments come back, in order, as interim
+    results carrying the text so far; the final result joins all of them.
+    """
+
+    def __init__(self, client, rate, language=None, model='whisper-1', encoding='OGG_OPUS', target_rate=16000,
+                 min_segment_seconds=4.0, max_segment_seconds=15.0, pause_seconds=0.3, max_workers=4):
+        if encoding not in FILE_NAMES:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        self.client = client
+        self.rate = rate
+        self.language = language
+        self.model = model
+        self.encoding = encoding
+        self.target_rate = target_rate
+        self.min_segment_seconds = min_segment_seconds
+        self.max_segment_seconds = max_segment_seconds
+        self.pause_seconds = pause_seconds
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='whisper')
+
+        self.utterances = 0
+        self.segments = 0
+        self.failed_segments = 0
+        self.audio_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.request_seconds = 0.0
+        self.final_delay_seconds = 0.0  # end of audio -> final transcript
+
+    def _new_segment(self, number):
+        processor = CaptureProcessor(self.rate, self.target_rate, self.encoding, report_interval=0)
+        return _Segment(number, processor)
+
+    def _submit(self, segment):
+        payload = segment.close()
+        self.segments += 1
+        self.bytes_in += segment.processor.bytes_in
+        self.bytes_out += len(payload)
+        segment.future = self._executor.submit(self._transcribe, segment.number, payload)
+        logger.debug("Whisper segment %d: %.2fs, %d bytes", segment.number, segment.seconds, len(payload))
+
+    def _transcribe(self, number, payload):
+        started = time.monotonic()
+        for attempt in range(2):
+            try:
+                transcription = self.client.audio.transcriptions.create(
+                    model=self.model,
+                    file=(FILE_NAMES[self.encoding], payload),
+                    **({'language': self.language} if self.language else {})
+                )
+                self.request_seconds += time.monotonic() - started
+                return transcription.text.strip()
+            except RETRYABLE_ERRORS as e:
+                if attempt:
+                    logger.warning("Whisper segment %d dropped: %s", number, e)
+            except openai.OpenAIError as e:
+                logger.warning("Whisper segment %d dropped: %s", number, e)
+                break
+        self.failed_segments += 1
+        return ""
+
+    def responses(self, chunks):
+        """Blocking generator over Google-shaped responses for one utterance."""
+        self.utterances += 1
+        vad = VoiceActivityDetector(self.rate)
+        segments = []
+        texts = []
+        segment = self._new_segment(0)
+        silence = 0.0
+        offset = 0.0
+
+        def finished():
+            # Text of the segments that are done, stopping at the first one still in flight
+            while len(texts) < len(segments) and segments[len(texts)].future.done():
+                texts.append(segments[len(texts)].future.result())
+                yield _response(_join(texts), False, offset)
+
+        for chunk in chunks:
+            seconds = len(chunk) / 2 / self.rate
+            offset += seconds
+            voiced = vad.is_speech(chunk)
+            segment.add(chunk, seconds, voiced)
+            silence = 0.0 if voiced else silence + seconds
+            if ((segment.seconds >= self.min_segment_seconds and silence >= self.pause_seconds)
+                    or segment.seconds >= self.max_segment_seconds):
+                if segment.voiced:
+                    self._submit(segment)
+                    segments.append(segment)
+                segment = self._new_segment(len(segments))
+                silence = 0.0
+            yield from finished()
+
+        self.audio_seconds += offset
+        # Whisper makes up text for silence, the trailing bit is often nothing else
+        if segment.voiced:
+            self._submit(segment)
+            segments.append(segment)
+        ended = time.monotonic()
+        for pending in segments[len(texts):]:
+            texts.append(pending.future.result())
+        self.final_delay_seconds += time.monotonic() - ended
+        transcript = _join(texts)
+        if transcript:
+            yield _response(transcript, True, offset)
+
+    def stats(self):
+        return {
+            'utterances': self.utterances,
+            'segments': self.segments,
+            'failed_segments': self.failed_segments,
+            'compression': self.bytes_in / self.bytes_out if self.bytes_out else 0.0,
+            'mean_request_ms': 1000 * self.request_seconds / self.segments if self.segments else 0.0,
+            'mean_final_delay_ms': 1000 * self.final_delay_seconds / self.utterances if self.utterances else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _join(texts):
+    """Segments of Chinese run together, anything else is separated by a space."""
+    joined = ""
+    for text in texts:
+        if not text:
+            continue
+        if joined and (joined[-1].isascii() or text[0].isascii()):
+            joined += " "
+        joined += text
+    return joined
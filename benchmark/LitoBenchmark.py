@@ -0,0 +1,437 @@
+"""Offline end-to-end benchmark of LitoChatBot.
+
+Recorded WAV files (or synthetic speech-like bursts) are replayed in real
+time through a file-backed MicrophoneStream, while Google STT, the OpenAI
+Assistants API and edge-tts are served by the local stand-ins in
+LitoStubServers.py. handle_speech, the conversation turns and their
+synthesis and playback (CustomEventHandler.synthesize_sentence and
+play_in_order) run unmodified; only the microphone and the speaker are
+swapped.
+
+    python benchmark/LitoBenchmark.py --synthetic 5 --profile typical
+    python benchmark/LitoBenchmark.py hello.wav story.wav --max-p50 end_to_end=2500
+
+A transcript for each WAV is read from a .txt file next to it. The report
+(JSON) has per-turn latencies, their percentiles, CPU and RSS; any --max-p50
+limit that is exceeded makes the exit status 1, for CI. --echo feeds what the
+speaker plays back into the microphone, as a room would, to check the echo
+canceller keeps the bot from answering itself. --llm picks the LLM backend,
+to compare their time_to_first_token on the same recordings (with
+LITO_SPECULATIVE_STABILITY=1.1, or speculative turns mostly have none).
+"""
+import argparse
+import asyncio
+import functools
+import importlib
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from LitoAudioOutput import AudioOutputEngine
+from LitoCapture import MicrophoneStream, Resampler
+from LitoTTS import TTS_RATE
+from LitoMetrics import LatencyHistogram, MetricsRecorder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRANSCRIPT = "你好，你叫什么名字"
+
+
+def read_wav(path, rate):
+    """16-bit PCM of a WAV file, downmixed to mono and resampled to rate."""
+    with wave.open(path, 'rb') as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit WAV files are supported")
+        channels = f.getnchannels()
+        in_rate = f.getframerate()
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return Resampler(in_rate, rate).process(samples.tobytes())
+
+
+def synthetic_speech(seconds, rate, seed=0):
+    """Syllable-rate modulated noise: loud and bursty enough for the VAD, nothing more."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate)) / rate
+    envelope = 0.55 + 0.45 * np.sin(2 * np.pi * 4 * t)
+    return (rng.normal(0, 4000, len(t)) * envelope).clip(-32768, 32767).astype(np.int16).tobytes()
+
+
+def background_noise(seconds, rate, rng):
+    return rng.normal(0, 40, int(seconds * rate)).astype(np.int16).tobytes()
+
+
+class EchoPath:
+    """Speaker to microphone path of a simulated room.
+
+    Everything the output hands to its "device", silence included, comes back
+    delay seconds later at the microphone rate, scaled by gain, with two
+    weaker reflections.
+    """
+
+    def __init__(self, out_rate, mic_rate, gain=0.4, delay=0.05):
+        self.resampler = Resampler(out_rate, mic_rate)
+        response = np.zeros(int(0.03 * mic_rate))
+        response[[0, int(0.007 * mic_rate), -1]] = (1.0, 0.4, 0.2)
+        self.response = gain * response
+        self._history = np.zeros(len(response) - 1)
+        self._buffer = np.zeros(int(delay * mic_rate))
+        self._lock = threading.Lock()
+
+    def play(self, pcm):
+        x = np.concatenate((self._history, np.frombuffer(self.resampler.process(pcm), dtype=np.int16)))
+        echo = np.convolve(x, self.response, mode='valid')
+        self._history = x[len(x) - len(self._history):]
+        with self._lock:
+            self._buffer = np.concatenate((self._buffer, echo))
+
+    def mix(self, chunk):
+        """chunk with the echo that reached the microphone meanwhile added."""
+        mic = np.frombuffer(chunk, dtype=np.int16)
+        with self._lock:
+            echo, self._buffer = self._buffer[:len(mic)], self._buffer[len(mic):]
+        mic = mic.astype(np.float64)
+        mic[:len(echo)] += echo
+        return np.clip(mic, -32768, 32767).astype(np.int16).tobytes()
+
+
+class ReplayMicrophoneStream(MicrophoneStream):
+    """MicrophoneStream whose "device" plays clips into the capture ring at real-time pace.
+
+    lead_in seconds of background noise come first so the VAD settles, then
+    each clip followed by gap seconds of noise for the reply. The monotonic
+    time the last chunk of each clip was captured, i.e. the true end of
+    speech, is appended to speech_ends. With an EchoPath the speaker is
+    mixed in.
+    """
+
+    def __init__(self, rate, chunk, clips=(), gap=8.0, lead_in=1.0, speech_ends=None, echo=None, **kwargs):
+        kwargs.pop('audio', None)
+        super().__init__(rate, chunk, **kwargs)
+        self.clips = clips
+        self.gap = gap
+        self.lead_in = lead_in
+        self.speech_ends = speech_ends if speech_ends is not None else []
+        self.echo = echo
+
+    def __enter__(self):
+        self.closed = False
+        threading.Thread(target=self._replay, name='replay-microphone', daemon=True).start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.closed = True
+        self.ring.close()
+
+    def _chunks(self, pcm):
+        size = self.chunk * 2
+        for start in range(0, len(pcm) - size + 1, size):
+            yield pcm[start:start + size]
+
+    def _replay(self):
+        rng = np.random.default_rng(1)
+        period = self.chunk / self.rate
+        due = time.monotonic()
+        segments = [(background_noise(self.lead_in, self.rate, rng), False)]
+        for clip in self.clips:
+            segments.append((clip, True))
+            segments.append((background_noise(self.gap, self.rate, rng), False))
+        for pcm, is_clip in segments:
+            for chunk in self._chunks(pcm):
+                # A device hands over each chunk once it has been captured
+                due += period
+                time.sleep(max(0.0, due - time.monotonic()))
+                if self.closed:
+                    return
+                if self.echo is not None:
+                    chunk = self.echo.mix(chunk)
+                self.ring.write(chunk)
+            if is_clip:
+                self.speech_ends.append(time.monotonic())
+        self.ring.close()
+
+
+class NullAudioOutput(AudioOutputEngine):
+    """AudioOutputEngine whose device callback is driven by a real-time thread instead of PortAudio."""
+
+    def __init__(self, *args, loopback=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loopback = loopback  # EchoPath the "speaker" plays into
+        self._closed = None
+
+    def start(self):
+        if self._closed is not None:
+            return
+        self._closed = threading.Event()
+        threading.Thread(target=self._clock, args=(self._closed,), name='null-audio', daemon=True).start()
+
+    def _clock(self, closed):
+        due = time.monotonic()
+        while not closed.is_set():
+            due += self.buffer_period
+            time.sleep(max(0.0, due - time.monotonic()))
+            out, _ = self._callback(None, self.frames_per_buffer, None, None)
+            if self.loopback is not None:
+                self.loopback.play(out)
+
+    def close(self):
+        self.stop()
+        if self._closed is not None:
+            self._closed.set()
+            self._closed = None
+
+
+class BenchmarkRecorder(MetricsRecorder):
+    """MetricsRecorder that also keeps every timeline for the report."""
+
+    def __init__(self):
+        super().__init__()
+        self.timelines = []
+
+    def record(self, timeline, status='completed'):
+        super().record(timeline, status)
+        self.timelines.append((timeline, status))
+
+
+class ResourceUsage:
+    """CPU time (all threads) and memory of this process between two points."""
+
+    def __init__(self):
+        self.wall = time.monotonic()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    @staticmethod
+    def rss_bytes():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            return None
+
+    def since(self, start):
+        wall = self.wall - start.wall
+        cpu = (self.usage.ru_utime - start.usage.ru_utime) + (self.usage.ru_stime - start.usage.ru_stime)
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak = self.usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        rss = self.rss_bytes()
+        return {
+            'wall_seconds': round(wall, 2),
+            'cpu_seconds': round(cpu, 3),
+            'cpu_percent': round(100 * cpu / wall, 1) if wall else 0.0,
+            'rss_mib': round(rss / 2 ** 20, 1) if rss is not None else None,
+            'peak_rss_mib': round(peak / 2 ** 20, 1),
+        }
+
+
+def start_stubs(args, transcripts):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'LitoStubServers.py'),
+               '--profile', args.profile]
+    for item in args.set:
+        command += ['--set', item]
+    for transcript in transcripts:
+        command += ['--transcript', transcript]
+    if args.reply:
+        command += ['--reply', args.reply]
+    # Separate process, so its CPU time is not counted against the bot
+    stubs = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    line = stubs.stdout.readline()
+    if not line:
+        raise RuntimeError("Stub servers failed to start")
+    return stubs, json.loads(line)
+
+
+def load_bot(endpoints, tts_cache, llm='assistants'):
+    """Import LitoChatBot against the stand-ins."""
+    os.environ['LITO_LLM_BACKEND'] = llm
+    os.environ['LITO_STT_ENDPOINT'] = endpoints['stt']
+    os.environ['OPENAI_BASE_URL'] = endpoints['openai']
+    os.environ['OPENAI_API_KEY'] = 'stub'
+    os.environ['OPENAI_ASSISTANT_ID'] = 'asst_stub'
+    os.environ['OPENAI_THREAD_ID'] = 'thread_stub'
+    os.environ['LITO_REGISTRY'] = ''  # never the real assistant from a registry in the working directory
+    os.environ['LITO_TTS_CACHE'] = tts_cache or ''
+    os.environ['LITO_TTS_URL'] = endpoints['tts']
+    os.environ.pop('LITO_METRICS_LOG', None)
+
+    import edge_tts.communicate
+    edge_tts.communicate.WSS_URL = endpoints['tts']
+    started = time.monotonic()
+    bot = importlib.import_module('LitoChatBot')
+    bot.import_seconds = time.monotonic() - started
+    return bot
+
+
+def _percentiles(values):
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.add(value)
+    result = histogram.percentiles()
+    if values:
+        result['max'] = round(1000 * max(values), 1)
+    return result
+
+
+def build_report(recorder, speech_ends, usage, args):
+    turns = []
+    end_to_end = []
+    first_audio = []
+    for timeline, status in recorder.timelines:
+        entry = {'turn': timeline.turn_id, 'status': status, 'text': timeline.text}
+        final = timeline.marks.get('final_transcript')
+        # The clip this turn answers is the last one that ended before its final transcript
+        spoken = [end for end in speech_ends if final is not None and end <= final]
+        start = timeline.marks.get('playback_start')
+        if status == 'completed' and start is not None:
+            if spoken:
+                end_to_end.append(start - spoken[-1])
+                entry['end_to_end_ms'] = round(1000 * end_to_end[-1], 1)
+            first_audio.append(start - final)
+            entry['time_to_first_audio_ms'] = round(1000 * first_audio[-1], 1)
+        entry['intervals_ms'] = timeline.to_dict(status)['intervals_ms']
+        turns.append(entry)
+
+    return {
+        'profile': args.profile,
+        'overrides': args.set,
+        'llm': args.llm,
+        'utterances': len(speech_ends),
+        'turns': turns,
+        'latency_ms': {
+            # From the real end of the clip to the first reply sample leaving the speaker
+            'end_to_end': _percentiles(end_to_end),
+            # From the final transcript to the first reply sample leaving the speaker
+            'time_to_first_audio': _percentiles(first_audio),
+            **recorder.snapshot()['latency_ms'],
+        },
+        'tokens': recorder.snapshot()['tokens'],
+        'resources': usage,
+    }
+
+
+def check_limits(report, limits):
+    failures = []
+    for item in limits:
+        name, limit = item.split('=', 1)
+        p50 = report['latency_ms'].get(name, {}).get('p50')
+        if p50 is None:
+            failures.append(f"{name}: no samples")
+        elif p50 > float(limit):
+            failures.append(f"{name}: p50 {p50} ms > {limit} ms")
+    return failures
+
+
+async def run(args, bot, clips):
+    speech_ends = []
+    recorder = BenchmarkRecorder()
+    bot.metrics = recorder
+    echo = EchoPath(TTS_RATE, bot.RATE, gain=args.echo, delay=args.echo_delay) if args.echo else None
+    bot.MicrophoneStream = functools.partial(ReplayMicrophoneStream, clips=clips, gap=args.gap,
+                                             speech_ends=speech_ends, echo=echo)
+    bot.get_pyaudio = lambda: None  # no PortAudio: the replay has no device and the output is NullAudioOutput
+    bot.audio_output = NullAudioOutput(reference=bot.echo_reference, loopback=echo)
+    bot.audio_output.start()
+
+    # Same diagnostics and concurrent warm-up as main(), the replayed microphone starts right away
+    bot.start_diagnostics()
+    bot.warm_up(audio=False)
+    start = ResourceUsage()
+    try:
+        await bot.handle_speech()
+        # The last reply may still be playing when the recording runs out
+        turn = bot.local_conversation.current_turn
+        if turn is not None and turn.task is not None:
+            await asyncio.gather(turn.task, return_exceptions=True)
+    finally:
+        bot.audio_output.close()
+        await bot.tts_pool.close()
+        await bot.thread_pool.close()
+        bot.stop_diagnostics()
+    report = build_report(recorder, speech_ends, ResourceUsage().since(start), args)
+    report['tts_pool'] = bot.tts_pool.stats()
+    report['context'] = bot.local_conversation.context.stats()
+    report['response_store'] = bot.local_conversation.response_store.stats()
+    if bot.watchdog is not None:
+        report['event_loop'] = bot.watchdog.stats()
+    if bot.profiler is not None:
+        report['profiler'] = bot.profiler.stats()
+    if bot.local_conversation.echo_canceller is not None:
+        report['echo_canceller'] = bot.local_conversation.echo_canceller.stats()
+    report['startup_ms'] = {'import': round(1000 * bot.import_seconds, 1), **bot.startup.report()}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('wavs', nargs='*', help="16-bit WAV recordings, one utterance each")
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N',
+                        help="add N generated 1.5 s utterances (no recordings needed)")
+    parser.add_argument('--profile', default='typical', help="stub latency profile: fast, typical or slow")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=SECONDS',
+                        help="override one stub latency setting")
+    parser.add_argument('--reply', help="what the stub assistant answers")
+    parser.add_argument('--gap', type=float, default=8.0, help="seconds of silence after each utterance")
+    parser.add_argument('--echo', type=float, default=0.0, metavar='GAIN',
+                        help="play the speaker back into the microphone at this gain (0: no echo)")
+    parser.add_argument('--echo-delay', type=float, default=0.05, metavar='SECONDS',
+                        help="speaker to microphone delay of --echo")
+    parser.add_argument('--llm', choices=('assistants', 'chat'), default='assistants',
+                        help="LLM backend: Assistants runs or streamed Chat Completions")
+    parser.add_argument('--tts-cache', help="TTS cache file to use (default: in-memory tier only)")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--max-p50', action='append', default=[], metavar='NAME=MS',
+                        help="fail when the median of a latency exceeds MS, e.g. end_to_end=2500")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=os.getenv('LITO_LOG_LEVEL', 'WARNING').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
+    if not args.wavs and not args.synthetic:
+        parser.error("give WAV files and/or --synthetic N")
+
+    transcripts = []
+    for path in args.wavs:
+        sidecar = os.path.splitext(path)[0] + '.txt'
+        if os.path.exists(sidecar):
+            with open(sidecar, encoding='utf-8') as f:
+                transcripts.append(f.read().strip())
+        else:
+            transcripts.append(DEFAULT_TRANSCRIPT)
+    transcripts += [DEFAULT_TRANSCRIPT] * args.synthetic
+
+    stubs, endpoints = start_stubs(args, transcripts)
+    try:
+        bot = load_bot(endpoints, args.tts_cache, args.llm)
+        clips = [read_wav(path, bot.RATE) for path in args.wavs]
+        clips += [synthetic_speech(1.5, bot.RATE, seed=i) for i in range(args.synthetic)]
+        report = asyncio.run(run(args, bot, clips))
+    finally:
+        stubs.stdin.close()
+        stubs.wait(timeout=10)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    failures = check_limits(report, args.max_p50)
+    for failure in failures:
+        print(f"Regression: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
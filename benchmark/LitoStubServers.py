@@ -0,0 +1,511 @@
+"""Local stand-ins for Google streaming recognize, the OpenAI Assistants API and edge-tts.
+
+Each one speaks enough of the real wire protocol for the unmodified clients
+(google-cloud-speech over gRPC, openai with OPENAI_BASE_URL, edge-tts over a
+websocket) and sleeps according to a latency profile, so the bot's own
+overhead can be measured without a network:
+
+    python benchmark/LitoStubServers.py --profile typical --transcript "你好"
+
+prints one JSON line with the endpoints once everything is listening.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import time
+import uuid
+
+import aiohttp
+import av
+import grpc
+import numpy as np
+from aiohttp import web
+from google.cloud import speech
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LitoSegmenter import CHINESE_WEIGHT, contains_chinese
+from LitoTTS import TTS_RATE
+
+logger = logging.getLogger(__name__)
+
+# Seconds unless noted. stt_*: interim results while audio arrives, the final one after the
+# client half-closes. llm_*: message create round trip, the queueing an Assistants run adds
+# before it starts, time to the first token and between tokens. tts_*: time to the first audio frame and between frames, seconds of speech per
+# English-character equivalent of text.
+PROFILES = {
+    'fast': {
+        'stt_interim_interval': 0.2, 'stt_final_delay': 0.05,
+        'llm_request_delay': 0.02, 'llm_run_overhead': 0.05, 'llm_first_token': 0.1, 'llm_token_interval': 0.01,
+        'tts_first_byte': 0.05, 'tts_chunk_interval': 0.02, 'tts_seconds_per_char': 0.06,
+    },
+    'typical': {
+        'stt_interim_interval': 0.3, 'stt_final_delay': 0.25,
+        'llm_request_delay': 0.15, 'llm_run_overhead': 0.3, 'llm_first_token': 0.6, 'llm_token_interval': 0.03,
+        'tts_first_byte': 0.25, 'tts_chunk_interval': 0.05, 'tts_seconds_per_char': 0.06,
+    },
+    'slow': {
+        'stt_interim_interval': 0.5, 'stt_final_delay': 0.6,
+        'llm_request_delay': 0.4, 'llm_run_overhead': 0.8, 'llm_first_token': 1.5, 'llm_token_interval': 0.06,
+        'tts_first_byte': 0.6, 'tts_chunk_interval': 0.1, 'tts_seconds_per_char': 0.06,
+    },
+}
+
+DEFAULT_TRANSCRIPT = "你好，你叫什么名字"
+DEFAULT_REPLY = "你好呀，我叫小乐！今天过得怎么样？我们可以一起讲故事，也可以一起唱歌。"
+
+_ids = itertools.count(1)
+
+
+def _id(prefix):
+    return f"{prefix}_{next(_ids):06d}"
+
+
+class StubSpeechServicer:
+    """google.cloud.speech.v1.Speech/StreamingRecognize, transcripts handed out in turn."""
+
+    def __init__(self, profile, transcripts):
+        self.profile = profile
+        self.transcripts = transcripts or [DEFAULT_TRANSCRIPT]
+        self._calls = itertools.count()
+
+    def streaming_recognize(self, requests, context):
+        transcript = self.transcripts[next(self._calls) % len(self.transcripts)]
+        step = max(1, len(transcript) // 4)
+        bytes_per_second = None
+        audio_bytes = 0
+        first_audio = None
+        last_interim = 0.0
+        shown = 0
+
+        for request in requests:
+            if 'streaming_config' in request:
+                config = request.streaming_config.config
+                if config.encoding == speech.RecognitionConfig.AudioEncoding.LINEAR16:
+                    bytes_per_second = 2 * (config.sample_rate_hertz or 16000)
+                continue
+            audio_bytes += len(request.audio_content)
+            now = time.monotonic()
+            first_audio = first_audio or now
+            if now - last_interim >= self.profile['stt_interim_interval'] and shown < len(transcript):
+                last_interim = now
+                shown = min(len(transcript), shown + step)
+                yield speech.StreamingRecognizeResponse(results=[speech.StreamingRecognitionResult(
+                    alternatives=[speech.SpeechRecognitionAlternative(transcript=transcript[:shown])],
+                    stability=0.9 if shown == len(transcript) else 0.1,
+                )])
+
+        if first_audio is None:
+            return
+        if bytes_per_second:
+            audio_seconds = audio_bytes / bytes_per_second
+        else:
+            audio_seconds = time.monotonic() - first_audio  # compressed audio arrives in real time
+        time.sleep(self.profile['stt_final_delay'])
+        yield speech.StreamingRecognizeResponse(results=[speech.StreamingRecognitionResult(
+            alternatives=[speech.SpeechRecognitionAlternative(transcript=transcript, confidence=0.95)],
+            is_final=True,
+            result_end_time=datetime.timedelta(seconds=audio_seconds),
+        )])
+
+
+def start_speech_server(profile, transcripts, host='127.0.0.1', port=0):
+    servicer = StubSpeechServicer(profile, transcripts)
+    handler = grpc.method_handlers_generic_handler('google.cloud.speech.v1.Speech', {
+        'StreamingRecognize': grpc.stream_stream_rpc_method_handler(
+            servicer.streaming_recognize,
+            request_deserializer=speech.StreamingRecognizeRequest.deserialize,
+            response_serializer=speech.StreamingRecognizeResponse.serialize,
+        ),
+    })
+    server = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=8))
+    server.add_generic_rpc_handlers((handler,))
+    port = server.add_insecure_port(f'{host}:{port}')
+    server.start()
+    return server, f'{host}:{port}'
+
+
+def _tokens(text):
+    """Roughly how the model streams: whole English words, one or two Chinese characters."""
+    return re.findall(r'[A-Za-z]+\s*|[一-鿿]{1,2}|.', text, flags=re.S)
+
+
+class StubAssistantsApp:
+    """The slice of the OpenAI API the bot uses: threads, messages, streamed runs, cancel, transcriptions,
+    chat completions (summaries, and streamed for the chat backend) and what LitoCreateAssistant.py
+    provisions. Prompt tokens are counted over what a run would read."""
+
+    def __init__(self, profile, reply, transcripts=None):
+        self.profile = profile
+        self.reply = reply
+        self.transcripts = transcripts or [DEFAULT_TRANSCRIPT]
+        self._transcriptions = itertools.count()
+        self.runs = {}
+        self.threads = collections.defaultdict(list)  # thread id -> messages, oldest first
+        self.app = web.Application()
+        self.app.add_routes([
+            web.post('/v1/assistants', self.create_assistant),
+            web.get('/v1/assistants/{assistant}', self.retrieve_assistant),
+            web.post('/v1/threads', self.create_thread),
+            web.get('/v1/threads/{thread}', self.retrieve_thread),
+            web.post('/v1/threads/{thread}/messages', self.create_message),
+            web.get('/v1/threads/{thread}/messages', self.list_messages),
+            web.delete('/v1/threads/{thread}/messages/{message}', self.delete_message),
+            web.post('/v1/threads/{thread}/runs', self.create_run),
+            web.get('/v1/threads/{thread}/runs/{run}', self.retrieve_run),
+            web.post('/v1/threads/{thread}/runs/{run}/cancel', self.cancel_run),
+            web.post('/v1/audio/transcriptions', self.transcribe),
+            web.post('/v1/chat/completions', self.complete),
+            web.get('/v1/models/{model}', self.retrieve_model),
+        ])
+
+    async def _delay(self):
+        await asyncio.sleep(self.profile['llm_request_delay'])
+
+    @staticmethod
+    def _message(message_id, thread_id, role, text=None, status='completed', run_id=None):
+        content = [] if text is None else [{'type': 'text', 'text': {'value': text, 'annotations': []}}]
+        return {
+            'id': message_id, 'object': 'thread.message', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'role': role, 'content': content, 'status': status,
+            'assistant_id': None, 'run_id': run_id, 'attachments': [], 'metadata': {},
+        }
+
+    def _run(self, run_id, thread_id, assistant_id, status):
+        return {
+            'id': run_id, 'object': 'thread.run', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'assistant_id': assistant_id, 'status': status,
+            'instructions': '', 'model': 'stub', 'tools': [], 'metadata': {},
+            'parallel_tool_calls': True,
+        }
+
+    @staticmethod
+    def _assistant(assistant_id, name='stub', model='stub', instructions=''):
+        return {'id': assistant_id, 'object': 'assistant', 'created_at': int(time.time()), 'name': name,
+                'description': None, 'model': model, 'instructions': instructions, 'tools': [], 'metadata': {}}
+
+    async def create_assistant(self, request):
+        body = await request.json()
+        await self._delay()
+        return web.json_response(self._assistant(_id('asst'), body.get('name'), body['model'],
+                                                 body.get('instructions')))
+
+    async def retrieve_assistant(self, request):
+        await self._delay()
+        return web.json_response(self._assistant(request.match_info['assistant']))
+
+    async def retrieve_thread(self, request):
+        await self._delay()
+        thread_id = request.match_info['thread']
+        if thread_id not in self.threads:
+            return web.json_response({'error': {'message': f"No thread found with id '{thread_id}'.",
+                                                'type': 'invalid_request_error'}}, status=404)
+        return web.json_response({'id': thread_id, 'object': 'thread', 'created_at': int(time.time()),
+                                  'metadata': {}})
+
+    async def create_thread(self, request):
+        body = await request.json() if request.can_read_body else {}
+        await self._delay()
+        thread_id = _id('thread')
+        self.threads[thread_id] = []
+        for message in body.get('messages', []):
+            self.threads[thread_id].append(self._message(_id('msg'), thread_id, message['role'], message['content']))
+        return web.json_response({'id': thread_id, 'object': 'thread', 'created_at': int(time.time()),
+                                  'metadata': {}})
+
+    async def create_message(self, request):
+        body = await request.json()
+        await self._delay()
+        thread_id = request.match_info['thread']
+        message = self._message(_id('msg'), thread_id, body.get('role', 'user'), body.get('content', ''))
+        self.threads[thread_id].append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request):
+        await self._delay()
+        messages = self.threads[request.match_info['thread']]
+        if 'run_id' in request.query:
+            messages = [m for m in messages if m['run_id'] == request.query['run_id']]
+        if request.query.get('order', 'desc') == 'desc':
+            messages = messages[::-1]
+        return web.json_response({'object': 'list', 'data': messages, 'has_more': False,
+                                  'first_id': messages[0]['id'] if messages else None,
+                                  'last_id': messages[-1]['id'] if messages else None})
+
+    async def delete_message(self, request):
+        await self._delay()
+        messages = self.threads[request.match_info['thread']]
+        messages[:] = [m for m in messages if m['id'] != request.match_info['message']]
+        return web.json_response({'id': request.match_info['message'], 'object': 'thread.message.deleted',
+                                  'deleted': True})
+
+    def _prompt_tokens(self, thread_id, body):
+        messages = self.threads[thread_id]
+        truncation = body.get('truncation_strategy') or {}
+        if truncation.get('type') == 'last_messages':
+            messages = messages[-truncation['last_messages']:]
+        text = (body.get('instructions') or '') + ''.join(
+            part['text']['value'] for message in messages for part in message['content'])
+        return len(_tokens(text))
+
+    async def retrieve_model(self, request):
+        await self._delay()
+        return web.json_response({'id': request.match_info['model'], 'object': 'model',
+                                  'created': int(time.time()), 'owned_by': 'stub'})
+
+    async def complete(self, request):
+        body = await request.json()
+        if body.get('stream'):
+            return await self._stream_completion(request, body)
+        await asyncio.sleep(self.profile['llm_first_token'])
+        # Stands in for a summary: the end of what it was asked to summarize
+        text = body['messages'][-1]['content'][-60:]
+        return web.json_response({
+            'id': _id('chatcmpl'), 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': text}}],
+            'usage': {'prompt_tokens': len(_tokens(json.dumps(body['messages'], ensure_ascii=False))),
+                      'completion_tokens': len(_tokens(text)), 'total_tokens': 0},
+        })
+
+    async def _stream_completion(self, request, body):
+        # The chat backend: the reply to the conversation it sent, as chat.completion.chunk events
+        completion_id = _id('chatcmpl')
+        prompt_tokens = len(_tokens(''.join(message['content'] for message in body['messages'])))
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        async def send(delta=None, finish_reason=None, usage=None):
+            choices = [] if delta is None else [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': body.get('model', 'stub'), 'choices': choices, 'usage': usage}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+
+        await asyncio.sleep(self.profile['llm_first_token'])
+        await send({'role': 'assistant', 'content': ''})
+        for token in _tokens(self.reply):
+            await send({'content': token})
+            await asyncio.sleep(self.profile['llm_token_interval'])
+        await send({}, 'stop')
+        if (body.get('stream_options') or {}).get('include_usage'):
+            completion_tokens = len(_tokens(self.reply))
+            await send(usage={'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                              'total_tokens': prompt_tokens + completion_tokens})
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def retrieve_run(self, request):
+        await self._delay()
+        run = self.runs.get(request.match_info['run'])
+        if run is None:
+            return web.json_response({'error': {'message': 'No run found', 'type': 'invalid_request_error'}},
+                                     status=404)
+        return web.json_response(run)
+
+    async def cancel_run(self, request):
+        await self._delay()
+        run = self.runs.get(request.match_info['run'])
+        if run is None:
+            return web.json_response({'error': {'message': 'No run found', 'type': 'invalid_request_error'}},
+                                     status=404)
+        if run['status'] in ('queued', 'in_progress'):
+            run['status'] = 'cancelled'
+        return web.json_response(run)
+
+    async def transcribe(self, request):
+        # Whisper backend: one transcript per uploaded segment, answered once it is complete
+        await request.post()
+        await asyncio.sleep(self.profile['stt_final_delay'])
+        transcript = self.transcripts[next(self._transcriptions) % len(self.transcripts)]
+        return web.json_response({'text': transcript})
+
+    async def create_run(self, request):
+        body = await request.json()
+        thread_id = request.match_info['thread']
+        run = self._run(_id('run'), thread_id, body.get('assistant_id'), 'queued')
+        self.runs[run['id']] = run
+        prompt_tokens = self._prompt_tokens(thread_id, body)
+        message_id = _id('msg')
+        message = None
+        spoken = ""
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        async def send(event, data):
+            await response.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+        try:
+            await send('thread.run.created', dict(run))
+            await asyncio.sleep(self.profile['llm_run_overhead'])
+            run['status'] = 'in_progress'
+            await send('thread.run.in_progress', dict(run))
+            await asyncio.sleep(self.profile['llm_first_token'])
+            # On the thread from here on, like the real one: a cancelled run leaves it incomplete
+            message = self._message(message_id, thread_id, 'assistant', status='in_progress', run_id=run['id'])
+            self.threads[thread_id].append(message)
+            await send('thread.message.created', message)
+            for token in _tokens(self.reply):
+                if run['status'] != 'in_progress':
+                    break
+                spoken += token
+                await send('thread.message.delta', {
+                    'id': message_id, 'object': 'thread.message.delta',
+                    'delta': {'content': [{'index': 0, 'type': 'text', 'text': {'value': token, 'annotations': []}}]},
+                })
+                await asyncio.sleep(self.profile['llm_token_interval'])
+            if run['status'] == 'in_progress':
+                message.update(self._message(message_id, thread_id, 'assistant', self.reply, run_id=run['id']))
+                await send('thread.message.completed', message)
+                run['status'] = 'completed'
+                await send('thread.run.completed', dict(run, usage={
+                    'prompt_tokens': prompt_tokens, 'completion_tokens': len(_tokens(self.reply)),
+                    'total_tokens': prompt_tokens + len(_tokens(self.reply)),
+                }))
+            else:
+                await send('thread.run.cancelled', dict(run))
+            await response.write(b"event: done\ndata: [DONE]\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            # The client closed the stream (barge-in), the run stops generating
+            if run['status'] == 'in_progress':
+                run['status'] = 'cancelled'
+            raise
+        finally:
+            if message is not None and message['status'] == 'in_progress':
+                message.update(self._message(message_id, thread_id, 'assistant', spoken, 'incomplete', run['id']))
+        return response
+
+
+class StubTTSApp:
+    """edge-tts websocket: turn.start, MP3 audio frames, turn.end for every SSML request."""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self._mp3 = {}
+        self.app = web.Application()
+        self.app.add_routes([web.get('/{tail:.*}', self.synthesize)])
+
+    def _audio(self, seconds):
+        """MP3 in the format edge-tts asks for, a quiet tone of the given length."""
+        seconds = round(seconds, 1)
+        if seconds not in self._mp3:
+            sink = _Collect()
+            container = av.open(sink, 'w', format='mp3')
+            stream = container.add_stream('libmp3lame', rate=TTS_RATE)
+            stream.layout = 'mono'
+            stream.bit_rate = 48000
+            t = np.arange(int(seconds * TTS_RATE)) / TTS_RATE
+            samples = (3000 * np.sin(2 * np.pi * 220 * t)).astype(np.int16).reshape(1, -1)
+            frame = av.AudioFrame.from_ndarray(samples, format='s16', layout='mono')
+            frame.sample_rate = TTS_RATE
+            for packet in itertools.chain(stream.encode(frame), stream.encode(None)):
+                container.mux(packet)
+            container.close()
+            self._mp3[seconds] = b"".join(sink.chunks)
+        return self._mp3[seconds]
+
+    def _duration(self, text):
+        weight = sum(CHINESE_WEIGHT if '一' <= c <= '鿿' else 1 for c in text)
+        return max(0.3, weight * self.profile['tts_seconds_per_char'])
+
+    async def synthesize(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT or 'Path:ssml' not in message.data:
+                continue
+            request_id = re.search(r'X-RequestId:(\w+)', message.data)
+            request_id = request_id.group(1) if request_id else uuid.uuid4().hex
+            text = re.sub(r'<[^>]+>', '', message.data.split('\r\n\r\n', 1)[-1])
+            mp3 = self._audio(self._duration(text))
+            logger.debug("TTS %s (%s): %d bytes", text, 'zh' if contains_chinese(text) else 'en', len(mp3))
+
+            await ws.send_str(f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\n"
+                              f"Path:turn.start\r\n\r\n{{}}")
+            await asyncio.sleep(self.profile['tts_first_byte'])
+            header = (f"X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\n"
+                      f"X-StreamId:{request_id}\r\nPath:audio\r\n").encode()
+            for start in range(0, len(mp3), 1440):
+                await ws.send_bytes(len(header).to_bytes(2, 'big') + header + mp3[start:start + 1440])
+                await asyncio.sleep(self.profile['tts_chunk_interval'])
+            await ws.send_str(f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\n"
+                              f"Path:turn.end\r\n\r\n{{}}")
+        return ws
+
+
+class _Collect:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+async def start_http_servers(profile, reply, transcripts=None, host='127.0.0.1'):
+    """Run the OpenAI and TTS stand-ins on the current loop, return their base URLs."""
+    endpoints = {}
+    runners = []
+    for name, app in (('openai', StubAssistantsApp(profile, reply, transcripts).app),
+                      ('tts', StubTTSApp(profile).app)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        runners.append(runner)
+        endpoints[name] = (f'http://{host}:{port}/v1' if name == 'openai'
+                           else f'ws://{host}:{port}/consumer/speech/synthesize/readaloud/edge/v1'
+                                f'?TrustedClientToken=stub')
+    return runners, endpoints
+
+
+def load_profile(name, overrides=None):
+    profile = dict(PROFILES[name])
+    for key, value in (overrides or {}).items():
+        if key not in profile:
+            raise ValueError(f"Unknown latency setting: {key}")
+        profile[key] = float(value)
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='typical')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=SECONDS',
+                        help="override one latency setting of the profile")
+    parser.add_argument('--transcript', action='append', default=[],
+                        help="what STT recognizes, one per utterance in turn")
+    parser.add_argument('--reply', default=DEFAULT_REPLY, help="what the assistant answers")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv('LITO_LOG_LEVEL', 'WARNING').upper())
+
+    profile = load_profile(args.profile, dict(item.split('=', 1) for item in args.set))
+    speech_server, stt_endpoint = start_speech_server(profile, args.transcript)
+
+    async def serve():
+        runners, endpoints = await start_http_servers(profile, args.reply, args.transcript)
+        endpoints['stt'] = stt_endpoint
+        print(json.dumps(endpoints), flush=True)
+        # Run until the benchmark closes our stdin
+        await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+        for runner in runners:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        speech_server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
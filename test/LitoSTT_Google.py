@@ -1,8 +1,12 @@
-import pyaudio
-import queue
+import os
+import sys
 from google.cloud import speech
 from google.oauth2 import service_account
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LitoCapture import MicrophoneStream
+
 # Audio recording parameters
 RATE = 44100
 CHUNK = int(RATE / 10)  # 100ms
@@ -10,47 +14,6 @@ CHUNK = int(RATE / 10)  # 100ms
 # Credentials for Google Cloud Speech API
 credentials = service_account.Credentials.from_service_account_file('google_speech_config.json')
 
-class MicrophoneStream:
-    """Opens a recording stream as a generator yielding the audio chunks."""
-    def __init__(self, rate, chunk):
-        self.rate = rate
-        self.chunk = chunk
-        self.p = pyaudio.PyAudio()
-        self.stream = None
-        self.closed = True
-
-    def __enter__(self):
-        self.stream = self.p.open(
-            format=pyaudio.paInt16,
-            channels=1,
-            rate=self.rate,
-            input=True,
-            frames_per_buffer=self.chunk,
-            stream_callback=self._fill_buffer
-        )
-        self._buff = queue.Queue()
-        self.closed = False
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.stream.stop_stream()
-        self.stream.close()
-        self.p.terminate()
-        self.closed = True
-        self._buff.put(None)  # Signal the generator to terminate
-
-    def _fill_buffer(self, in_data, frame_count, time_info, status_flags):
-        self._buff.put(in_data)
-        return None, pyaudio.paContinue
-
-    def generator(self):
-        while not self.closed:
-            chunk = self._buff.get()
-            if chunk is None:
-                return
-            yield chunk
-
-
 def main():
     client = speech.SpeechClient(credentials=credentials)
     config = speech.RecognitionConfig(
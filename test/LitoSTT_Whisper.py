@@ -1,19 +1,25 @@
 import pyaudio
-import wave
 from openai import OpenAI
 import os
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LitoCapture import SpeechGate
+from LitoWhisperSTT import WhisperSessionManager
+
 class LitoSpeechToText:
-    def __init__(self, device_index=1, format=pyaudio.paInt16, channels=1, rate=44100, chunk=4096, record_seconds=5, wave_output_filename="output.wav"):
+    def __init__(self, device_index=1, format=pyaudio.paInt16, channels=1, rate=44100, chunk=4096, max_record_seconds=30, trailing_silence=1.0):
         self.device_index = device_index
         self.format = format
         self.channels = channels
         self.rate = rate
         self.chunk = chunk
-        self.record_seconds = record_seconds
-        self.wave_output_filename = wave_output_filename
+        self.max_record_seconds = max_record_seconds
+        self.trailing_silence = trailing_silence
         self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # Compressed in memory and uploaded in pause-split segments while recording continues
+        self.whisper = WhisperSessionManager(self.client, rate)
 
     def list_audio_devices(self):
         audio = pyaudio.PyAudio()
@@ -23,7 +29,20 @@ class LitoSpeechToText:
             if (audio.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
                 print("Input Device id ", i, " - ", audio.get_device_info_by_host_api_device_index(0, i).get('name'))
 
-    def record_audio(self):
+    def _read_chunks(self, stream):
+        while True:
+            yield stream.read(self.chunk, exception_on_overflow=False)
+
+    def _limit(self, utterance):
+        seconds = 0.0
+        for chunk in utterance:
+            yield chunk
+            seconds += len(chunk) / 2 / self.rate
+            if seconds >= self.max_record_seconds:
+                return
+
+    def record_and_transcribe(self):
+        """Record until the user stops talking, transcribing while recording."""
         audio = pyaudio.PyAudio()
 
         # Redirect stderr to /dev/null to suppress ALSA/JACK logs
@@ -35,47 +54,37 @@ class LitoSpeechToText:
         stream = audio.open(format=self.format, channels=self.channels,
                             rate=self.rate, input=True, input_device_index=self.device_index,
                             frames_per_buffer=self.chunk)
-        print("Recording...")
-        frames = []
+        transcript = None
 
         try:
-            for _ in range(0, int(self.rate / self.chunk * self.record_seconds)):
-                data = stream.read(self.chunk, exception_on_overflow=False)
-                frames.append(data)
+            gate = SpeechGate(self._read_chunks(stream), self.rate, trailing_silence=self.trailing_silence)
+            print("Recording...")
+            utterance = gate.wait_for_speech()
+            for response in self.whisper.responses(self._limit(utterance)):
+                result = response.results[0]
+                if result.is_final:
+                    transcript = result.alternatives[0].transcript
+                else:
+                    print(f"... {result.alternatives[0].transcript}")
         except IOError as e:
             print(f"Error recording audio: {e}")
+        finally:
+            print("Finished recording.")
 
-        print("Finished recording.")
-
-        # Stop recording
-        stream.stop_stream()
-        stream.close()
-        audio.terminate()
-
-        # Save the recorded data as a WAV file
-        with wave.open(self.wave_output_filename, 'wb') as wf:
-            wf.setnchannels(self.channels)
-            wf.setsampwidth(audio.get_sample_size(self.format))
-            wf.setframerate(self.rate)
-            wf.writeframes(b''.join(frames))
+            # Stop recording
+            stream.stop_stream()
+            stream.close()
+            audio.terminate()
 
-        # Restore stderr
-        sys.stderr = original_stderr
-        fnull.close()
+            # Restore stderr
+            sys.stderr = original_stderr
+            fnull.close()
 
-    def transcribe_audio(self):
-        with open(self.wave_output_filename, "rb") as audio_file:
-            transcription = self.client.audio.transcriptions.create(
-                model="whisper-1", 
-                file=audio_file
-            )
-        return transcription.text
+        return transcript
 
     def get_speech_input(self):
-        self.record_audio()
-        print("Transcribing audio...")
         try:
-            transcript = self.transcribe_audio()
+            transcript = self.record_and_transcribe()
             print("Transcription:")
             print(transcript)
             return transcript
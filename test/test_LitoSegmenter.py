@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LitoSegmenter import StreamingSegmenter
+from LitoTTS import VOICE_CHINESE, VOICE_ENGLISH
+
+
+def segment(text, step=3, **options):
+    """Feed text in deltas of step characters, as the LLM stream does, and return the chunk texts."""
+    segmenter = StreamingSegmenter(**options)
+    chunks = []
+    for i in range(0, len(text), step):
+        chunks += segmenter.feed(text[i:i + step])
+    return [chunk for chunk, _ in chunks + segmenter.flush()]
+
+
+@pytest.mark.parametrize("step", [1, 3, 100])
+def test_abbreviations_and_numbers_stay_whole(step):
+    text = ("Hello there, friend. I really like many fruits, e.g. apples and pears. "
+            "Then I met Dr. Smith today. Pi is 3.14 and I owe 1,000 dollars.")
+    assert segment(text, step) == [
+        "Hello there,",
+        "friend. I really like many fruits, e.g. apples and pears.",
+        "Then I met Dr. Smith today.",
+        "Pi is 3.14 and I owe 1,000 dollars.",
+    ]
+
+
+def test_period_waits_for_the_next_word():
+    segmenter = StreamingSegmenter()
+    segmenter.feed("Okay, that is all fine.")
+    assert segmenter.feed(" ") == []
+    assert segmenter.feed("Next") == [("that is all fine.", VOICE_ENGLISH)]
+
+
+def test_period_before_closing_quote_or_chinese():
+    assert segment('He said "that is enough." Then he left.') == [
+        'He said "that is enough."',
+        "Then he left.",
+    ]
+    assert segment("我喜欢Python.你呢？") == ["我喜欢Python.", "你呢？"]
+
+
+def test_chinese_voice_and_weight():
+    segmenter = StreamingSegmenter()
+    chunks = segmenter.feed("你好，今天天气很好。") + segmenter.flush()
+    assert chunks == [("你好，", VOICE_CHINESE), ("今天天气很好。", VOICE_CHINESE)]
+
+
+def test_hard_cut_at_last_space():
+    chunks = segment("word " * 40, max_chars=20)
+    assert all(len(chunk) <= 20 for chunk in chunks)
+    assert " ".join(chunks).split() == ["word"] * 40
+
+
+def test_emojis_removed():
+    assert segment("Great news 😀! All done.") == ["Great news !", "All done."]